@@ -13,11 +13,14 @@ import picamera.array
 import cv2
 from geometry_msgs.msg import PoseStamped
 from sensor_msgs.msg import Image, Range, CameraInfo
+from std_msgs.msg import Int32
 import rospy
 import tf
 import sys
 from MATL_slam_helper import FastSLAM
 from MATL_helper import PROB_THRESHOLD, LocalizationParticleFilter
+from frame import Frame
+from frame_ingest import CapturedFrame
 
 # ---------- camera parameters DO NOT EDIT ----------- #
 CAMERA_WIDTH = 320
@@ -27,7 +30,9 @@ CAMERA_CENTER = np.float32([(CAMERA_WIDTH - 1) / 2., (CAMERA_HEIGHT - 1) / 2.]).
 # ---------- SLAM parameters ----------- #
 MAX_BAD_COUNT = -1000
 SLAM_PARTICLE = 20
+MIN_SLAM_PARTICLE = 8
 LOCALIZATION_PARTICLE = 40
+MIN_LOCALIZATION_PARTICLE = 12
 NUM_FEATURES = 50
 
 
@@ -39,9 +44,11 @@ class MATL(picamera.array.PiMotionAnalysis):
 
         self.posepub = rospy.Publisher('/pidrone/picamera/pose', PoseStamped, queue_size=1)
         self.first_image_pub = rospy.Publisher("/pidrone/picamera/first_image", Image, queue_size=1, latch=True)
+        self.num_particles_pub = rospy.Publisher('/pidrone/picamera/num_particles', Int32, queue_size=1)
 
         self.detector = cv2.ORB(nfeatures=NUM_FEATURES, scoreType=cv2.ORB_FAST_SCORE)
         self.SLAM_estimator = FastSLAM()
+        rospy.on_shutdown(self.SLAM_estimator.close)
         self.localization_estimator = None
 
         self.angle_x = 0.0
@@ -56,8 +63,7 @@ class MATL(picamera.array.PiMotionAnalysis):
         self.state = "START"
 
         self.prev_img = None
-        self.prev_kp = None
-        self.prev_des = None
+        self.prev_frame = None
         self.prev_time = None
 
         self.prev_rostime = None
@@ -76,7 +82,13 @@ class MATL(picamera.array.PiMotionAnalysis):
         self.hybrid_alpha = 0.3  # blend position with first frame and int
 
     def write(self, data):
-        curr_img = np.reshape(np.fromstring(data, dtype=np.uint8), (CAMERA_HEIGHT, CAMERA_WIDTH, 3))
+        self.process(CapturedFrame(data, CAMERA_WIDTH, CAMERA_HEIGHT, self.detector))
+
+    def process(self, captured):
+        """
+        :param captured: the CapturedFrame of the camera image
+        """
+        curr_img = captured.image
         curr_rostime = rospy.Time.now()
         self.posemsg.header.stamp = curr_rostime
         curr_time = curr_rostime.to_sec()
@@ -85,27 +97,31 @@ class MATL(picamera.array.PiMotionAnalysis):
         if self.state == "STANDBY" and self.compute_map:
 
             # create a SLAM object and the denominator for progress percentage
-            self.SLAM_estimator.generate_particles(SLAM_PARTICLE)
+            self.SLAM_estimator.generate_particles(SLAM_PARTICLE, MIN_SLAM_PARTICLE)
             denominator = len(self.map_data)
 
-            # run stored map data through fastSLAM to produce a map
-            for i in range(1, len(self.map_data)):
-                self.SLAM_estimator.run(self.z_data[i-1], self.map_data[i-1][0], self.map_data[i-1][1], self.map_data[i][0],
-                                        self.map_data[i][1])
-                # make a nice-looking progress bar
-                percent = int(round(float(i) / denominator, 2) * 100)
-                sys.stdout.write("\rIncorporated %d%% of data into map!" % percent)
-                sys.stdout.flush()
+            # run stored map data through fastSLAM to produce a map, rebuilding the frames one at a time so
+            # only the frames SLAM still uses hold their matchers and matches
+            prev_frame = None
+            for i, (points, des) in enumerate(self.map_data):
+                curr_frame = Frame(None, des, points)
+                if prev_frame is not None:
+                    self.SLAM_estimator.run(self.z_data[i-1], prev_frame, curr_frame)
+                    # make a nice-looking progress bar
+                    percent = int(round(float(i) / denominator, 2) * 100)
+                    sys.stdout.write("\rIncorporated %d%% of data into map!" % percent)
+                    sys.stdout.flush()
+                prev_frame = curr_frame
 
             # find the particle with the best map
-            particle_weights = [p.weight for p in self.SLAM_estimator.particles]
-            best_index = particle_weights.index(max(particle_weights))
-            map = self.SLAM_estimator.particles[best_index].landmarks
+            particles = self.SLAM_estimator.particles
+            best_index = np.argmax(particles.weights)
+            map = particles.landmarks(best_index)
             self.compute_map = False
 
             # initialize a localization object and sort the kp and des into grids
-            map_kp = [[lm.x, lm.y] for lm in map]
-            map_des = [[d for d in lm.des] for lm in map]
+            map_kp = particles.lm_pos[map].tolist()
+            map_des = list(particles.lm_des[map])
             self.localization_estimator = LocalizationParticleFilter()
             self.localization_estimator.create_map(map_kp, map_des)
 
@@ -113,17 +129,19 @@ class MATL(picamera.array.PiMotionAnalysis):
             print "The map is completed with ", len(map), "landmarks!"
             print self.state
         else:
-            curr_kp, curr_des = self.detector.detectAndCompute(curr_img, None)
+            curr_kp, curr_des = captured.features(NUM_FEATURES)
+            curr_frame = Frame(curr_kp, curr_des)
 
             if curr_kp is not None and curr_kp is not None:
 
                 if self.state == "MAPPING":
-                    self.map_data.append((curr_kp, curr_des))
+                    # keep only the keypoint coordinates and descriptors of the flight
+                    self.map_data.append((curr_frame.points, curr_des))
                     self.z_data.append(self.z)
                 elif self.state == "LOCALIZING":
                         if self.first_locate:
-                            particle = self.localization_estimator.initialize_particles(LOCALIZATION_PARTICLE, curr_kp,
-                                                                                        curr_des)
+                            particle = self.localization_estimator.initialize_particles(LOCALIZATION_PARTICLE, curr_frame,
+                                                                                    MIN_LOCALIZATION_PARTICLE)
                             self.first_locate = False
                             self.pos = [particle.x(), particle.y(), particle.z(), particle.yaw()]
 
@@ -138,11 +156,12 @@ class MATL(picamera.array.PiMotionAnalysis):
                             self.posemsg.pose.orientation.w = w
 
                             self.posepub.publish(self.posemsg)
+                            self.num_particles_pub.publish(self.localization_estimator.particles.num_particles)
 
                             print 'first', particle
                         else:
                             particle = self.localization_estimator.update(self.z, self.angle_x, self.angle_y,
-                                                                        self.prev_kp, self.prev_des, curr_kp, curr_des)
+                                                                        self.prev_frame, curr_frame)
 
                             # update position
                             self.pos = [self.hybrid_alpha * particle.x() + (1.0 - self.hybrid_alpha) * self.pos[0],
@@ -161,6 +180,7 @@ class MATL(picamera.array.PiMotionAnalysis):
                             self.posemsg.pose.orientation.w = w
 
                             self.posepub.publish(self.posemsg)
+                            self.num_particles_pub.publish(self.localization_estimator.particles.num_particles)
 
                             print '--pose', self.pos[0], self.pos[1], self.pos[3]
 
@@ -179,8 +199,7 @@ class MATL(picamera.array.PiMotionAnalysis):
                                 print 'Restart localization'
                             print 'count', self.map_counter
 
-                self.prev_kp = curr_kp
-                self.prev_des = curr_des
+                self.prev_frame = curr_frame
 
             else:
                 print "CANNOT FIND ANY FEATURES !!!!!"
@@ -7,6 +7,12 @@ Implements Monte-Carlo Localization for the PiDrone using a map generated by Fas
 import math
 import numpy as np
 import cv2
+import resampling
+import kld_sampling
+from matcher_pool import MatcherPool
+from matchers import create_matcher
+import bow_index
+import guided_matching
 
 
 # ----- camera parameters DO NOT EDIT ----- #
@@ -29,6 +35,12 @@ MATCH_RATIO = 0.7
 MIN_MATCH_COUNT = 3
 PROB_THRESHOLD = 0.001
 MAP_FEATURES = 600
+# the number of most similar map cells initialize_particles tries to match
+RELOCALIZATION_CANDIDATES = 8
+# side of a cell of the grid the SLAM map is partitioned into
+MAP_CELL_SIZE = 10
+# the key of the whole map in the matcher pool
+WHOLE_MAP = 'map'
 # ------------------------------------------ #
 
 
@@ -76,18 +88,29 @@ class LocalizationParticleFilter:
     def __init__(self):
         self.map_kp = None
         self.map_des = None
+        self.whole_map_kp = None
+        self.whole_map_des = None
+        self.relocalization_index = None
 
         self.particles = None
+        # the bounds of the number of particles, which follows the uncertainty of the belief
+        self.min_particles = None
+        self.max_particles = None
         self.measure_count = 0
 
-        index_params = dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1)
-        search_params = dict(checks=50)
-        self.matcher = cv2.FlannBasedMatcher(index_params, search_params)
+        self.matcher = create_matcher()
+        # one matcher trained on each map cell, so matching against a cell only runs the query
+        self.matcher_pool = MatcherPool()
 
         self.previous_time = None
 
-        self.key_kp = None
-        self.key_des = None
+        # the Frame of the most recent keyframe
+        self.key_frame = None
+
+        # the transforms from the previous frame and from the keyframe to the most recent frame, used to
+        # predict where the keypoints of the next frame are
+        self.frame_transform = None
+        self.key_transform = None
 
         self.z = 0.0
         self.angle_x = 0.0
@@ -110,18 +133,19 @@ class LocalizationParticleFilter:
                                            [0, 0, sigma_vz ** 2, 0],
                                            [0, 0, 0, sigma_yaw ** 2]])
 
-    def update(self, z, angle_x, angle_y, prev_kp, prev_des, kp, des):
+    def update(self, z, angle_x, angle_y, prev_frame, frame):
         """
         We implement the MCL algorithm from probabilistic robotics (Table 8.2)
-        kp is the position of detected features
-        des is the description of detected features
+        prev_frame is the Frame of the previous image
+        frame is the Frame of the current image, holding its detected features
         """
         # update parameters
         self.z = z
         self.angle_x = angle_x
         self.angle_y = angle_y
 
-        transform = self.compute_transform(prev_kp, prev_des, kp, des)
+        transform = self.compute_transform(prev_frame, frame, self.frame_transform)
+        self.frame_transform = transform
 
         if transform is not None:
             x = -transform[0, 2]
@@ -131,9 +155,14 @@ class LocalizationParticleFilter:
             self.sample_motion_model(x, y, yaw)
 
             # if there is some previous keyframe
-            if self.key_kp is not None and self.key_des is not None:
+            if self.key_frame is not None:
+
+                predicted = None
+                if self.key_transform is not None:
+                    predicted = guided_matching.compose(self.frame_transform, self.key_transform)
 
-                transform = self.compute_transform(self.key_kp, self.key_des, kp, des)
+                transform = self.compute_transform(self.key_frame, frame, predicted)
+                self.key_transform = transform
 
                 if transform is not None:
                     # distance since previous keyframe in PIXELS
@@ -144,17 +173,20 @@ class LocalizationParticleFilter:
                     # if we've moved an entire camera frame distance since the last keyframe (or yawed 10 degrees)
                     if distance(x, y, 0, 0) > KEYFRAME_DIST_THRESHOLD or yaw > KEYFRAME_YAW_THRESHOLD:
 
-                        self.measurement_model(kp, des)
-                        self.key_kp, self.key_des = kp, des
+                        self.measurement_model(frame)
+                        self.key_frame = frame
+                        self.key_transform = guided_matching.IDENTITY
                 else:
                     # moved too far to transform from last keyframe, so set a new one
-                    self.measurement_model(kp, des)
-                    self.key_kp, self.key_des = kp, des
+                    self.measurement_model(frame)
+                    self.key_frame = frame
+                    self.key_transform = guided_matching.IDENTITY
 
             # there is no previous keyframe
             else:
-                self.measurement_model(kp, des)
-                self.key_kp, self.key_des = kp, des
+                self.measurement_model(frame)
+                self.key_frame = frame
+                self.key_transform = guided_matching.IDENTITY
 
         self.resample_particles()
         return self.get_estimated_position()
@@ -162,56 +194,28 @@ class LocalizationParticleFilter:
     def sample_motion_model(self, x, y, yaw):
         """
         Implement motion model from Equation 3 in PiDrone Slam with noise.
+        Every particle gets its own noise, and all particles are moved at once.
         """
         # add noise
-        noisy_x_y_z_yaw = np.random.multivariate_normal([x, y, self.z, yaw], self.covariance_motion)
+        noisy_x_y_z_yaw = np.random.multivariate_normal([x, y, self.z, yaw], self.covariance_motion,
+                                                        self.particles.num_particles)
 
-        for i in range(self.particles.num_particles):
-            pose = self.particles.poses[i]
-            pose[0] += self.pixel_to_meter(noisy_x_y_z_yaw[0])
-            pose[1] += self.pixel_to_meter(noisy_x_y_z_yaw[1])
-            pose[2] = self.z
-            pose[3] += noisy_x_y_z_yaw[3]
-            pose[3] = adjust_angle(pose[3])
-
-    def measurement_model(self, kp, des):
+        poses = self.particles.poses
+        poses[:, 0] += self.pixel_to_meter(noisy_x_y_z_yaw[:, 0])
+        poses[:, 1] += self.pixel_to_meter(noisy_x_y_z_yaw[:, 1])
+        poses[:, 2] = self.z
+        poses[:, 3] = adjust_angle(poses[:, 3] + noisy_x_y_z_yaw[:, 3])
+
+    def measurement_model(self, frame):
         """
         landmark_model_known_correspondence from probablistic robotics 6.6
+        every particle is matched against the whole map, so the map is matched once per frame and the
+        result is shared by all particles
         """
+        pose, num = self.compute_location(frame, self.whole_map_kp, self.whole_map_des, WHOLE_MAP)
+
         for i in range(self.particles.num_particles):
             position = self.particles.poses[i]
-            """
-            # the grid that we suspect this pose is in
-            grid_x = int(math.floor(position[0] * 10))
-            grid_y = int(math.floor(position[1] * 10))
-
-            sub_map_kp = []
-            sub_map_des = []
-
-            # get the des from that cell and all those surrounding it
-            for g in range(-1, 2):
-                for j in range(-1, 2):
-                    if 0 <= grid_x + g < self.map_grid_size_x and 0 <= grid_y + j < self.map_grid_size_y:
-                        sub_map_kp += self.map_kp[grid_y + j][grid_x + g]
-                        sub_map_des += self.map_des[grid_y + j][grid_x + g]
-
-            # note that if the pose is negative (moved off the map since all map landmarks are positive) then
-            # sub_map_kp/des will be empty, in which case we will not compute a gobal pose
-            pose = None
-            if sub_map_des and sub_map_kp:
-                pose, num = self.compute_location(kp, des, sub_map_kp, sub_map_des)
-            
-            """
-            map_kp = []
-            map_des = []
-
-            # get the des from that cell and all those surrounding it
-            for g in range(self.map_grid_size_x):
-                for j in range(self.map_grid_size_y):
-                    map_kp += self.map_kp[j][g]
-                    map_des += self.map_des[j][g]
-
-            pose, num = self.compute_location(kp, des, map_kp, map_des)
 
             # compute weight of particle
             if pose is None:
@@ -237,22 +241,30 @@ class LocalizationParticleFilter:
     def resample_particles(self):
         """""
         samples a new particle set, biased towards particles with higher weights
+        uses low variance resampling, and keeps the particles while their weights have not degenerated
+        the number of particles is chosen with KLD-sampling, growing to the maximum when the filter is lost
         """""
-        weights_sum = np.sum(self.particles.weights)
-        new_poses = []
-        new_weights = []
-
-        normal_weights = self.particles.weights / float(weights_sum)  # normalize
-        # samples sums to num_particles with same length as normal_weights, positions with higher weights are
-        # more likely to be sampled
-        samples = np.random.multinomial(self.particles.num_particles, normal_weights)
-        for i, count in enumerate(samples):
-            for _ in range(count):
-                new_poses.append(self.particles.poses[i])
-                new_weights.append(self.particles.weights[i])
-
-        self.particles.poses = np.array(new_poses)
-        self.particles.weights = np.array(new_weights)
+        normal_weights = self.particles.weights / float(np.sum(self.particles.weights))  # normalize
+        if not self.is_lost():
+            indices = kld_sampling.resample(normal_weights, self.particles.poses, self.min_particles,
+                                            self.max_particles)
+        elif self.particles.num_particles != self.max_particles:
+            indices = resampling.systematic(normal_weights, self.max_particles)
+        else:
+            indices = resampling.resample(normal_weights)
+
+        if indices is None:
+            return
+
+        weights = self.particles.weights[indices]
+        self.particles = ParticleSet(len(indices), self.particles.poses[indices])
+        self.particles.weights[:] = weights
+
+    def is_lost(self):
+        """""
+        :return: True if no particle is close to a pose measured against the map
+        """""
+        return np.all(self.particles.weights <= PROB_THRESHOLD)
 
     def get_estimated_position(self):
         """""
@@ -273,27 +285,32 @@ class LocalizationParticleFilter:
 
         return Particle(0, np.array([[x, y, z, yaw]]), np.array([weights_sum / self.particles.weights.size]))
 
-    def initialize_particles(self, num_particles, kp, des):
+    def initialize_particles(self, num_particles, frame, min_particles=None):
         """
         find most possible location to start
-        :param num_particles: number of particles we are using
-        :param kp: the keyPoints of the first captured image
-        :param des: the descriptions of the first captured image
+        :param num_particles: number of particles we are using, and the most the filter will use
+        :param frame: the Frame of the first captured image
+        :param min_particles: the fewest particles the filter will use, by default the number stays fixed
         """
-        self.key_kp, self.key_des = None, None
+        self.max_particles = num_particles
+        self.min_particles = min_particles if min_particles is not None else num_particles
+        self.key_frame = None
+        self.frame_transform, self.key_transform = None, None
         weights_sum = 0.0
         weights = []
         poses = []
-        new_poses = []
 
-        # go through every grid, trying to find matched features
-        for x in range(self.map_grid_size_x):
-            for y in range(self.map_grid_size_y):
-                p, w = self.compute_location(kp, des, self.map_kp[y][x], self.map_des[y][x])
-                if p is not None:
-                    poses.append([p[0], p[1], p[2], p[3]])
-                    weights.append(w)
-                    weights_sum += w
+        # rank the grids by how similar their features are to the image, and only try to match the best ones
+        candidates = []
+        if self.relocalization_index is not None:
+            candidates = self.relocalization_index.query(frame.des, RELOCALIZATION_CANDIDATES)
+
+        for x, y in candidates:
+            p, w = self.compute_location(frame, self.map_kp[y][x], self.map_des[y][x], (x, y))
+            if p is not None:
+                poses.append([p[0], p[1], p[2], p[3]])
+                weights.append(w)
+                weights_sum += w
 
         # cannot find a match
         if len(poses) == 0:
@@ -309,43 +326,44 @@ class LocalizationParticleFilter:
 
         # sample particles based on the number of matched features
         weights = np.array(weights) / weights_sum  # normalize
-        samples = np.random.multinomial(num_particles, weights)  # sample
-        for i, count in enumerate(samples):
-            for _ in range(count):
-                new_poses.append(poses[i])
+        indices = resampling.systematic(weights, num_particles)  # sample
 
-        self.particles = ParticleSet(num_particles, np.array(new_poses))
+        self.particles = ParticleSet(num_particles, np.array(poses)[indices])
         return self.get_estimated_position()
 
-    def compute_location(self, kp1, des1, kp2, des2):
+    def compute_location(self, frame, kp2, des2, cell=None):
         """
         compute the global location of center of current image
-        :param kp1: captured keyPoints
-        :param des1: captured descriptions
+        :param frame: the Frame of the captured image
         :param kp2: map keyPoints
         :param des2: map descriptions
+        :param cell: the key of the map cell kp2 and des2 belong to, to match with the cell's trained matcher
         :return: global pose
         """
 
         good = []
         pose = None
 
-        if des1 is not None and des2 is not None and len(des1) != 0 and len(des2) != 0:
+        # the ratio test needs at least two map features
+        if frame.des is not None and des2 is not None and len(frame.des) != 0 and len(des2) > 1:
             des22 = np.asarray(des2, np.uint8)
-            matches = self.matcher.knnMatch(des1, des22, k=2)
+            if cell is not None:
+                matches = self.matcher_pool.get(cell, des22).knnMatch(frame.des, k=2)
+            else:
+                matches = self.matcher.knnMatch(frame.des, des22, k=2)
 
             for match in matches:
                 if len(match) > 1 and match[0].distance < MATCH_RATIO*match[1].distance:
                     good.append(match[0])
 
             if len(good) >= MIN_MATCH_COUNT:
-                # switch the origin to be in the bottom right corner rather than top
-                kp1_flip = [[k.pt[0], CAMERA_HEIGHT - k.pt[1]] for k in kp1]
-
-                # convert current image keypoints from pixels to meters
-                kp1_meter = [[self.pixel_to_meter(k[0]), self.pixel_to_meter(k[1])] for k in kp1_flip]
+                # switch the origin to be in the bottom right corner rather than top, and convert the matched
+                # keypoints of the current image from pixels to meters
+                query = [m.queryIdx for m in good]
+                kp1_meter = self.pixel_to_meter(np.column_stack((frame.points[query, 0],
+                                                                 CAMERA_HEIGHT - frame.points[query, 1])))
 
-                src_pts = np.float32([kp1_meter[m.queryIdx] for m in good]).reshape(-1, 1, 2)
+                src_pts = np.float32(kp1_meter).reshape(-1, 1, 2)
                 dst_pts = np.float32([kp2[m.trainIdx] for m in good]).reshape(-1, 1, 2)
 
                 transform = cv2.estimateRigidTransform(src_pts, dst_pts, False)
@@ -368,24 +386,19 @@ class LocalizationParticleFilter:
         print "computed pose: ", pose
         return pose, len(good)
 
-    def compute_transform(self, kp1, des1, kp2, des2):
-        transform = None
-
-        if des1 is not None and des2 is not None:
-            matches = self.matcher.knnMatch(des1, des2, k=2)
-
-            good = []
-            for match in matches:
-                if len(match) > 1 and match[0].distance < MATCH_RATIO * match[1].distance:
-                    good.append(match[0])
+    def compute_transform(self, frame1, frame2, predicted=None):
+        """
+        :param frame1, frame2: the Frames to transform from and to
+        :param predicted: a predicted 2 x 3 transform from frame 1 to frame 2, used to guide the matching
+        """
+        query, train = frame2.match(frame1, predicted)
 
-            src_pts = np.float32([kp1[m.queryIdx].pt for m in good]).reshape(-1, 1, 2)
-            dst_pts = np.float32([kp2[m.trainIdx].pt for m in good]).reshape(-1, 1, 2)
-            # estimateRigidTransform needs at least three pairs
-            if src_pts is not None and dst_pts is not None and len(src_pts) > 3 and len(dst_pts) > 3:
-                transform = cv2.estimateRigidTransform(src_pts, dst_pts, False)
+        # estimateRigidTransform needs at least three pairs
+        if len(query) > 3:
+            return cv2.estimateRigidTransform(frame1.points[query].reshape(-1, 1, 2),
+                                              frame2.points[train].reshape(-1, 1, 2), False)
 
-        return transform
+        return None
 
     def pixel_to_meter(self, px):
         """""
@@ -395,69 +408,66 @@ class LocalizationParticleFilter:
 
     def create_map(self, map_kp, map_des):
         """
-        Partitions the set of keypoints and descriptors from the SLAM map into 10cm x 10cm grids and
-        places them into matrices
+        Partitions the set of keypoints and descriptors from the SLAM map into grid cells and
+        places them into matrices, the keypoints are bucketed by sorting them by cell once, so each
+        cell's keypoints and descriptors are contiguous arrays ready for knnMatch
 
         :param map_kp: the keypoints from the SLAM-generated map as a list of pairs [[x1,y1],...,[xn,yn]]
         :param map_des: the descriptors from the SLAM_generated map as a list of lists of 8-bit integers
         """
-
-        # find the minimum x and y values
-        x_list = [pt[0] for pt in map_kp]
-        y_list = [pt[1] for pt in map_kp]
+        points = np.array(map_kp, dtype=np.float64).reshape(-1, 2)
+        descriptors = np.array(map_des, dtype=np.uint8).reshape(len(points), -1)
 
         # adjust kp x and y values to all be in the first quadrant
-        min_x, min_y = float(min(x_list)), float(min(y_list))
-        if min_x < 0:
-            x_list = map(lambda n: n - min_x, x_list)
-        if min_y < 0:
-            y_list = map(lambda n: n - min_y, y_list)
+        points -= np.minimum(points.min(axis=0), 0)
 
-        max_x, self.min_x, max_y, self.min_y = max(x_list), min(x_list), max(y_list), min(y_list)
+        self.min_x, self.min_y = points.min(axis=0)
+        x_range, y_range = points.max(axis=0) - (self.min_x, self.min_y)
 
-        x_range = max_x - self.min_x
-        y_range = max_y - self.min_y
+        # divide the range into grids
+        self.map_grid_size_x = max(int(math.ceil(x_range / MAP_CELL_SIZE)), 1)
+        self.map_grid_size_y = max(int(math.ceil(y_range / MAP_CELL_SIZE)), 1)
 
-        # divide the range into grids that are 10cm wide
-        self.map_grid_size_x = int(math.ceil(x_range * 0.1))
-        self.map_grid_size_y = int(math.ceil(y_range * 0.1))
+        # the grid cell of each kp, a kp on the far edge of the map goes in the last cell
+        grid_x = np.minimum(((points[:, 0] - self.min_x) // MAP_CELL_SIZE).astype(np.int64), self.map_grid_size_x - 1)
+        grid_y = np.minimum(((points[:, 1] - self.min_y) // MAP_CELL_SIZE).astype(np.int64), self.map_grid_size_y - 1)
+        cells = grid_x * self.map_grid_size_y + grid_y
 
-        # create matrices to hold the kp and des in each grid
-        map_grid_kp = [[[] for _ in range(self.map_grid_size_x)] for _ in range(self.map_grid_size_y)]
-        map_grid_des = [[[] for _ in range(self.map_grid_size_x)] for _ in range(self.map_grid_size_y)]
+        # sort the kp and des by cell, keeping the map's order within a cell
+        order = np.argsort(cells, kind='mergesort')
+        points, descriptors, cells = points[order], descriptors[order], cells[order]
+        bounds = np.searchsorted(cells, np.arange(self.map_grid_size_x * self.map_grid_size_y + 1))
 
-        # put all kp and des into the grids to which they belong
+        # matrices holding views of the kp and des in each grid
+        map_grid_kp = [[None for _ in range(self.map_grid_size_x)] for _ in range(self.map_grid_size_y)]
+        map_grid_des = [[None for _ in range(self.map_grid_size_x)] for _ in range(self.map_grid_size_y)]
         for x in range(self.map_grid_size_x):
-            x_bound = self.min_x + 10 * x
             for y in range(self.map_grid_size_y):
-                y_bound = self.min_y + 10 * y
-                for i, [x_n, y_n] in enumerate(zip(x_list, y_list)):
-                    if x_bound <= x_n < x_bound + 10 and y_bound <= y_n < y_bound + 10:
-                        map_grid_kp[y][x].append([x_n, y_n])
-                        map_grid_des[y][x].append(map_des[i])
-
-        # process the des so they will be compatible with knnMatch in compute_location
-        for x in range(self.map_grid_size_x):
-            for y in range(self.map_grid_size_y):
-                lst = map_grid_des[y][x]
-                for d in lst:
-                    for x in d:
-                        x = x.astype(np.uint8)
+                cell = x * self.map_grid_size_y + y
+                map_grid_kp[y][x] = points[bounds[cell]:bounds[cell + 1]]
+                map_grid_des[y][x] = descriptors[bounds[cell]:bounds[cell + 1]]
 
         self.map_kp = map_grid_kp
         self.map_des = map_grid_des
 
+        # every particle is matched against the whole map, the sorted arrays are the cells one after another
+        self.whole_map_kp = points
+        self.whole_map_des = descriptors
+
+        # ranks the map cells by similarity to an image for relocalization
+        cells = [(x, y) for x in range(self.map_grid_size_x) for y in range(self.map_grid_size_y)]
+        self.relocalization_index = bow_index.build_index(cells, [map_grid_des[y][x] for x, y in cells])
+
+        # the trained matchers belong to the old map
+        self.matcher_pool.clear()
+        self.matcher_pool.fill(((x, y), map_grid_des[y][x]) for x, y in cells)
+
 
 def adjust_angle(angle):
     """""
-    keeps angle within -pi to pi
+    keeps angle within -pi to pi, works on scalars and on arrays of angles
     """""
-    while angle > math.pi:
-        angle -= 2 * math.pi
-    while angle <= -math.pi:
-        angle += 2 * math.pi
-
-    return angle
+    return math.pi - np.mod(math.pi - angle, 2 * math.pi)
 
 
 def norm_pdf(x, mu, sigma):
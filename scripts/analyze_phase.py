@@ -6,6 +6,7 @@ import numpy as np
 from pidrone_pkg.msg import State
 from std_msgs.msg import Empty, Bool
 from geometry_msgs.msg import PoseStamped
+from frame_ingest import CapturedFrame
 
 
 class AnalyzePhase(picamera.array.PiMotionAnalysis):
@@ -58,11 +59,15 @@ class AnalyzePhase(picamera.array.PiMotionAnalysis):
 
     def write(self, data):
         ''' A method that is called everytime an image is taken '''
+        self.process(CapturedFrame(data, 320, 240, None))
+
+    def process(self, captured):
+        ''' Estimate the pose from the image of a CapturedFrame '''
 
         # Run the following only if position control is enabled to prevent
         # wasting computation resources on unused position data
         if self.position_control:
-            image = np.reshape(np.fromstring(data, dtype=np.uint8), (240, 320, 3))
+            image = captured.image
             # if there is no first image stored, tell the user to capture an image
             if self.first:
                 self.first = False
@@ -0,0 +1,190 @@
+"""
+bow_index.py
+
+A bag of binary words index over the cells of a feature map, used to relocalize without matching against
+every cell
+
+The vocabulary is a tree built by hierarchical k-majority clustering of the map's ORB descriptors, and a
+descriptor's word is the leaf reached by descending to the closest child center at each level. Each cell is
+described by the TF-IDF weighted histogram of the words of its descriptors, and a frame is compared with
+every cell at once by the intersection of the L1 normalized histograms.
+"""
+
+from __future__ import division
+import numpy as np
+import hamming
+
+BRANCHING = 8
+DEPTH = 3
+ITERATIONS = 5
+# the vocabulary is trained on a random subset of the map's descriptors when the map is larger than this
+MAX_TRAINING_DESCRIPTORS = 5000
+
+
+class Vocabulary(object):
+    """
+    a vocabulary tree of binary words
+
+    attributes:
+    centers:  the descriptor at the center of each node, node 0 is the root
+    children: the child nodes of each node, -1 marks a missing child
+    words:    the word of each leaf node, -1 for inner nodes
+    """
+
+    def __init__(self, descriptors, branching=BRANCHING, depth=DEPTH, iterations=ITERATIONS, seed=0):
+        """
+        :param descriptors: N x D array of the uint8 descriptors to train the vocabulary on
+        :param branching: the number of children of each node
+        :param depth: the number of levels below the root
+        :param iterations: the number of k-majority iterations at each node
+        :param seed: the seed of the random choices, so the same map gives the same vocabulary
+        """
+        random = np.random.RandomState(seed)
+        descriptors = np.asarray(descriptors, dtype=np.uint8)
+        if len(descriptors) > MAX_TRAINING_DESCRIPTORS:
+            descriptors = descriptors[random.choice(len(descriptors), MAX_TRAINING_DESCRIPTORS, replace=False)]
+
+        centers = [np.zeros(descriptors.shape[1], dtype=np.uint8)]
+        children = [[]]
+        stack = [(0, descriptors, 0)]
+        while len(stack) != 0:
+            node, members, level = stack.pop()
+            k = min(branching, len(members))
+            if level == depth or k < 2:
+                continue
+
+            node_centers, labels = k_majority(members, k, iterations, random)
+            for c in range(k):
+                children[node].append(len(centers))
+                stack.append((len(centers), members[labels == c], level + 1))
+                centers.append(node_centers[c])
+                children.append([])
+
+        self.centers = np.array(centers, dtype=np.uint8)
+        self.children = np.full((len(centers), branching), -1, dtype=np.int64)
+        for node, node_children in enumerate(children):
+            self.children[node, :len(node_children)] = node_children
+
+        leaves = self.children[:, 0] < 0
+        self.words = np.full(len(centers), -1, dtype=np.int64)
+        self.words[leaves] = np.arange(np.count_nonzero(leaves))
+        self.num_words = np.count_nonzero(leaves)
+
+    def transform(self, descriptors):
+        """
+        :param descriptors: N x D array of uint8 descriptors
+        :return: the word of each descriptor
+        """
+        descriptors = np.asarray(descriptors, dtype=np.uint8)
+        nodes = np.zeros(len(descriptors), dtype=np.int64)
+
+        while True:
+            inner = np.flatnonzero(self.children[nodes, 0] >= 0)
+            if len(inner) == 0:
+                return self.words[nodes]
+
+            # move each descriptor at an inner node to the closest of the node's children
+            node_children = self.children[nodes[inner]]
+            dist = hamming.paired_distances(descriptors[inner, np.newaxis, :],
+                                            self.centers[np.maximum(node_children, 0)])
+            dist[node_children < 0] = np.iinfo(dist.dtype).max
+            nodes[inner] = node_children[np.arange(len(inner)), dist.argmin(axis=1)]
+
+
+class BowIndex(object):
+    """
+    ranks the cells of a map by the similarity of their bag of words to a query frame
+    """
+
+    def __init__(self, vocabulary, keys, documents):
+        """
+        :param vocabulary: the Vocabulary to describe descriptors with
+        :param keys: the key of each cell
+        :param documents: the array of descriptors of each cell
+        """
+        self.vocabulary = vocabulary
+        self.keys = list(keys)
+
+        counts = np.zeros((len(documents), vocabulary.num_words))
+        for d, descriptors in enumerate(documents):
+            if len(descriptors) != 0:
+                counts[d] = np.bincount(vocabulary.transform(descriptors), minlength=vocabulary.num_words)
+
+        # words which appear in few cells tell the cells apart, words in every cell do not
+        containing = (counts > 0).sum(axis=0)
+        self.idf = np.log(max(len(documents), 1) / np.maximum(containing, 1))
+
+        self.vectors = np.array([self.normalize(c * self.idf) for c in counts])
+
+    def vector(self, descriptors):
+        """
+        :param descriptors: the descriptors of a frame
+        :return: the L1 normalized TF-IDF vector of the frame
+        """
+        counts = np.bincount(self.vocabulary.transform(descriptors), minlength=self.vocabulary.num_words)
+        return self.normalize(counts * self.idf)
+
+    def scores(self, descriptors):
+        """
+        :param descriptors: the descriptors of a frame
+        :return: the similarity of each cell to the frame, between 0 and 1
+        """
+        return np.minimum(self.vectors, self.vector(descriptors)).sum(axis=1)
+
+    def query(self, descriptors, num_results):
+        """
+        :param descriptors: the descriptors of a frame
+        :param num_results: the number of cells to return
+        :return: the keys of the cells most similar to the frame, most similar first, cells sharing no
+                 words with the frame are left out
+        """
+        if descriptors is None or len(descriptors) == 0 or len(self.keys) == 0:
+            return []
+
+        scores = self.scores(descriptors)
+        best = np.argsort(-scores, kind='mergesort')[:num_results]
+        return [self.keys[i] for i in best if scores[i] > 0]
+
+    @staticmethod
+    def normalize(vector):
+        total = np.sum(vector)
+        return vector / total if total > 0 else vector
+
+
+def build_index(keys, documents):
+    """
+    trains a vocabulary on the descriptors of every cell and indexes the cells with it
+
+    :param keys: the key of each cell
+    :param documents: the array of descriptors of each cell
+    :return: the BowIndex of the cells, or None if the cells hold too few descriptors for a vocabulary
+    """
+    descriptors = [d for d in documents if len(d) != 0]
+    if len(descriptors) == 0 or sum(len(d) for d in descriptors) < 2:
+        return None
+
+    return BowIndex(Vocabulary(np.concatenate(descriptors)), keys, documents)
+
+
+def k_majority(descriptors, k, iterations, random):
+    """
+    clusters binary descriptors around k centers, each center holds the majority value of every bit of the
+    descriptors assigned to it
+
+    :param descriptors: N x D array of uint8 descriptors, N >= k
+    :param k: the number of clusters
+    :param iterations: the number of assignment and update steps
+    :param random: the RandomState choosing the initial centers
+    :return: k x D array of the centers and the cluster of each descriptor
+    """
+    centers = descriptors[random.choice(len(descriptors), k, replace=False)].copy()
+    bits = np.unpackbits(descriptors, axis=1)
+
+    for _ in range(iterations):
+        labels = hamming.distances(descriptors, centers).argmin(axis=1)
+        for c in range(k):
+            members = bits[labels == c]
+            if len(members) != 0:
+                centers[c] = np.packbits(2 * members.sum(axis=0) > len(members))
+
+    return centers, hamming.distances(descriptors, centers).argmin(axis=1)
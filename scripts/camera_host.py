@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""
+camera_host.py
+
+Owns the camera and shares it between analyzers, so optical flow, phase analysis or SLAM/localization and
+object tracking can run together instead of each node opening the camera itself
+
+The motion vectors are handed to the motion analyzers (AnalyzeFlow) on the camera's thread. Each frame analyzer
+(AnalyzePhase, SLAM, Localizer, MATL, ObjectTracker) runs behind its own FramePipeline and gets the newest frame
+as a CapturedFrame, which runs ORB at most once per frame for all of them. Every analyzer can be given the most
+frames per second it is handed.
+
+usage: camera_host.py [--flow [HZ]] [--phase [HZ]] [--slam [HZ] | --localization [HZ] | --matl [HZ]]
+                      [--tracking [HZ]]
+"""
+
+import os
+import sys
+import argparse
+import cv2
+import rospy
+import picamera
+import camera_info_manager
+from cv_bridge import CvBridge
+from sensor_msgs.msg import Image, CameraInfo
+from std_msgs.msg import Empty
+from pidrone_pkg.msg import State
+from analyze_flow import AnalyzeFlow
+from analyze_phase import AnalyzePhase
+from frame_pipeline import FramePipeline
+from frame_ingest import CapturedFrame
+import frame_ingest
+import onboard_slam
+import onboard_localization
+import MATL
+import object_tracking
+
+CAMERA_WIDTH = 320
+CAMERA_HEIGHT = 240
+FRAMERATE = 90
+
+
+class RateLimit(object):
+    """
+    lets through at most rate events per second
+    """
+
+    def __init__(self, rate=None):
+        """
+        :param rate: the most events per second, None or 0 for no limit
+        """
+        self.period = 1.0 / rate if rate else 0.0
+        self.last = None
+
+    def ready(self, now):
+        """
+        :param now: the time of the event in seconds
+        :return: True if the event is let through
+        """
+        if self.last is not None and now - self.last < self.period:
+            return False
+
+        self.last = now
+        return True
+
+
+class MotionOutput(object):
+    """
+    the output of the motion vectors, which hands them to every motion analyzer on the camera's thread
+    """
+
+    def __init__(self):
+        self.analyzers = []
+
+    def write(self, data):
+        now = rospy.get_time()
+        for analyzer, limit in self.analyzers:
+            if limit.ready(now):
+                analyzer.write(data)
+
+    def flush(self):
+        pass
+
+
+class CameraHost(object):
+    """
+    the output of the camera frames, which wraps every frame in a CapturedFrame and hands it to the pipeline of
+    every frame analyzer
+
+    attributes:
+    latest: the CapturedFrame of the newest frame and the time it was captured, None before the first frame
+    """
+
+    def __init__(self, camera, num_features=None):
+        """
+        :param camera: the PiCamera
+        :param num_features: the most features any frame analyzer asks for, None if no analyzer uses features
+        """
+        self.camera = camera
+        self.detector = cv2.ORB(nfeatures=num_features, scoreType=cv2.ORB_FAST_SCORE) if num_features else None
+        self.motion_output = MotionOutput()
+        self.pipelines = []
+
+        self.latest = None
+
+    def add_motion_analyzer(self, analyzer, rate=None):
+        """
+        :param analyzer: an object with a write(data) method taking the motion vectors of a frame
+        :param rate: the most frames per second to hand to the analyzer, None for every frame
+        """
+        self.motion_output.analyzers.append((analyzer, RateLimit(rate)))
+
+    def add_frame_analyzer(self, analyzer, name, rate=None):
+        """
+        :param analyzer: an object with a process(captured) method taking a CapturedFrame
+        :param name: the name of the analyzer's frame counters, see FramePipeline
+        :param rate: the most frames per second to hand to the analyzer, None for every frame
+        """
+        self.pipelines.append((FramePipeline(analyzer, name, analyzer.process), RateLimit(rate)))
+
+    def write(self, data):
+        captured = CapturedFrame(data, CAMERA_WIDTH, CAMERA_HEIGHT, self.detector)
+        stamp = rospy.Time.now()
+        self.latest = (captured, stamp)
+
+        now = stamp.to_sec()
+        for pipeline, limit in self.pipelines:
+            if limit.ready(now):
+                pipeline.write(captured)
+
+    def flush(self):
+        pass
+
+    def start(self):
+        self.camera.start_recording("/dev/null", format='h264', splitter_port=1, motion_output=self.motion_output)
+        self.camera.start_recording(self, format=frame_ingest.FORMAT, splitter_port=2)
+
+    def stop(self):
+        self.camera.stop_recording(splitter_port=1)
+        self.camera.stop_recording(splitter_port=2)
+        for pipeline, _ in self.pipelines:
+            pipeline.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Share the camera between the vision analyzers')
+    # each analyzer is run if its flag is given, optionally with the most frames per second it is handed
+    for name, help_text in (('flow', 'optical flow from the motion vectors'),
+                            ('phase', 'position from the first and previous images'),
+                            ('slam', 'SLAM'),
+                            ('localization', 'localization in map.jpg'),
+                            ('matl', 'mapping and then localization'),
+                            ('tracking', 'object tracking')):
+        parser.add_argument('--' + name, type=float, nargs='?', const=0, default=None, metavar='HZ', help=help_text)
+    args = parser.parse_args()
+
+    estimators = [arg for arg in (args.slam, args.localization, args.matl) if arg is not None]
+    if len(estimators) > 1:
+        parser.error('run at most one of --slam, --localization and --matl')
+
+    node_name = os.path.splitext(os.path.basename(__file__))[0]
+    rospy.init_node(node_name)
+
+    image_pub = rospy.Publisher("/pidrone/picamera/image_raw", Image, queue_size=1, tcp_nodelay=False)
+    camera_info_pub = rospy.Publisher("/pidrone/picamera/camera_info", CameraInfo, queue_size=1, tcp_nodelay=False)
+
+    cim = camera_info_manager.CameraInfoManager("picamera", "package://pidrone_pkg/params/picamera.yaml")
+    cim.loadCameraInfo()
+    if not cim.isCalibrated():
+        rospy.logerr("warning, could not find calibration for the camera.")
+
+    try:
+        bridge = CvBridge()
+
+        with picamera.PiCamera(framerate=FRAMERATE) as camera:
+            camera.resolution = (CAMERA_WIDTH, CAMERA_HEIGHT)
+
+            # the ORB pass is shared, so it finds as many features as the analyzer which wants the most
+            num_features = []
+            analyzers = []
+
+            if args.flow is not None:
+                flow_analyzer = AnalyzeFlow(camera)
+                flow_analyzer.setup(camera.resolution)
+                analyzers.append(('flow', flow_analyzer, args.flow, True))
+
+            if args.phase is not None:
+                phase_analyzer = AnalyzePhase(camera)
+                phase_analyzer.setup()
+                analyzers.append(('phase', phase_analyzer, args.phase, False))
+
+            if args.slam is not None:
+                estimator = onboard_slam.SLAM(camera, bridge)
+                num_features.append(onboard_slam.NUM_FEATURES)
+                analyzers.append(('slam', estimator, args.slam, False))
+            elif args.localization is not None:
+                estimator = onboard_localization.Localizer(camera, bridge)
+                num_features.append(onboard_localization.NUM_FEATURES)
+                analyzers.append(('localization', estimator, args.localization, False))
+            elif args.matl is not None:
+                estimator = MATL.MATL(camera, bridge)
+                rospy.Subscriber('/pidrone/map', Empty, estimator.map_callback)
+                num_features.append(MATL.NUM_FEATURES)
+                analyzers.append(('matl', estimator, args.matl, False))
+            else:
+                estimator = None
+
+            if estimator is not None:
+                rospy.Subscriber('/pidrone/reset_transform', Empty, estimator.reset_callback)
+                rospy.Subscriber('/pidrone/state', State, estimator.state_callback)
+
+            if args.tracking is not None:
+                tracker = object_tracking.ObjectTracker(camera)
+                rospy.Subscriber('/pidrone/reset_transform', Empty, tracker.reset_callback)
+                rospy.Subscriber('/pidrone/state', State, tracker.state_callback)
+                num_features.append(object_tracking.NUM_FEATURES)
+                analyzers.append(('object_tracking', tracker, args.tracking, False))
+
+            host = CameraHost(camera, max(num_features) if num_features else None)
+            for name, analyzer, rate, motion in analyzers:
+                if motion:
+                    host.add_motion_analyzer(analyzer, rate)
+                else:
+                    host.add_frame_analyzer(analyzer, name, rate)
+
+            print "Camera host started with", ", ".join(name for name, _, _, _ in analyzers)
+            host.start()
+            last_stamp = None
+            while not rospy.is_shutdown():
+                camera.wait_recording(1 / 100.0)
+
+                # publish the raw image so that the web interface can display the camera feed
+                latest = host.latest
+                if latest is not None and latest[1] != last_stamp:
+                    captured, last_stamp = latest
+                    image_message = bridge.cv2_to_imgmsg(captured.image, encoding="mono8")
+                    image_message.header.stamp = last_stamp
+                    image_pub.publish(image_message)
+                    camera_info_pub.publish(cim.getCameraInfo())
+
+            host.stop()
+        print "Shutdown Received"
+        sys.exit()
+    except Exception:
+        print "Camera Error!!"
+        raise
+
+
+if __name__ == '__main__':
+    main()
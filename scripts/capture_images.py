@@ -15,6 +15,7 @@ import time
 from cv_bridge import CvBridge, CvBridgeError
 import camera_info_manager
 import os
+import frame_ingest
 
 
 CAMERA_WIDTH = 320
@@ -52,7 +53,7 @@ class AnalyzePhase(picamera.array.PiMotionAnalysis):
         self.i = 1
 
     def write(self, data):
-        curr_img = np.reshape(np.fromstring(data, dtype=np.uint8), (CAMERA_HEIGHT, CAMERA_WIDTH, 3))
+        curr_img = frame_ingest.luminance(data, CAMERA_WIDTH, CAMERA_HEIGHT)
         curr_rostime = rospy.Time.now()
         curr_time = curr_rostime.to_sec()
 
@@ -89,13 +90,13 @@ def main():
             phase_analyzer = AnalyzePhase(camera, bridge)
 
             print "Starting Flow"
-            camera.start_recording(phase_analyzer, format='bgr', splitter_port=1)
+            camera.start_recording(phase_analyzer, format=frame_ingest.FORMAT, splitter_port=1)
             last_time = None
             while not rospy.is_shutdown():
                 camera.wait_recording(1 / 30.0)
 
                 if phase_analyzer.prev_img is not None and phase_analyzer.prev_time != last_time:
-                    image_message = bridge.cv2_to_imgmsg(phase_analyzer.prev_img, encoding="bgr8")
+                    image_message = bridge.cv2_to_imgmsg(phase_analyzer.prev_img, encoding="mono8")
                     image_message.header.stamp = phase_analyzer.prev_rostime
                     # print "stamp", image_message.header.stamp
                     last_time = phase_analyzer.prev_rostime
@@ -0,0 +1,139 @@
+"""
+feature_map.py
+
+A compiled feature map: the keypoints and descriptors of a map image, already grouped by grid cell, in a
+file which is memory-mapped on load instead of re-running ORB over the whole map image on every startup
+
+The file holds a fixed size header followed by three arrays:
+offsets:     (cells + 1) int64, the entries of cell c are offsets[c]:offsets[c + 1]
+points:      entries x 2 float32, the pixel coordinates of the keypoints of each cell's group
+descriptors: entries x DES_SIZE uint8, the descriptors of those keypoints
+
+Cells are stored in row-major order of (x, y), and each cell holds its whole group of keypoints, so
+the keypoints of a cell and its neighbors are one contiguous slice ready to be matched against.
+The header records the format version and the parameters the map was built with, a file whose version or
+parameters differ is rejected and the map has to be compiled again.
+"""
+
+import os
+import struct
+import numpy as np
+
+MAGIC = 'PIDRNMAP'
+VERSION = 1
+DES_SIZE = 32
+
+# magic, version, grid size x, grid size y, number of entries, number of features per cell of the image,
+# size and modification time of the source image
+HEADER = struct.Struct('<8sIIIQQQQ')
+HEADER_SIZE = 64
+
+
+class FeatureMap(object):
+    """
+    a compiled feature map opened read only, the arrays are memory-mapped from the file
+    """
+
+    def __init__(self, file_name):
+        with open(file_name, 'rb') as f:
+            fields = HEADER.unpack(f.read(HEADER.size))
+
+        magic, version, self.grid_size_x, self.grid_size_y, num_entries, self.num_features, \
+            self.source_size, self.source_mtime = fields
+        if magic != MAGIC:
+            raise ValueError("%s is not a compiled feature map" % file_name)
+        if version != VERSION:
+            raise ValueError("%s has feature map version %d, expected %d" % (file_name, version, VERSION))
+
+        num_cells = self.grid_size_x * self.grid_size_y
+        offset = HEADER_SIZE
+        self.offsets = np.memmap(file_name, dtype=np.int64, mode='r', offset=offset, shape=(num_cells + 1,))
+        offset += self.offsets.nbytes
+        self.points = np.memmap(file_name, dtype=np.float32, mode='r', offset=offset, shape=(num_entries, 2))
+        offset += self.points.nbytes
+        self.descriptors = np.memmap(file_name, dtype=np.uint8, mode='r', offset=offset,
+                                     shape=(num_entries, DES_SIZE))
+
+    def cell(self, x, y):
+        """
+        :param x, y: the grid cell
+        :return: the points and descriptors of the keypoints grouped into the cell
+        """
+        c = x * self.grid_size_y + y
+        start, end = self.offsets[c], self.offsets[c + 1]
+        return self.points[start:end], self.descriptors[start:end]
+
+    def grid(self):
+        """
+        :return: the points and descriptors of every cell, as lists indexed [x][y]
+        """
+        cells = [[self.cell(x, y) for y in range(self.grid_size_y)] for x in range(self.grid_size_x)]
+        return [[points for points, _ in column] for column in cells], \
+               [[descriptors for _, descriptors in column] for column in cells]
+
+    def matches_source(self, source_file, num_features):
+        """
+        :param source_file: the image the map should have been compiled from
+        :param num_features: the number of features per cell of the image the map should have been built with
+        :return: True if the map was compiled from the current version of source_file with num_features
+        """
+        stat = os.stat(source_file)
+        return self.num_features == num_features and self.source_size == stat.st_size \
+            and self.source_mtime == int(stat.st_mtime)
+
+
+def write_map(file_name, grid_points, grid_descriptors, num_features, source_file):
+    """
+    writes a compiled feature map, the file is written to a temporary name and renamed so a reader never
+    sees a partial map
+
+    :param file_name: the file to write
+    :param grid_points: lists indexed [x][y] of the N x 2 points of each cell
+    :param grid_descriptors: lists indexed [x][y] of the N x DES_SIZE descriptors of each cell
+    :param num_features: the number of features per cell of the image the map was built with
+    :param source_file: the image the map was built from
+    """
+    grid_size_x, grid_size_y = len(grid_points), len(grid_points[0])
+    cells = [(x, y) for x in range(grid_size_x) for y in range(grid_size_y)]
+
+    counts = [len(grid_points[x][y]) for x, y in cells]
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    points = np.zeros((offsets[-1], 2), dtype=np.float32)
+    descriptors = np.zeros((offsets[-1], DES_SIZE), dtype=np.uint8)
+    for c, (x, y) in enumerate(cells):
+        if counts[c] != 0:
+            points[offsets[c]:offsets[c + 1]] = grid_points[x][y]
+            descriptors[offsets[c]:offsets[c + 1]] = grid_descriptors[x][y]
+
+    stat = os.stat(source_file)
+    header = HEADER.pack(MAGIC, VERSION, grid_size_x, grid_size_y, offsets[-1], num_features,
+                         stat.st_size, int(stat.st_mtime))
+
+    temp_name = file_name + '.tmp'
+    with open(temp_name, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, '\0'))
+        f.write(offsets.tobytes())
+        f.write(points.tobytes())
+        f.write(descriptors.tobytes())
+    os.rename(temp_name, file_name)
+
+
+def load_map(file_name, source_file, num_features):
+    """
+    :param file_name: the compiled map
+    :param source_file: the image the map should have been compiled from
+    :param num_features: the number of features per cell of the image the map should have been built with
+    :return: the FeatureMap, or None if the file is missing, is not a current map or is out of date
+    """
+    if not os.path.exists(file_name):
+        return None
+
+    try:
+        feature_map = FeatureMap(file_name)
+    except (ValueError, struct.error):
+        return None
+
+    if not feature_map.matches_source(source_file, num_features):
+        return None
+
+    return feature_map
@@ -0,0 +1,127 @@
+"""
+feature_transport.py
+
+Sends the ORB features of camera frames to offboard SLAM or localization instead of the frames themselves
+
+A 320x240 BGR frame is 230400 bytes on the Wi-Fi link, and the offboard node only runs ORB on it. The drone
+runs ORB instead and sends a FrameFeatures message with the keypoint coordinates as int16 in 1/16 pixels, the
+pyramid level and the 32 byte descriptor of each keypoint, and the altitude and attitude SLAM and localization
+need with the frame. At 200 features that is 37 bytes per keypoint and about 7.4 KB per frame.
+
+The keypoints are sent strongest first, so a node which wants fewer features than the drone detects keeps the
+same features a detector of its own size would have found, see frame_ingest.strongest.
+"""
+
+import numpy as np
+import cv2
+import rospy
+from rospy.numpy_msg import numpy_msg
+from pidrone_pkg.msg import FrameFeatures
+from frame import Frame
+from frame_ingest import level_quotas
+
+FEATURES_TOPIC = '/pidrone/picamera/features'
+# the features the drone detects, as many as the offboard node which wants the most
+NUM_FEATURES = 200
+DES_SIZE = 32
+# the keypoint coordinates are sent in 1/POINT_SCALE pixels
+POINT_SCALE = 16
+
+FeaturesMsg = numpy_msg(FrameFeatures)
+
+
+def pack(kp, des, z, angle_x, angle_y, msg=None):
+    """
+    :param kp, des: the keypoints and descriptors, as returned by detectAndCompute
+    :param z, angle_x, angle_y: the altitude and attitude when the frame was captured
+    :param msg: the message to fill in, a new one if None
+    :return: the FrameFeatures message, its header is left to the caller
+    """
+    if msg is None:
+        msg = FeaturesMsg()
+
+    kp = kp if kp is not None else []
+    order = np.argsort([-k.response for k in kp], kind='mergesort').astype(np.int64)
+
+    points = np.float32([kp[i].pt for i in order]).reshape(-1, 2)
+    msg.points = np.round(points * POINT_SCALE).astype(np.int16).ravel()
+    msg.octaves = np.uint8([kp[i].octave for i in order])
+    msg.descriptors = des[order].ravel() if len(kp) != 0 else np.empty(0, dtype=np.uint8)
+    msg.z, msg.angle_x, msg.angle_y = z, angle_x, angle_y
+
+    return msg
+
+
+def unpack(msg, num_features=None):
+    """
+    :param msg: the FrameFeatures message
+    :param num_features: the most features to keep, the strongest of each pyramid level, None for all of them
+    :return: the Frame of the features
+    """
+    points = np.asarray(msg.points, dtype=np.int16).reshape(-1, 2).astype(np.float32) / POINT_SCALE
+    des = np.asarray(msg.descriptors, dtype=np.uint8).reshape(-1, DES_SIZE)
+
+    if num_features is not None and len(points) > num_features:
+        octaves = np.asarray(msg.octaves, dtype=np.uint8)
+        # the keypoints are sorted strongest first, so the first ones of each level are its strongest
+        keep = np.sort(np.concatenate([np.nonzero(octaves == level)[0][:quota]
+                                       for level, quota in enumerate(level_quotas(num_features))]))
+        points, des = points[keep], des[keep]
+
+    return Frame(None, des if len(des) != 0 else None, points)
+
+
+class FeaturePublisher(object):
+    """
+    detects the features of camera frames and publishes them, while an offboard node subscribes to them
+    """
+
+    def __init__(self, num_features=NUM_FEATURES):
+        """
+        :param num_features: the number of features to detect in each frame
+        """
+        self.detector = cv2.ORB(nfeatures=num_features, scoreType=cv2.ORB_FAST_SCORE)
+        self.features_pub = rospy.Publisher(FEATURES_TOPIC, FeaturesMsg, queue_size=1)
+        self.msg = FeaturesMsg()
+
+        self.z = 0.0
+        self.angle_x = 0.0
+        self.angle_y = 0.0
+
+    def state_callback(self, data):
+        """ update z, angle x, and angle y data when /pidrone/state is published to """
+        self.z = data.pose_with_covariance.pose.position.z
+        self.angle_x = data.twist_with_covariance.twist.angular.x
+        self.angle_y = data.twist_with_covariance.twist.angular.y
+
+    def publish(self, image, stamp):
+        """
+        :param image: the camera frame
+        :param stamp: the rospy.Time the frame was captured
+        """
+        # no ORB pass while nobody uses the features
+        if self.features_pub.get_num_connections() == 0:
+            return
+
+        kp, des = self.detector.detectAndCompute(image, None)
+        pack(kp, des, self.z, self.angle_x, self.angle_y, self.msg)
+        self.msg.header.stamp = stamp
+        self.features_pub.publish(self.msg)
+
+
+class FeatureSubscriber(object):
+    """
+    calls back with the Frame, altitude and attitude of every frame whose features the drone publishes
+    """
+
+    def __init__(self, callback, num_features=None):
+        """
+        :param callback: called with the Frame, z, angle x and angle y of each frame
+        :param num_features: the most features of each frame to use, None for all of them
+        """
+        self.callback = callback
+        self.num_features = num_features
+        self.features_sub = rospy.Subscriber(FEATURES_TOPIC, FeaturesMsg, self.features_callback)
+
+    def features_callback(self, msg):
+        self.callback(unpack(msg, self.num_features), msg.z, msg.angle_x, msg.angle_y)
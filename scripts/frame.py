@@ -0,0 +1,96 @@
+"""
+frame.py
+
+A camera frame's features, created once per frame and shared by everything which uses them
+
+The odometry matches a frame against the previous frame and the keyframe checks match it against the keyframe,
+which is often the previous frame itself. The frame keeps its keypoint coordinates in one array, builds its
+matcher index once and remembers its matches against every frame it was matched with, so none of that is
+computed twice.
+"""
+
+import itertools
+import numpy as np
+import guided_matching
+from matchers import create_matcher
+
+MATCH_RATIO = 0.7
+
+# gives every frame a distinct id, used to key the matches between frames
+frame_ids = itertools.count()
+
+
+class Frame(object):
+    """
+    attributes:
+    id:      a number identifying the frame
+    kp:      the list of keypoints, empty for a frame whose features were detected on another host
+    des:     the descriptors of the keypoints, None if there are no keypoints
+    points:  N x 2 float32 array of the keypoint coordinates
+    matches: the matches against earlier frames, keyed by their id
+    """
+
+    def __init__(self, kp, des, points=None):
+        """
+        :param kp: the keypoints, None if there are none or the frame is built from points
+        :param des: the descriptors of the keypoints
+        :param points: the keypoint coordinates, given instead of the keypoints, see feature_transport
+        """
+        self.id = next(frame_ids)
+        self.kp = kp if kp is not None else []
+        self.des = des
+        if points is not None:
+            self.points = np.float32(points).reshape(-1, 2)
+        else:
+            self.points = np.float32([k.pt for k in self.kp]).reshape(-1, 2)
+        self.matches = {}
+        self.index = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def matcher(self):
+        """
+        :return: a matcher trained on the frame's descriptors, built on the first call
+        """
+        if self.index is None:
+            self.index = create_matcher()
+            self.index.add([self.des])
+            self.index.train()
+
+        return self.index
+
+    def match(self, other, predicted=None):
+        """
+        matches the keypoints of an earlier frame against the keypoints of this one
+
+        the matches are computed once for each pair of frames and cached on this frame, so the prediction only
+        matters the first time a pair is matched
+
+        :param other: the earlier frame
+        :param predicted: a predicted 2 x 3 transform from the other frame to this one, if given the keypoints are
+                          first matched only near their predicted positions, falling back to matching against
+                          every keypoint when that gives too few matches
+        :return: arrays of the indices of the matched keypoints in the other frame and in this one
+        """
+        matches = self.matches.get(other.id)
+        if matches is not None:
+            return matches
+
+        if other.des is None or self.des is None:
+            matches = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        else:
+            matches = None
+            if predicted is not None:
+                matches = guided_matching.match(other.points, other.des, self.points, self.des, predicted)
+                if len(matches[0]) < guided_matching.MIN_MATCH_COUNT:
+                    matches = None
+
+            if matches is None:
+                good = [m[0] for m in self.matcher().knnMatch(other.des, k=2)
+                        if len(m) > 1 and m[0].distance < MATCH_RATIO * m[1].distance]
+                matches = (np.array([m.queryIdx for m in good], dtype=np.int64),
+                           np.array([m.trainIdx for m in good], dtype=np.int64))
+
+        self.matches[other.id] = matches
+        return matches
@@ -0,0 +1,119 @@
+"""
+frame_ingest.py
+
+Reads the luminance of camera frames without copying them
+
+ORB and estimateRigidTransform only look at the brightness of an image. Recording in YUV420 instead of BGR,
+the camera delivers the brightness as the first plane of every frame, so a frame can be used as a view of that
+plane on the bytes picamera hands over. There is no copy of the frame and no color conversion, a YUV420 frame
+is half the size of a BGR frame, and the brightness which is read is a third of it.
+
+A CapturedFrame carries a frame to the analyzers which share a camera, and runs ORB on it at most once for all
+of them.
+"""
+
+import threading
+import numpy as np
+
+# the recording format to start the camera with for luminance frames
+FORMAT = 'yuv'
+# the pyramid of the ORB detectors, OpenCV's defaults
+SCALE_FACTOR = 1.2
+NUM_LEVELS = 8
+
+
+def raw_resolution(width, height):
+    """
+    :param width, height: the camera resolution
+    :return: the size of the Y plane picamera delivers, whose width is padded to a multiple of 32 and height
+             to a multiple of 16
+    """
+    return (width + 31) // 32 * 32, (height + 15) // 16 * 16
+
+
+def luminance(data, width, height):
+    """
+    :param data: the bytes of a YUV420 frame recorded at width x height
+    :param width, height: the camera resolution
+    :return: height x width uint8 array of the frame's brightness, a read-only view of data
+    """
+    stride, _ = raw_resolution(width, height)
+    return np.frombuffer(data, dtype=np.uint8, count=stride * height).reshape(height, stride)[:, :width]
+
+
+# detectors are not safe to use from several threads at once, so one detection runs at a time
+detector_lock = threading.Lock()
+
+
+class CapturedFrame(object):
+    """
+    a camera frame handed to the frame analyzers, which shares the ORB pass between all analyzers of the frame
+
+    attributes:
+    data:  the bytes of the YUV420 frame
+    image: the luminance of the frame, see luminance
+    """
+
+    def __init__(self, data, width, height, detector):
+        """
+        :param data: the bytes of a YUV420 frame recorded at width x height
+        :param width, height: the camera resolution
+        :param detector: the ORB detector, which must find as many features as any analyzer asks for
+        """
+        self.data = data
+        self.image = luminance(data, width, height)
+        self.detector = detector
+        self.detected = None
+        self.lock = threading.Lock()
+
+    def features(self, num_features=None):
+        """
+        detects the features of the frame on the first call, later calls reuse them
+
+        :param num_features: the most features to return, the strongest are kept, None for all of them
+        :return: the keypoints and descriptors, as returned by detectAndCompute
+        """
+        with self.lock:
+            if self.detected is None:
+                with detector_lock:
+                    self.detected = self.detector.detectAndCompute(self.image, None)
+
+        kp, des = self.detected
+        if num_features is None or kp is None or len(kp) <= num_features:
+            return kp, des
+
+        keep = strongest(kp, num_features)
+        return [kp[i] for i in keep], des[keep]
+
+
+def level_quotas(num_features, scale_factor=SCALE_FACTOR, num_levels=NUM_LEVELS):
+    """
+    :return: the number of features ORB keeps on each pyramid level when it detects num_features, fewer on the
+             smaller levels
+    """
+    factor = 1 / scale_factor
+    desired = num_features * (1 - factor) / (1 - factor ** num_levels)
+
+    quotas = []
+    for _ in range(num_levels - 1):
+        quotas.append(int(round(desired)))
+        desired *= factor
+    quotas.append(max(num_features - sum(quotas), 0))
+
+    return quotas
+
+
+def strongest(kp, num_features):
+    """
+    picks the features a detector of num_features would have kept from the features of a larger detector,
+    the strongest of each pyramid level up to the level's quota
+
+    :param kp: the keypoints
+    :param num_features: the number of features to keep
+    :return: the sorted indices of the kept keypoints
+    """
+    octaves = np.array([k.octave for k in kp])
+    order = np.argsort([-k.response for k in kp], kind='mergesort')
+
+    keep = [order[octaves[order] == level][:quota] for level, quota in enumerate(level_quotas(num_features))]
+    return np.sort(np.concatenate(keep))
@@ -0,0 +1,106 @@
+"""
+frame_pipeline.py
+
+Runs a camera frame consumer on its own worker thread
+
+picamera calls the write method of a recording's output on its output thread, so a consumer which does its
+work there holds up the encoder whenever a frame takes longer than the frame period, and the frames queue up
+behind it. A FramePipeline is the output instead: its write only stamps the frame and puts it in a single slot,
+replacing a frame the worker has not taken yet, and the worker always processes the newest frame. OpenCV and
+numpy release the GIL while they work, so the worker runs alongside the camera.
+
+For every consumer the pipeline publishes the number of frames dropped so far and the time from the capture of
+each processed frame to the end of its processing.
+"""
+
+import threading
+import rospy
+from std_msgs.msg import Int32, Float32
+
+
+class FramePipeline(object):
+    """
+    a picamera output which hands the newest frame to consumer.write on a worker thread
+
+    attributes:
+    dropped:   the number of frames replaced before the worker took them
+    processed: the number of frames the consumer processed
+    latency:   the seconds from the capture of the last processed frame to the end of its processing
+    """
+
+    def __init__(self, consumer, name, handler=None):
+        """
+        :param consumer: an object with a write(data) method taking a frame's bytes
+        :param name: the name of the consumer, its counters are published under /pidrone/picamera/<name>/
+        :param handler: the function to call with each frame instead of consumer.write
+        """
+        self.consumer = consumer
+        self.handler = handler if handler is not None else consumer.write
+        self.dropped = 0
+        self.processed = 0
+        self.latency = 0.0
+
+        self.dropped_pub = rospy.Publisher('/pidrone/picamera/' + name + '/dropped_frames', Int32, queue_size=1)
+        self.latency_pub = rospy.Publisher('/pidrone/picamera/' + name + '/latency', Float32, queue_size=1)
+
+        # the newest frame and its capture time, None once the worker took it
+        self.slot = None
+        self.condition = threading.Condition()
+        self.running = True
+        self.error = None
+
+        self.worker = threading.Thread(target=self.run, name=name)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def write(self, data):
+        """
+        called by picamera on its output thread for every frame, stores the frame for the worker
+
+        :param data: the bytes of the frame, or whatever the handler takes
+        """
+        # let an error of the consumer stop the recording, as it would if the consumer were the output
+        if self.error is not None:
+            raise self.error
+
+        with self.condition:
+            if self.slot is not None:
+                self.dropped += 1
+            self.slot = (data, rospy.get_time())
+            self.condition.notify()
+
+    def flush(self):
+        pass
+
+    def run(self):
+        """
+        the worker loop, processes the newest frame whenever there is one
+        """
+        while True:
+            with self.condition:
+                while self.slot is None and self.running:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                (data, stamp), self.slot = self.slot, None
+
+            try:
+                self.handler(data)
+            except Exception as error:
+                self.error = error
+                rospy.logerr('frame consumer %s failed: %s', self.worker.name, error)
+                return
+
+            self.processed += 1
+            self.latency = rospy.get_time() - stamp
+            self.dropped_pub.publish(self.dropped)
+            self.latency_pub.publish(self.latency)
+
+    def close(self):
+        """
+        stops the worker once it has finished the frame it is processing, frames still waiting are dropped
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.worker.join()
@@ -0,0 +1,292 @@
+"""
+frame_transport.py
+
+Hands camera frames to nodes on the same host through shared memory instead of ROS messages
+
+A sensor_msgs/Image is serialized by the publisher, sent over TCP and deserialized and converted by every
+subscriber, even when both nodes run on the Pi. The FrameWriter instead copies each frame once into a ring
+buffer of slots in a file in /dev/shm, and publishes only a small FrameSlot message naming the slot. A reader on
+the same host maps the file and uses the slot as an image without copying it.
+
+Every slot starts with the sequence number of the frame it holds, which is 0 while the slot is being written.
+The writer reuses a slot after num_slots frames, so a reader only uses a slot while it still holds the
+announced sequence number, and a frame which was overwritten is dropped.
+
+The writer never truncates a file a reader may still have mapped, which would kill the reader with SIGBUS.
+Each writer builds its ring buffer in a file of its own and renames it into place, and numbers it with a
+generation which every FrameSlot message carries. A reader which still maps the ring buffer of a camera which
+has restarted keeps reading the old file safely, and maps the new one once the messages name a new generation.
+
+Nodes on other hosts cannot map the file, and a FrameSubscriber falls back to the image topic for them.
+"""
+
+import os
+import mmap
+import socket
+import threading
+import time
+import numpy as np
+import rospy
+from cv_bridge import CvBridge
+from sensor_msgs.msg import Image
+from pidrone_pkg.msg import FrameSlot
+
+SHM_DIR = '/dev/shm'
+DEFAULT_NAME = 'pidrone_frames'
+FRAME_SLOT_TOPIC = '/pidrone/picamera/frame_slot'
+IMAGE_TOPIC = '/pidrone/picamera/image_raw'
+NUM_SLOTS = 8
+
+MAGIC = 0x52464450  # 'PDFR'
+# the header holds the magic, width, height, channels, number of slots and generation
+HEADER_SIZE = 64
+# the slot header holds the sequence number
+SLOT_HEADER_SIZE = 8
+ALIGNMENT = 64
+
+
+def slot_size(width, height, channels):
+    """
+    :return: the bytes taken by a slot, rounded up so every slot starts aligned
+    """
+    size = SLOT_HEADER_SIZE + width * height * channels
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class FrameRing(object):
+    """
+    the ring buffer in a file in /dev/shm, mapped by the writer and by every reader
+
+    attributes:
+    generation: the generation of the ring buffer, which changes when the writer replaces it
+    sequences:  the sequence number of the frame in each slot, 0 while the slot is being written
+    frames:     num_slots x height x width x channels array of the frames
+    """
+
+    def __init__(self, path, writable):
+        """
+        :param path: the path of the file, which must already have its size
+        :param writable: True to map the file for writing
+        """
+        with open(path, 'r+b' if writable else 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+        magic, width, height, channels, num_slots, generation = np.frombuffer(self.map, dtype=np.uint32, count=6)
+        if magic != MAGIC:
+            raise ValueError('%s is not a frame ring buffer' % path)
+
+        self.width, self.height, self.channels, self.num_slots = int(width), int(height), int(channels), \
+            int(num_slots)
+        self.generation = int(generation)
+
+        stride = slot_size(self.width, self.height, self.channels)
+        self.sequences = np.ndarray((self.num_slots,), dtype=np.uint64, buffer=self.map, offset=HEADER_SIZE,
+                                    strides=(stride,))
+        self.frames = np.ndarray((self.num_slots, self.height, self.width, self.channels), dtype=np.uint8,
+                                 buffer=self.map, offset=HEADER_SIZE + SLOT_HEADER_SIZE,
+                                 strides=(stride, self.width * self.channels, self.channels, 1))
+
+    def close(self):
+        self.sequences = self.frames = None
+        self.map.close()
+
+
+class FrameWriter(object):
+    """
+    writes camera frames into a new ring buffer, and announces each frame with a FrameSlot message
+    """
+
+    def __init__(self, width, height, channels, name=DEFAULT_NAME, num_slots=NUM_SLOTS):
+        """
+        :param width, height, channels: the shape of the frames
+        :param name: the name of the file in /dev/shm
+        :param num_slots: the number of frames the buffer holds
+        """
+        self.name = name
+        self.path = os.path.join(SHM_DIR, name)
+        self.host = socket.gethostname()
+        # the time in ms, readers only compare it, so it may wrap around
+        self.generation = int(time.time() * 1000) & 0xffffffff
+
+        # readers of an earlier writer may still map the file at path, so the ring buffer is built in a new
+        # file and renamed over it, the old file lives on until the last reader unmaps it
+        new_path = '%s.%d' % (self.path, os.getpid())
+        header = np.zeros(HEADER_SIZE // 4, dtype=np.uint32)
+        header[:6] = MAGIC, width, height, channels, num_slots, self.generation
+        with open(new_path, 'wb') as f:
+            f.write(header.tostring())
+            f.truncate(HEADER_SIZE + num_slots * slot_size(width, height, channels))
+
+        self.ring = FrameRing(new_path, True)
+        self.inode = os.stat(new_path).st_ino
+        os.rename(new_path, self.path)
+        self.sequence = 0
+
+        self.slot_pub = rospy.Publisher(FRAME_SLOT_TOPIC, FrameSlot, queue_size=1)
+        self.msg = FrameSlot()
+        self.msg.host = self.host
+        self.msg.name = name
+        self.msg.generation = self.generation
+
+    def write(self, image, stamp):
+        """
+        copies a frame into the next slot and announces it
+
+        :param image: height x width x channels array, or the bytes of one
+        :param stamp: the rospy.Time the frame was captured
+        """
+        self.sequence += 1
+        slot = self.sequence % self.ring.num_slots
+
+        # readers reject the slot until it holds the whole new frame
+        self.ring.sequences[slot] = 0
+        self.ring.frames[slot] = np.frombuffer(image, dtype=np.uint8).reshape(self.ring.frames.shape[1:])
+        self.ring.sequences[slot] = self.sequence
+
+        self.msg.header.stamp = stamp
+        self.msg.slot = slot
+        self.msg.sequence = self.sequence
+        self.slot_pub.publish(self.msg)
+
+    def close(self):
+        self.ring.close()
+        # leave the file alone if a new writer has already replaced it
+        try:
+            if os.stat(self.path).st_ino == self.inode:
+                os.remove(self.path)
+        except OSError:
+            pass
+
+
+class FrameReader(object):
+    """
+    reads the frames a FrameWriter on this host announces
+    """
+
+    def __init__(self, name=DEFAULT_NAME):
+        """
+        :param name: the name of the file in /dev/shm
+        """
+        self.name = name
+        self.ring = FrameRing(os.path.join(SHM_DIR, name), False)
+        self.generation = self.ring.generation
+
+    def holds(self, msg):
+        """
+        :param msg: a FrameSlot message
+        :return: True if the frame msg announces is in this reader's ring buffer
+        """
+        return msg.name == self.name and msg.generation == self.generation
+
+    def read(self, msg):
+        """
+        :param msg: the FrameSlot message announcing the frame
+        :return: height x width (x channels) read-only view of the frame, None if it was already overwritten
+        """
+        if self.ring.sequences[msg.slot] != msg.sequence:
+            return None
+
+        frame = self.ring.frames[msg.slot]
+        return frame[..., 0] if self.ring.channels == 1 else frame
+
+    def intact(self, msg):
+        """
+        :param msg: the FrameSlot message of a frame returned by read
+        :return: True if the frame was not overwritten since, so everything computed from the view is valid
+        """
+        return self.ring.sequences[msg.slot] == msg.sequence
+
+    def close(self):
+        self.ring.close()
+
+
+class FrameSubscriber(object):
+    """
+    calls back with every camera frame, read from shared memory when the camera runs on this host and
+    converted from the image topic otherwise
+
+    the two topics are received on different threads, so the callback is only ever run by one of them at a
+    time, and no image is handed on once frames are read from shared memory
+
+    when the camera restarts it replaces the ring buffer, and the subscriber maps the new one
+
+    attributes:
+    local:   True once frames are read from shared memory
+    dropped: the number of frames which were overwritten before or while they were used
+    """
+
+    def __init__(self, callback):
+        """
+        :param callback: called with each image, which is only valid until the callback returns
+        """
+        self.callback = callback
+        self.host = socket.gethostname()
+        self.bridge = CvBridge()
+        self.reader = None
+        self.local = False
+        self.dropped = 0
+        # held while the callback runs and while the transport is chosen
+        self.lock = threading.Lock()
+
+        self.slot_sub = rospy.Subscriber(FRAME_SLOT_TOPIC, FrameSlot, self.slot_callback)
+        self.image_sub = rospy.Subscriber(IMAGE_TOPIC, Image, self.image_callback)
+
+    def slot_callback(self, msg):
+        with self.lock:
+            self.handle_slot(msg)
+
+    def handle_slot(self, msg):
+        if not self.local and msg.host != self.host:
+            # the camera runs on another host, its frames come over the image topic
+            self.slot_sub.unregister()
+            return
+
+        if self.reader is None or not self.reader.holds(msg):
+            self.open_reader(msg)
+            if self.reader is None or not self.reader.holds(msg):
+                # the message came from a writer which has been replaced since
+                self.dropped += 1
+                return
+
+        image = self.reader.read(msg)
+        if image is None:
+            self.dropped += 1
+            return
+
+        self.callback(image)
+
+        if not self.reader.intact(msg):
+            self.dropped += 1
+            rospy.logwarn('camera frame %d was overwritten while it was in use', msg.sequence)
+
+    def open_reader(self, msg):
+        """
+        maps the ring buffer msg names, the first time a frame is announced and after the camera restarted
+        """
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+        try:
+            self.reader = FrameReader(msg.name)
+        except (IOError, OSError, ValueError) as error:
+            if self.local:
+                rospy.logwarn('cannot map the camera frames: %s', error)
+            else:
+                rospy.logwarn('cannot map the camera frames, using %s: %s', IMAGE_TOPIC, error)
+                self.slot_sub.unregister()
+            return
+
+        if not self.local:
+            # stop receiving the same frames as images
+            self.local = True
+            self.image_sub.unregister()
+
+    def image_callback(self, msg):
+        if self.local:
+            return
+
+        image = self.bridge.imgmsg_to_cv2(msg, desired_encoding="passthrough")
+        with self.lock:
+            if not self.local:
+                self.callback(image)
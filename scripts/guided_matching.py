@@ -0,0 +1,109 @@
+"""
+guided_matching.py
+
+Matches the keypoints of two images using a prediction of the transform between them
+
+Each keypoint of the first image is only compared with the keypoints of the second image inside a square
+window around the position the predicted transform moves it to. The keypoints of the second image are
+bucketed into a grid of window sized cells, so the candidates of a keypoint are the keypoints of the 3 x 3
+cells around its predicted position, and the Hamming distances are only computed for those candidates.
+"""
+
+import numpy as np
+import hamming
+
+# half the side of the search window in pixels
+WINDOW = 16
+MATCH_RATIO = 0.7
+# the largest Hamming distance accepted for a match
+MAX_DISTANCE = 64
+# fewer guided matches than this means the prediction was off, and the caller should match without it
+MIN_MATCH_COUNT = 8
+CELL_KEY_STRIDE = 2 ** 20
+
+IDENTITY = np.float64([[1, 0, 0], [0, 1, 0]])
+
+
+def compose(second, first):
+    """
+    :param second, first: 2 x 3 affine transforms
+    :return: the 2 x 3 transform which applies first and then second
+    """
+    return np.dot(second[:, :2], first) + np.hstack((np.zeros((2, 2)), second[:, 2:]))
+
+
+def match(points1, des1, points2, des2, predicted, window=WINDOW, ratio=MATCH_RATIO, max_distance=MAX_DISTANCE):
+    """
+    finds the match of each keypoint of image 1 among the keypoints of image 2 inside its search window,
+    a match must pass the ratio test against the second best candidate in the window, if there is one
+
+    :param points1, des1: N x 2 keypoint coordinates and descriptors of image 1
+    :param points2, des2: M x 2 keypoint coordinates and descriptors of image 2
+    :param predicted: the predicted 2 x 3 transform from image 1 to image 2
+    :param window: half the side of the search window in pixels
+    :param ratio: the ratio test threshold
+    :param max_distance: the largest Hamming distance of a match
+    :return: arrays of the indices of the matched keypoints in image 1 and in image 2
+    """
+    points1 = np.asarray(points1, dtype=np.float64).reshape(-1, 2)
+    points2 = np.asarray(points2, dtype=np.float64).reshape(-1, 2)
+    if len(points1) == 0 or len(points2) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    predicted_points = np.dot(points1, predicted[:, :2].T) + predicted[:, 2]
+
+    # bucket the keypoints of image 2 into a grid of window sized cells
+    keys2 = cell_keys(np.floor(points2 / window).astype(np.int64))
+    order = np.argsort(keys2, kind='mergesort')
+    bucket_keys, starts = np.unique(keys2[order], return_index=True)
+    sizes = np.diff(np.append(starts, len(order)))
+
+    # gather the keypoints of the 3 x 3 cells around each predicted position as candidates
+    cells1 = np.floor(predicted_points / window).astype(np.int64)
+    queries, trains = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            keys = cell_keys(cells1 + (dx, dy))
+            buckets = np.minimum(np.searchsorted(bucket_keys, keys), len(bucket_keys) - 1)
+            query = np.flatnonzero(bucket_keys[buckets] == keys)
+            count = sizes[buckets[query]]
+
+            # the position of each candidate within its bucket
+            within = np.arange(np.sum(count)) - np.repeat(np.cumsum(count) - count, count)
+            queries.append(np.repeat(query, count))
+            trains.append(order[np.repeat(starts[buckets[query]], count) + within])
+
+    if sum(len(query) for query in queries) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    query, train = np.concatenate(queries), np.concatenate(trains)
+    inside = np.abs(points2[train] - predicted_points[query]).max(axis=1) <= window
+    query, train = query[inside], train[inside]
+    if len(query) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    distance = hamming.paired_distances(np.asarray(des1)[query], np.asarray(des2)[train])
+
+    # the best and second best candidate of each keypoint
+    order = np.lexsort((distance, query))
+    query, train, distance = query[order], train[order], distance[order]
+    best = np.flatnonzero(np.r_[True, query[1:] != query[:-1]])
+    after = np.minimum(best + 1, len(query) - 1)
+    has_second = (best + 1 < len(query)) & (query[after] == query[best])
+    second = np.where(has_second, distance[after], np.iinfo(np.int32).max)
+
+    good = best[(distance[best] <= max_distance) & (~has_second | (distance[best] < ratio * second))]
+    query, train, distance = query[good], train[good], distance[good]
+
+    # several keypoints may match one keypoint of image 2, keep the closest match only
+    order = np.lexsort((distance, train))
+    first = order[np.r_[True, train[order][1:] != train[order][:-1]]] if len(order) else order
+    return query[first], train[first]
+
+
+def cell_keys(cells):
+    """
+    :param cells: N x 2 array of grid cells
+    :return: a single integer key for each cell
+    """
+    return cells[:, 0] * CELL_KEY_STRIDE + cells[:, 1]
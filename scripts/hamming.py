@@ -0,0 +1,30 @@
+"""
+hamming.py
+
+Hamming distances between binary descriptors with numpy, using a lookup table of the number of set bits in
+each byte value
+"""
+
+import numpy as np
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def distances(a, b):
+    """
+    :param a: N x D array of uint8 descriptors
+    :param b: M x D array of uint8 descriptors
+    :return: N x M array of the Hamming distance between every descriptor of a and every descriptor of b
+    """
+    a = np.asarray(a, dtype=np.uint8)
+    b = np.asarray(b, dtype=np.uint8)
+    return POPCOUNT[a[:, np.newaxis, :] ^ b[np.newaxis, :, :]].sum(axis=2, dtype=np.int32)
+
+
+def paired_distances(a, b):
+    """
+    :param a: ... x D array of uint8 descriptors
+    :param b: array of uint8 descriptors broadcastable against a
+    :return: the Hamming distance between each pair of descriptors of a and b
+    """
+    return POPCOUNT[np.bitwise_xor(a, b)].sum(axis=-1, dtype=np.int32)
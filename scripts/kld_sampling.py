@@ -0,0 +1,100 @@
+"""
+kld_sampling.py
+
+Adapts the number of particles to the uncertainty of the belief with KLD-sampling (Fox, 2003)
+
+The poses are divided into bins of x, y and yaw. Particles are drawn from the weights until there are enough
+of them for the error between the sampled and the true belief, measured by the Kullback-Leibler divergence, to
+stay below EPSILON with probability 0.99, given how many bins hold a particle. A belief concentrated in a few
+bins needs few particles, and one spread over many bins needs many, always within the given bounds.
+"""
+
+from __future__ import division
+import numpy as np
+import resampling
+
+# the size of a bin of x and y in meters and of yaw in radians
+BIN_SIZE = (0.05, 0.05, 0.1)
+# the largest accepted KL divergence between the sampled and the true belief
+EPSILON = 0.25
+# the upper 0.99 quantile of the standard normal distribution
+Z_QUANTILE = 2.326
+# the particle set keeps its size while the new size is within this fraction of it and the weights have
+# not degenerated, so the set is not resampled on every frame only to change its size by a particle or two
+TOLERANCE = 0.2
+
+
+def kld_bound(k, epsilon=EPSILON, z=Z_QUANTILE):
+    """
+    :param k: the number of occupied bins, an integer or an array of them
+    :param epsilon: the largest accepted KL divergence
+    :param z: the upper quantile of the standard normal distribution for the wanted probability
+    :return: the number of particles needed for k occupied bins, from the Wilson-Hilferty approximation of the
+             chi-square quantile, a single bin needs no more than the minimum number of particles
+    """
+    k = np.asarray(k, dtype=np.float64)
+    a = 2 / (9 * np.maximum(k - 1, 1))
+    return np.where(k > 1, (k - 1) / (2 * epsilon) * (1 - a + np.sqrt(a) * z) ** 3, 0)
+
+
+def bin_keys(poses, bin_size=BIN_SIZE):
+    """
+    :param poses: N x 4 array of poses (x, y, z, yaw)
+    :param bin_size: the size of a bin of x, y and yaw
+    :return: a single integer key for the bin of each pose
+    """
+    bins = np.floor(poses[:, [0, 1, 3]] / np.asarray(bin_size)).astype(np.int64)
+    bins -= bins.min(axis=0)
+    extent = bins.max(axis=0) + 1
+
+    return (bins[:, 0] * extent[1] + bins[:, 1]) * extent[2] + bins[:, 2]
+
+
+def sample(weights, poses, min_particles, max_particles, bin_size=BIN_SIZE, epsilon=EPSILON, z=Z_QUANTILE):
+    """
+    draws particles one by one until their number reaches the KLD bound of the bins they occupy
+
+    :param weights: the normalized weights of the particles
+    :param poses: N x 4 array of the poses of the particles
+    :param min_particles, max_particles: the bounds of the number of particles to draw
+    :return: the sorted array of the indices of the drawn particles
+    """
+    # a low variance sample of the largest size, in random order so any prefix of it is a sample too
+    drawn = resampling.systematic(weights, max_particles)
+    np.random.shuffle(drawn)
+
+    # the number of distinct bins among the first n drawn particles, for every n
+    _, first = np.unique(bin_keys(poses[drawn], bin_size), return_index=True)
+    new_bin = np.zeros(max_particles, dtype=bool)
+    new_bin[first] = True
+    occupied = np.cumsum(new_bin)
+
+    count = np.arange(1, max_particles + 1)
+    enough = np.flatnonzero((count >= kld_bound(occupied, epsilon, z)) & (count >= min_particles))
+    num_particles = enough[0] + 1 if len(enough) != 0 else max_particles
+
+    return np.sort(drawn[:num_particles])
+
+
+def resample(weights, poses, min_particles, max_particles, threshold=resampling.ESS_THRESHOLD,
+             tolerance=TOLERANCE):
+    """
+    resamples the particles if their effective sample size is too low, or if the belief needs a number of
+    particles far enough from the current one
+
+    :param weights: the normalized weights of the particles
+    :param poses: N x 4 array of the poses of the particles
+    :param min_particles, max_particles: the bounds of the number of particles
+    :param threshold: see resampling.needs_resampling
+    :param tolerance: see TOLERANCE
+    :return: the indices of the new particles, or None if resampling was skipped
+    """
+    indices = sample(weights, poses, min_particles, max_particles)
+
+    num_particles = len(weights)
+    resize = abs(len(indices) - num_particles) > tolerance * num_particles \
+        or not min_particles <= num_particles <= max_particles
+    if not resize and not resampling.needs_resampling(weights, threshold):
+        return None
+
+    return indices
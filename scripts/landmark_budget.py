@@ -0,0 +1,87 @@
+"""
+landmark_budget.py
+
+Keeps the landmark maps of FastSLAM bounded
+
+A keypoint which fails the ratio test against the landmark it came from becomes a second landmark at almost
+the same place with almost the same descriptor. Such duplicates are merged into the landmark they duplicate
+instead of being added. Once a particle holds more landmarks than its budget, the landmarks worth the least
+are evicted: those seen the fewest times, and among those the ones with the largest covariance.
+"""
+
+import numpy as np
+import hamming
+
+# the most landmarks a particle keeps
+MAX_LANDMARKS = 1500
+# a particle over its budget evicts down to this share of it, so eviction copies shared blocks less often
+EVICT_TO = 0.9
+# a new landmark within this many meters and this Hamming distance of a landmark is a duplicate of it
+MERGE_RADIUS = 0.01
+MERGE_DISTANCE = 40
+
+
+def find_duplicates(new_pos, new_des, pos, des, radius=MERGE_RADIUS, max_distance=MERGE_DISTANCE):
+    """
+    pairs each new landmark with at most one landmark it duplicates, each landmark takes at most one new
+    landmark, and the pairs with the closest descriptors are taken first
+
+    :param new_pos, new_des: the positions and descriptors of the new landmarks
+    :param pos, des: the positions and descriptors of the landmarks already in the map
+    :param radius: the largest distance between duplicates in meters
+    :param max_distance: the largest Hamming distance between the descriptors of duplicates
+    :return: arrays of the indices of the duplicates among the new landmarks and among the landmarks
+    """
+    empty = np.empty(0, dtype=np.int64)
+    if len(new_pos) == 0 or len(pos) == 0:
+        return empty, empty
+
+    offset = np.asarray(new_pos)[:, np.newaxis, :] - np.asarray(pos)[np.newaxis, :, :]
+    new, old = np.nonzero(np.hypot(offset[..., 0], offset[..., 1]) <= radius)
+    distance = hamming.paired_distances(np.asarray(new_des)[new], np.asarray(des)[old])
+
+    close = distance <= max_distance
+    new, old, distance = new[close], old[close], distance[close]
+
+    # greedily take the closest pairs whose landmarks are both still unpaired
+    pairs_new, pairs_old = [], []
+    taken_new, taken_old = set(), set()
+    for k in np.argsort(distance, kind='mergesort'):
+        if new[k] not in taken_new and old[k] not in taken_old:
+            taken_new.add(new[k])
+            taken_old.add(old[k])
+            pairs_new.append(new[k])
+            pairs_old.append(old[k])
+
+    return np.array(pairs_new, dtype=np.int64), np.array(pairs_old, dtype=np.int64)
+
+
+def fuse(pos1, cov1, pos2, cov2):
+    """
+    combines two estimates of the same landmarks, weighting each by its information (inverse covariance)
+
+    :param pos1, cov1: N x 2 positions and N x 2 x 2 covariances of the first estimates
+    :param pos2, cov2: N x 2 positions and N x 2 x 2 covariances of the second estimates
+    :return: the fused positions and covariances
+    """
+    info1, info2 = np.linalg.inv(cov1), np.linalg.inv(cov2)
+    cov = np.linalg.inv(info1 + info2)
+    pos = np.einsum('nij,nj->ni', cov, np.einsum('nij,nj->ni', info1, pos1) + np.einsum('nij,nj->ni', info2, pos2))
+
+    return pos, cov
+
+
+def evictions(counter, cov, budget, evict_to=EVICT_TO):
+    """
+    :param counter: the observation counter of each landmark
+    :param cov: N x 2 x 2 array of the covariance of each landmark
+    :param budget: the most landmarks to keep
+    :param evict_to: the share of the budget to keep once the budget is exceeded
+    :return: the indices of the landmarks to evict, none while the budget is kept
+    """
+    if len(counter) <= budget:
+        return np.empty(0, dtype=np.int64)
+
+    # fewest observations first, and among equally observed landmarks the most uncertain first
+    order = np.lexsort((-np.trace(cov, axis1=1, axis2=2), counter))
+    return order[:len(counter) - int(budget * evict_to)]
@@ -0,0 +1,333 @@
+"""
+landmark_map.py
+
+Copy-on-write landmark maps for FastSLAM
+
+The landmarks of every particle live in fixed size blocks inside one shared pool, and a particle's map is
+just a row of block ids. Resampling copies rows and bumps reference counts, so the children of a particle
+share its blocks, and a block is only copied once a particle writes to a landmark in a shared block.
+
+Every block belongs to one cell of a uniform grid and only holds landmarks inside that cell, so the blocks
+double as a spatial hash: a range query only looks at the landmarks of blocks in the cells around the query.
+"""
+
+import math
+import numpy as np
+
+BLOCK_SIZE = 16
+DES_SIZE = 32
+INITIAL_BLOCKS = 128
+INITIAL_ROW_LENGTH = 16
+# side of a grid cell in meters, about the perceptual range of the camera at flying height
+CELL_SIZE = 0.2
+CELL_KEY_STRIDE = 2 ** 31
+
+
+class LandmarkPool(object):
+    """
+    holds the landmarks of every map which shares this pool, grouped into blocks of BLOCK_SIZE landmarks
+    a landmark is addressed by its id: block * BLOCK_SIZE + slot
+
+    attributes:
+    pos:        the (x, y) position of each landmark
+    cov:        the 2x2 covariance of each landmark
+    des:        the feature descriptor of each landmark
+    counter:    the number of times each landmark has been seen
+    used:       mask of the slots which currently hold a landmark
+    refcount:   the number of particle maps referencing each block
+    block_cell: the grid cell (x, y) holding the landmarks of each block
+    """
+
+    def __init__(self, num_blocks=INITIAL_BLOCKS, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+
+        size = num_blocks * BLOCK_SIZE
+        self.pos = np.zeros((size, 2))
+        self.cov = np.zeros((size, 2, 2))
+        self.des = np.zeros((size, DES_SIZE), dtype=np.uint8)
+        self.counter = np.zeros(size, dtype=np.int32)
+        self.used = np.zeros(size, dtype=bool)
+        self.refcount = np.zeros(num_blocks, dtype=np.int32)
+        self.block_cell = np.zeros((num_blocks, 2), dtype=np.int64)
+
+        self.free_blocks = range(num_blocks - 1, -1, -1)
+
+    def num_blocks(self):
+        return len(self.refcount)
+
+    def grow(self, num_blocks):
+        """
+        enlarges the pool to hold num_blocks blocks
+
+        :param num_blocks: the new number of blocks
+        """
+        old_blocks = self.num_blocks()
+        extra = (num_blocks - old_blocks) * BLOCK_SIZE
+        if extra <= 0:
+            return
+
+        self.pos = np.concatenate((self.pos, np.zeros((extra, 2))))
+        self.cov = np.concatenate((self.cov, np.zeros((extra, 2, 2))))
+        self.des = np.concatenate((self.des, np.zeros((extra, DES_SIZE), dtype=np.uint8)))
+        self.counter = np.concatenate((self.counter, np.zeros(extra, dtype=np.int32)))
+        self.used = np.concatenate((self.used, np.zeros(extra, dtype=bool)))
+        new_blocks = num_blocks - old_blocks
+        self.refcount = np.concatenate((self.refcount, np.zeros(new_blocks, dtype=np.int32)))
+        self.block_cell = np.concatenate((self.block_cell, np.zeros((new_blocks, 2), dtype=np.int64)))
+
+        self.free_blocks = range(num_blocks - 1, old_blocks - 1, -1) + self.free_blocks
+
+    def cells(self, pos):
+        """
+        :param pos: N x 2 array of positions
+        :return: N x 2 array of the grid cells holding pos
+        """
+        return np.floor(np.asarray(pos) / self.cell_size).astype(np.int64)
+
+    def allocate(self, cell=(0, 0)):
+        """
+        :param cell: the grid cell the block will hold landmarks of
+        :return: the id of an empty block with a single reference
+        """
+        if len(self.free_blocks) == 0:
+            self.grow(2 * self.num_blocks())
+
+        block = self.free_blocks.pop()
+        self.refcount[block] = 1
+        self.block_cell[block] = cell
+        self.used[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE] = False
+
+        return block
+
+    def clone(self, block):
+        """
+        copies a shared block into a new block, moving one reference from the old block to the new one
+
+        :param block: the id of the block to copy
+        :return: the id of the copy
+        """
+        new_block = self.allocate(self.block_cell[block])
+
+        src = slice(block * BLOCK_SIZE, (block + 1) * BLOCK_SIZE)
+        dst = slice(new_block * BLOCK_SIZE, (new_block + 1) * BLOCK_SIZE)
+        for array in (self.pos, self.cov, self.des, self.counter, self.used):
+            array[dst] = array[src]
+
+        self.refcount[block] -= 1
+
+        return new_block
+
+    def incref(self, blocks):
+        np.add.at(self.refcount, blocks, 1)
+
+    def decref(self, blocks):
+        """
+        drops one reference from each of blocks, blocks which are no longer referenced are freed
+        """
+        np.subtract.at(self.refcount, blocks, 1)
+        unique = np.unique(blocks)
+        self.free_blocks.extend(unique[self.refcount[unique] == 0].tolist())
+
+
+class LandmarkMap(object):
+    """
+    the landmark maps of a set of particles, row i of table holds the ids of the blocks of particle i's map
+    and -1 marks an empty entry
+
+    every write to a landmark must go through writable first, so shared blocks are copied before they change
+    """
+
+    def __init__(self, num_particles, pool=None, table=None):
+        self.pool = pool if pool is not None else LandmarkPool()
+        if table is None:
+            table = np.full((num_particles, INITIAL_ROW_LENGTH), -1, dtype=np.int32)
+        self.table = table
+
+    def blocks(self, i):
+        """
+        :param i: the index of the particle
+        :return: the ids of the blocks in particle i's map
+        """
+        row = self.table[i]
+        return row[row >= 0]
+
+    def landmarks(self, i):
+        """
+        :param i: the index of the particle
+        :return: the ids of the landmarks in particle i's map
+        """
+        ids = block_ids(self.blocks(i))
+        return ids[self.pool.used[ids]]
+
+    def near(self, i, x, y, radius):
+        """
+        finds the landmarks of particle i which may lie within radius of (x, y), the result holds every
+        landmark in range and some landmarks in the surrounding grid cells which are slightly out of range
+
+        :param i: the index of the particle
+        :param x, y: the center of the query
+        :param radius: the range of the query
+        :return: the ids of the candidate landmarks
+        """
+        blocks = self.blocks(i)
+        center = self.pool.cells([[x, y]])[0]
+        reach = int(math.ceil(radius / self.pool.cell_size))
+
+        offset = np.abs(self.pool.block_cell[blocks] - center).max(axis=1)
+        ids = block_ids(blocks[offset <= reach])
+        return ids[self.pool.used[ids]]
+
+    def num_landmarks(self):
+        """
+        :return: the number of landmarks in each particle's map
+        """
+        per_block = self.pool.used.reshape(-1, BLOCK_SIZE).sum(axis=1)
+        valid = self.table >= 0
+        return np.where(valid, per_block[np.where(valid, self.table, 0)], 0).sum(axis=1)
+
+    def writable(self, i, ids):
+        """
+        copies the blocks holding ids which particle i shares with other maps
+
+        :param i: the index of the particle
+        :param ids: the ids of the landmarks particle i is about to change
+        :return: the ids of the same landmarks in blocks owned by particle i alone
+        """
+        blocks = ids // BLOCK_SIZE
+        unique = np.unique(blocks)
+        shared = unique[self.pool.refcount[unique] > 1]
+        if len(shared) == 0:
+            return ids
+
+        row = self.table[i]
+        new_blocks = blocks.copy()
+        for block in shared:
+            new_block = self.pool.clone(block)
+            row[row == block] = new_block
+            new_blocks[blocks == block] = new_block
+
+        return new_blocks * BLOCK_SIZE + ids % BLOCK_SIZE
+
+    def add(self, i, pos, cov, des, counter=1):
+        """
+        stores new landmarks in free slots of blocks owned by particle i which cover the landmarks' grid
+        cells, allocating blocks as needed
+
+        :param i: the index of the particle
+        :param pos, cov, des: the positions, covariances and descriptors of the new landmarks
+        :param counter: the initial counter of the new landmarks
+        :return: the ids of the new landmarks
+        """
+        cells = self.pool.cells(pos)
+        keys = cell_keys(cells)
+        ids = np.empty(len(keys), dtype=np.int64)
+
+        blocks = self.blocks(i)
+        owned = blocks[self.pool.refcount[blocks] == 1]
+        owned_keys = cell_keys(self.pool.block_cell[owned])
+
+        for key in np.unique(keys):
+            members = np.flatnonzero(keys == key)
+            free = block_ids(owned[owned_keys == key])
+            free = free[~self.pool.used[free]]
+
+            while len(free) < len(members):
+                block = self.pool.allocate(cells[members[0]])
+                self.append_block(i, block)
+                free = np.concatenate((free, block_ids([block])))
+
+            ids[members] = free[:len(members)]
+
+        self.pool.pos[ids] = pos
+        self.pool.cov[ids] = cov
+        self.pool.des[ids] = des
+        self.pool.counter[ids] = counter
+        self.pool.used[ids] = True
+
+        return ids
+
+    def relocate(self, i, ids):
+        """
+        moves landmarks whose position has left the grid cell of their block into a block of their new cell
+
+        :param i: the index of the particle
+        :param ids: the ids of landmarks which particle i does not share with other particles
+        """
+        moved = ids[np.any(self.pool.cells(self.pool.pos[ids]) != self.pool.block_cell[ids // BLOCK_SIZE], axis=1)]
+        if len(moved) == 0:
+            return
+
+        pos, cov = self.pool.pos[moved], self.pool.cov[moved]
+        des, counter = self.pool.des[moved], self.pool.counter[moved]
+        self.remove(i, moved)
+        self.add(i, pos, cov, des, counter)
+
+    def remove(self, i, ids):
+        """
+        removes landmarks from particle i's map, blocks which become empty are dropped from the map
+
+        :param i: the index of the particle
+        :param ids: the ids of the landmarks to remove
+        """
+        if len(ids) == 0:
+            return
+
+        ids = self.writable(i, ids)
+        self.pool.used[ids] = False
+
+        blocks = np.unique(ids // BLOCK_SIZE)
+        empty = blocks[~self.pool.used.reshape(-1, BLOCK_SIZE)[blocks].any(axis=1)]
+        if len(empty) != 0:
+            row = self.table[i]
+            row[np.in1d(row, empty)] = -1
+            self.pool.decref(empty)
+
+    def append_block(self, i, block):
+        """
+        adds a block to particle i's row, widening the table if the row is full
+        """
+        empty = np.flatnonzero(self.table[i] < 0)
+        if len(empty) == 0:
+            width = self.table.shape[1]
+            self.table = np.concatenate((self.table, np.full((len(self.table), width), -1, dtype=np.int32)),
+                                        axis=1)
+            empty = [width]
+
+        self.table[i, empty[0]] = block
+
+    def select(self, indices):
+        """
+        builds the maps of a resampled particle set, the new maps share every block with this one
+
+        :param indices: an array of particle indices, particles may be repeated
+        :return: a new LandmarkMap using the same pool
+        """
+        table = self.table[indices]
+        self.pool.incref(table[table >= 0])
+
+        return LandmarkMap(len(indices), self.pool, table)
+
+    def release(self):
+        """
+        drops this map's references to its blocks, the map must not be used afterwards
+        """
+        self.pool.decref(self.table[self.table >= 0])
+        self.table = np.full((len(self.table), 0), -1, dtype=np.int32)
+
+
+def cell_keys(cells):
+    """
+    :param cells: N x 2 array of grid cells
+    :return: a single integer key for each cell
+    """
+    cells = np.asarray(cells, dtype=np.int64).reshape(-1, 2)
+    return cells[:, 0] * CELL_KEY_STRIDE + cells[:, 1]
+
+
+def block_ids(blocks):
+    """
+    :param blocks: an array of block ids
+    :return: the ids of every landmark slot in blocks
+    """
+    blocks = np.asarray(blocks, dtype=np.int64)
+    return (blocks[:, np.newaxis] * BLOCK_SIZE + np.arange(BLOCK_SIZE)).ravel()
@@ -5,9 +5,18 @@ global_position_estimator_distance
 Implements Monte-Carlo Localization for the PiDrone
 """""
 
+import os
 import math
 import numpy as np
 import cv2
+import resampling
+import kld_sampling
+from matcher_pool import MatcherPool
+from matchers import create_matcher
+import bow_index
+from relocalization import Relocalizer
+import feature_map
+import guided_matching
 
 
 # ---------- map parameters ----------- #
@@ -41,6 +50,10 @@ CELL_X = float(MAP_PIXEL_WIDTH) / MAP_GRID_SIZE_X
 CELL_Y = float(MAP_PIXEL_HEIGHT) / MAP_GRID_SIZE_Y
 PROB_THRESHOLD = 0.001
 MAP_FEATURES = 600
+# the number of most similar map cells initialize_particles tries to match
+RELOCALIZATION_CANDIDATES = 8
+# the compiled map is stored next to the map image with this extension
+MAP_EXTENSION = '.fmap'
 # -------------------------- #
 
 
@@ -89,17 +102,32 @@ class LocalizationParticleFilter:
         self.map_kp = map_kp
         self.map_des = map_des
 
+        # ranks the map cells by similarity to an image for relocalization
+        self.cells = [(x, y) for x in range(MAP_GRID_SIZE_X) for y in range(MAP_GRID_SIZE_Y)]
+        self.relocalization_index = bow_index.build_index(self.cells, [map_des[x][y] for x, y in self.cells])
+        # verifies the candidate cells in parallel, started on the first relocalization
+        self.relocalizer = None
+
         self.particles = None
+        # the bounds of the number of particles, which follows the uncertainty of the belief
+        self.min_particles = None
+        self.max_particles = None
         self.measure_count = 0
 
-        index_params = dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1)
-        search_params = dict(checks=50)
-        self.matcher = cv2.FlannBasedMatcher(index_params, search_params)
+        self.matcher = create_matcher()
+        # one matcher trained on each map cell, so matching against a cell only runs the query
+        self.matcher_pool = MatcherPool()
+        self.matcher_pool.fill((cell, map_des[cell[0]][cell[1]]) for cell in self.cells)
 
         self.previous_time = None
 
-        self.key_kp = None
-        self.key_des = None
+        # the Frame of the most recent keyframe
+        self.key_frame = None
+
+        # the transforms from the previous frame and from the keyframe to the most recent frame, used to
+        # predict where the keypoints of the next frame are
+        self.frame_transform = None
+        self.key_transform = None
 
         self.z = 0.0
         self.angle_x = 0.0
@@ -118,18 +146,19 @@ class LocalizationParticleFilter:
                                            [0, 0, sigma_vz ** 2, 0],
                                            [0, 0, 0, sigma_yaw ** 2]])
 
-    def update(self, z, angle_x, angle_y, prev_kp, prev_des, kp, des):
+    def update(self, z, angle_x, angle_y, prev_frame, frame):
         """
         We implement the MCL algorithm from probabilistic robotics (Table 8.2)
-        kp is the position of detected features
-        des is the description of detected features
+        prev_frame is the Frame of the previous image
+        frame is the Frame of the current image, holding its detected features
         """
         # update parameters
         self.z = z
         self.angle_x = angle_x
         self.angle_y = angle_y
 
-        transform = self.compute_transform(prev_kp, prev_des, kp, des)
+        transform = self.compute_transform(prev_frame, frame, self.frame_transform)
+        self.frame_transform = transform
 
         if transform is not None:
             x = self.pixel_to_meter(-transform[0, 2])
@@ -140,9 +169,14 @@ class LocalizationParticleFilter:
             self.sample_motion_model(x, y, yaw)
 
             # if there is some previous keyframe
-            if self.key_kp is not None and self.key_des is not None:
+            if self.key_frame is not None:
+
+                predicted = None
+                if self.key_transform is not None:
+                    predicted = guided_matching.compose(self.frame_transform, self.key_transform)
 
-                transform = self.compute_transform(self.key_kp, self.key_des, kp, des)
+                transform = self.compute_transform(self.key_frame, frame, predicted)
+                self.key_transform = transform
 
                 if transform is not None:
                     # distance since previous keyframe in PIXELS
@@ -152,17 +186,20 @@ class LocalizationParticleFilter:
 
                     # if we've moved an entire camera frame distance since the last keyframe (or yawed 10 degrees)
                     if distance(x, y, 0, 0) > KEYFRAME_DIST_THRESHOLD or yaw > KEYFRAME_YAW_THRESHOLD:
-                        self.measurement_model(kp, des)
-                        self.key_kp, self.key_des = kp, des
+                        self.measurement_model(frame)
+                        self.key_frame = frame
+                        self.key_transform = guided_matching.IDENTITY
                 else:
                     # moved too far to transform from last keyframe, so set a new one
-                    self.measurement_model(kp, des)
-                    self.key_kp, self.key_des = kp, des
+                    self.measurement_model(frame)
+                    self.key_frame = frame
+                    self.key_transform = guided_matching.IDENTITY
 
             # there is no previous keyframe
             else:
-                self.measurement_model(kp, des)
-                self.key_kp, self.key_des = kp, des
+                self.measurement_model(frame)
+                self.key_frame = frame
+                self.key_transform = guided_matching.IDENTITY
 
         self.resample_particles()
         return self.get_estimated_position()
@@ -170,23 +207,27 @@ class LocalizationParticleFilter:
     def sample_motion_model(self, x, y, yaw):
         """
         Implement motion model from Equation 3 in PiDrone Slam with noise.
+        Every particle gets its own noise, and all particles are moved at once.
         """
         # add noise
-        noisy_x_y_z_yaw = np.random.multivariate_normal([x, y, self.z, yaw], self.covariance_motion)
+        noisy_x_y_z_yaw = np.random.multivariate_normal([x, y, self.z, yaw], self.covariance_motion,
+                                                        self.particles.num_particles)
 
-        for i in range(self.particles.num_particles):
-            pose = self.particles.poses[i]
-            old_yaw = pose[3]
-            pose[0] += (noisy_x_y_z_yaw[0] * np.cos(old_yaw) + noisy_x_y_z_yaw[1] * np.sin(old_yaw))
-            pose[1] += (noisy_x_y_z_yaw[0] * np.sin(old_yaw) + noisy_x_y_z_yaw[1] * np.cos(old_yaw))
-            pose[2] = self.z
-            pose[3] += noisy_x_y_z_yaw[3]
-            pose[3] = adjust_angle(pose[3])
-
-    def measurement_model(self, kp, des):
+        poses = self.particles.poses
+        old_yaw = poses[:, 3].copy()
+        poses[:, 0] += (noisy_x_y_z_yaw[:, 0] * np.cos(old_yaw) + noisy_x_y_z_yaw[:, 1] * np.sin(old_yaw))
+        poses[:, 1] += (noisy_x_y_z_yaw[:, 0] * np.sin(old_yaw) + noisy_x_y_z_yaw[:, 1] * np.cos(old_yaw))
+        poses[:, 2] = self.z
+        poses[:, 3] = adjust_angle(old_yaw + noisy_x_y_z_yaw[:, 3])
+
+    def measurement_model(self, frame):
         """
         landmark_model_known_correspondence from probablistic robotics 6.6
+        particles in the same grid cell match the same part of the map, so each occupied cell is
+        matched once per frame and its result is shared by the particles in it
         """
+        locations = {}
+
         for i in range(self.particles.num_particles):
             position = self.particles.poses[i]
 
@@ -195,12 +236,13 @@ class LocalizationParticleFilter:
             grid_x = max(min(grid_x, MAP_GRID_SIZE_X - 1), 0)
             grid_y = int(position[1] * METER_TO_PIXEL / CELL_Y)
             grid_y = max(min(grid_y, MAP_GRID_SIZE_Y - 1), 0)
-            # get 8 map cells around pose
-            sub_map_kp = self.map_kp[grid_x][grid_y]
-            sub_map_des = self.map_des[grid_x][grid_y]
 
-            # measure current global position
-            pose, num = self.compute_location(kp, des, sub_map_kp, sub_map_des)
+            # measure current global position against the 8 map cells around pose
+            if (grid_x, grid_y) not in locations:
+                sub_map_kp = self.map_kp[grid_x][grid_y]
+                sub_map_des = self.map_des[grid_x][grid_y]
+                locations[(grid_x, grid_y)] = self.compute_location(frame, sub_map_kp, sub_map_des, (grid_x, grid_y))
+            pose, num = locations[(grid_x, grid_y)]
 
             # compute weight of particle
             if pose is None:
@@ -226,22 +268,30 @@ class LocalizationParticleFilter:
     def resample_particles(self):
         """""
         samples a new particle set, biased towards particles with higher weights
+        uses low variance resampling, and keeps the particles while their weights have not degenerated
+        the number of particles is chosen with KLD-sampling, growing to the maximum when the filter is lost
         """""
-        weights_sum = np.sum(self.particles.weights)
-        new_poses = []
-        new_weights = []
-
-        normal_weights = self.particles.weights / float(weights_sum)  # normalize
-        # samples sums to num_particles with same length as normal_weights, positions with higher weights are
-        # more likely to be sampled
-        samples = np.random.multinomial(self.particles.num_particles, normal_weights)
-        for i, count in enumerate(samples):
-            for _ in range(count):
-                new_poses.append(self.particles.poses[i])
-                new_weights.append(self.particles.weights[i])
-
-        self.particles.poses = np.array(new_poses)
-        self.particles.weights = np.array(new_weights)
+        normal_weights = self.particles.weights / float(np.sum(self.particles.weights))  # normalize
+        if not self.is_lost():
+            indices = kld_sampling.resample(normal_weights, self.particles.poses, self.min_particles,
+                                            self.max_particles)
+        elif self.particles.num_particles != self.max_particles:
+            indices = resampling.systematic(normal_weights, self.max_particles)
+        else:
+            indices = resampling.resample(normal_weights)
+
+        if indices is None:
+            return
+
+        weights = self.particles.weights[indices]
+        self.particles = ParticleSet(len(indices), self.particles.poses[indices])
+        self.particles.weights[:] = weights
+
+    def is_lost(self):
+        """""
+        :return: True if no particle is close to a pose measured against the map
+        """""
+        return np.all(self.particles.weights <= PROB_THRESHOLD)
 
     def get_estimated_position(self):
         """""
@@ -262,27 +312,37 @@ class LocalizationParticleFilter:
 
         return Particle(0, np.array([[x, y, z, yaw]]), np.array([weights_sum / self.particles.weights.size]))
 
-    def initialize_particles(self, num_particles, kp, des):
+    def initialize_particles(self, num_particles, frame, min_particles=None):
         """
         find most possible location to start
-        :param num_particles: number of particles we are using
-        :param kp: the keyPoints of the first captured image
-        :param des: the descriptions of the first captured image
+        :param num_particles: number of particles we are using, and the most the filter will use
+        :param frame: the Frame of the first captured image
+        :param min_particles: the fewest particles the filter will use, by default the number stays fixed
         """
-        self.key_kp, self.key_des = None, None
+        self.max_particles = num_particles
+        self.min_particles = min_particles if min_particles is not None else num_particles
+        self.key_frame = None
+        self.frame_transform, self.key_transform = None, None
         weights_sum = 0.0
         weights = []
         poses = []
-        new_poses = []
 
-        # go through every grid, trying to find matched features
-        for x in range(MAP_GRID_SIZE_X):
-            for y in range(MAP_GRID_SIZE_Y):
-                p, w = self.compute_location(kp, des, self.map_kp[x][y], self.map_des[x][y])
-                if p is not None:
-                    poses.append([p[0], p[1], p[2], p[3]])
-                    weights.append(w)
-                    weights_sum += w
+        # rank the grids by how similar their features are to the image, and only try to match the best ones
+        candidates = []
+        if self.relocalization_index is not None:
+            candidates = self.relocalization_index.query(frame.des, RELOCALIZATION_CANDIDATES)
+
+        if self.relocalizer is None:
+            self.relocalizer = Relocalizer(self.cells, [self.map_kp[x][y] for x, y in self.cells],
+                                           [self.map_des[x][y] for x, y in self.cells], locate)
+
+        # match the candidates on all cores, returning early once enough of them match well
+        attitude = (self.z, self.angle_x, self.angle_y)
+        hypotheses = self.relocalizer.verify(candidates, frame.points, frame.des, attitude)
+        for _, p, w in hypotheses:
+            poses.append([p[0], p[1], p[2], p[3]])
+            weights.append(w)
+            weights_sum += w
 
         # cannot find a match
         if len(poses) == 0:
@@ -298,73 +358,45 @@ class LocalizationParticleFilter:
 
         # sample particles based on the number of matched features
         weights = np.array(weights) / weights_sum  # normalize
-        samples = np.random.multinomial(num_particles, weights)  # sample
-        for i, count in enumerate(samples):
-            for _ in range(count):
-                new_poses.append(poses[i])
+        indices = resampling.systematic(weights, num_particles)  # sample
 
-        self.particles = ParticleSet(num_particles, np.array(new_poses))
+        self.particles = ParticleSet(num_particles, np.array(poses)[indices])
         return self.get_estimated_position()
 
-    def compute_location(self, kp1, des1, kp2, des2):
+    def compute_location(self, frame, kp2, des2, cell=None):
         """
         compute the global location of center of current image
-        :param kp1: captured keyPoints
-        :param des1: captured descriptions
-        :param kp2: map keyPoints
+        :param frame: the Frame of the captured image
+        :param kp2: map keyPoint coordinates, N x 2
         :param des2: map descriptions
+        :param cell: the key of the map cell kp2 and des2 belong to, to match with the cell's trained matcher
         :return: global pose
         """
 
-        good = []
-        pose = None
-
-        if des1 is not None and des2 is not None:
-            matches = self.matcher.knnMatch(des1, des2, k=2)
-
-            for match in matches:
-                if len(match) > 1 and match[0].distance < MATCH_RATIO * match[1].distance:
-                    good.append(match[0])
-
-            if len(good) > MIN_MATCH_COUNT:
-                src_pts = np.float32([kp1[m.queryIdx].pt for m in good]).reshape(-1, 1, 2)
-                dst_pts = np.float32([kp2[m.trainIdx].pt for m in good]).reshape(-1, 1, 2)
-                transform = cv2.estimateRigidTransform(src_pts, dst_pts, False)
-                if transform is not None:
-                    transformed_center = cv2.transform(CAMERA_CENTER, transform)  # get global pixel
-                    transformed_center = [transformed_center[0][0][0] / METER_TO_PIXEL,  # map to global pose
-                                          (MAP_PIXEL_HEIGHT - 1 - transformed_center[0][0][1]) / METER_TO_PIXEL]
-                    yaw = np.arctan2(transform[1, 0], transform[0, 0])  # get global heading
-
-                    # correct the pose if the drone is not level
-                    z = math.sqrt(self.z ** 2 / (1 + math.tan(self.angle_x) ** 2 + math.tan(self.angle_y) ** 2))
-                    offset_x = np.tan(self.angle_x) * z
-                    offset_y = np.tan(self.angle_y) * z
-                    global_offset_x = math.cos(yaw) * offset_x + math.sin(yaw) * offset_y
-                    global_offset_y = math.sin(yaw) * offset_x + math.cos(yaw) * offset_y
-                    pose = [transformed_center[0] + global_offset_x, transformed_center[1] + global_offset_y, z, yaw]
-
-        return pose, len(good)
-
-    def compute_transform(self, kp1, des1, kp2, des2):
-        transform = None
+        # the ratio test needs at least two map features
+        if frame.des is not None and des2 is not None and len(des2) > 1:
+            if cell is not None:
+                matches = self.matcher_pool.get(cell, des2).knnMatch(frame.des, k=2)
+            else:
+                matches = self.matcher.knnMatch(frame.des, des2, k=2)
 
-        if des1 is not None and des2 is not None:
-            matches = self.matcher.knnMatch(des1, des2, k=2)
+            return locate(matches, frame.points, kp2, (self.z, self.angle_x, self.angle_y))
 
-            good = []
-            for match in matches:
-                if len(match) > 1 and match[0].distance < MATCH_RATIO * match[1].distance:
-                    good.append(match[0])
+        return None, 0
 
-            src_pts = np.float32([kp1[m.queryIdx].pt for m in good]).reshape(-1, 1, 2)
-            dst_pts = np.float32([kp2[m.trainIdx].pt for m in good]).reshape(-1, 1, 2)
+    def compute_transform(self, frame1, frame2, predicted=None):
+        """
+        :param frame1, frame2: the Frames to transform from and to
+        :param predicted: a predicted 2 x 3 transform from frame 1 to frame 2, used to guide the matching
+        """
+        query, train = frame2.match(frame1, predicted)
 
-            # estimateRigidTransform needs at least three pairs
-            if src_pts is not None and dst_pts is not None and len(src_pts) > 3 and len(dst_pts) > 3:
-                transform = cv2.estimateRigidTransform(src_pts, dst_pts, False)
+        # estimateRigidTransform needs at least three pairs
+        if len(query) > 3:
+            return cv2.estimateRigidTransform(frame1.points[query].reshape(-1, 1, 2),
+                                              frame2.points[train].reshape(-1, 1, 2), False)
 
-        return transform
+        return None
 
     def pixel_to_meter(self, px):
         """""
@@ -372,24 +404,91 @@ class LocalizationParticleFilter:
         """""
         return px * self.z / CAMERA_SCALE
 
+    def close(self):
+        """
+        stops the relocalization workers
+        """
+        if self.relocalizer is not None:
+            self.relocalizer.close()
+            self.relocalizer = None
+
 
 def adjust_angle(angle):
     """""
-    keeps angle within -pi to pi
+    keeps angle within -pi to pi, works on scalars and on arrays of angles
     """""
-    while angle > math.pi:
-        angle -= 2 * math.pi
-    while angle <= -math.pi:
-        angle += 2 * math.pi
+    return math.pi - np.mod(math.pi - angle, 2 * math.pi)
+
+
+def locate(matches, points1, points2, attitude):
+    """
+    compute the global location of center of current image from its matches against the map
+    :param matches: the result of a knnMatch with k=2 of the captured descriptions against the map's
+    :param points1: captured keyPoint coordinates
+    :param points2: map keyPoint coordinates
+    :param attitude: the height, angle_x and angle_y of the drone
+    :return: global pose, or None if it cannot be computed, and the number of good matches
+    """
+    good = []
+    pose = None
+
+    for match in matches:
+        if len(match) > 1 and match[0].distance < MATCH_RATIO * match[1].distance:
+            good.append(match[0])
+
+    if len(good) > MIN_MATCH_COUNT:
+        src_pts = np.float32([points1[m.queryIdx] for m in good]).reshape(-1, 1, 2)
+        dst_pts = np.float32([points2[m.trainIdx] for m in good]).reshape(-1, 1, 2)
+        transform = cv2.estimateRigidTransform(src_pts, dst_pts, False)
+        if transform is not None:
+            transformed_center = cv2.transform(CAMERA_CENTER, transform)  # get global pixel
+            transformed_center = [transformed_center[0][0][0] / METER_TO_PIXEL,  # map to global pose
+                                  (MAP_PIXEL_HEIGHT - 1 - transformed_center[0][0][1]) / METER_TO_PIXEL]
+            yaw = np.arctan2(transform[1, 0], transform[0, 0])  # get global heading
 
-    return angle
+            # correct the pose if the drone is not level
+            height, angle_x, angle_y = attitude
+            z = math.sqrt(height ** 2 / (1 + math.tan(angle_x) ** 2 + math.tan(angle_y) ** 2))
+            offset_x = np.tan(angle_x) * z
+            offset_y = np.tan(angle_y) * z
+            global_offset_x = math.cos(yaw) * offset_x + math.sin(yaw) * offset_y
+            global_offset_y = math.sin(yaw) * offset_x + math.cos(yaw) * offset_y
+            pose = [transformed_center[0] + global_offset_x, transformed_center[1] + global_offset_y, z, yaw]
+
+    return pose, len(good)
 
 
 def create_map(file_name):
     """
     create a feature map, extract features from each bigger cell.
+    the features are compiled into a file next to the image the first time, later calls memory-map that file
+    instead of extracting the features again, as long as the image has not changed
     :param file_name: the image of map
     :return: a list of center of bigger cells (kp and des), each bigger cell is a 3 by 3 grid (9 cells).
+    the kp of a cell are the N x 2 pixel coordinates of its keypoints
+    """
+    compiled_file_name = os.path.splitext(file_name)[0] + MAP_EXTENSION
+
+    compiled = feature_map.load_map(compiled_file_name, file_name, MAP_FEATURES)
+    if compiled is not None and (compiled.grid_size_x, compiled.grid_size_y) == (MAP_GRID_SIZE_X, MAP_GRID_SIZE_Y):
+        return compiled.grid()
+
+    map_grid_kp, map_grid_des = extract_map(file_name)
+
+    try:
+        feature_map.write_map(compiled_file_name, map_grid_kp, map_grid_des, MAP_FEATURES, file_name)
+    except (IOError, OSError) as e:
+        print "Could not save the compiled map:", e
+        return map_grid_kp, map_grid_des
+
+    return feature_map.FeatureMap(compiled_file_name).grid()
+
+
+def extract_map(file_name):
+    """
+    extracts the features of the map image and groups them by cell
+    :param file_name: the image of map
+    :return: lists indexed [x][y] of the keypoint coordinates and descriptors of each bigger cell
     """
 
     # read image and extract features
@@ -408,7 +507,7 @@ def create_map(file_name):
     for i in range(len(kp)):
         x = int(kp[i].pt[0] / CELL_X)
         y = MAP_GRID_SIZE_Y - 1 - int(kp[i].pt[1] / CELL_Y)
-        grid_kp[x][y].append(kp[i])
+        grid_kp[x][y].append(kp[i].pt)
         grid_des[x][y].append(des[i])
 
     # group every 3 by 3 grid, so we can access each center of grid and its 8 neighbors easily
@@ -423,7 +522,8 @@ def create_map(file_name):
                     if 0 <= x < MAP_GRID_SIZE_X and 0 <= y < MAP_GRID_SIZE_Y:
                         map_grid_kp[i][j].extend(grid_kp[x][y])
                         map_grid_des[i][j].extend(grid_des[x][y])
-            map_grid_des[i][j] = np.array(map_grid_des[i][j])
+            map_grid_kp[i][j] = np.array(map_grid_kp[i][j], dtype=np.float32).reshape(-1, 2)
+            map_grid_des[i][j] = np.array(map_grid_des[i][j], dtype=np.uint8).reshape(-1, feature_map.DES_SIZE)
 
     return map_grid_kp, map_grid_des
 
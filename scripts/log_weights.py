@@ -0,0 +1,62 @@
+"""
+log_weights.py
+
+Helpers for particle weights kept in log space
+
+The FastSLAM weights are sums of log likelihoods, which are far too small to exponentiate directly, so
+they are normalized with the log-sum-exp trick: the largest log weight is subtracted before exponentiating.
+"""
+
+import numpy as np
+import resampling
+
+
+def log_sum_exp(log_weights):
+    """
+    :param log_weights: an array of log weights
+    :return: log(sum(exp(log_weights))), computed without overflow or underflow
+    """
+    log_weights = np.asarray(log_weights, dtype=np.float64)
+    largest = np.max(log_weights)
+    if not np.isfinite(largest):
+        return largest
+
+    return largest + np.log(np.sum(np.exp(log_weights - largest)))
+
+
+def normalize(log_weights):
+    """
+    :param log_weights: an array of log weights
+    :return: the weights as a probability distribution
+    """
+    log_weights = np.asarray(log_weights, dtype=np.float64)
+    return np.exp(log_weights - log_sum_exp(log_weights))
+
+
+def effective_sample_size(log_weights):
+    """
+    :param log_weights: an array of log weights
+    :return: the number of equally weighted particles the weights are worth, between 1 and len(log_weights)
+    """
+    return resampling.effective_sample_size(normalize(log_weights))
+
+
+def circular_mean(angles, weights):
+    """
+    averages angles as unit vectors, so angles on either side of -pi/pi average to about pi rather than 0
+
+    :param angles: an array of angles in radians
+    :param weights: the normalized weight of each angle
+    :return: the weighted mean direction of the angles, within -pi to pi
+    """
+    return np.arctan2(np.dot(weights, np.sin(angles)), np.dot(weights, np.cos(angles)))
+
+
+def mean_pose(poses, weights):
+    """
+    :param poses: N x 4 array of poses (x, y, z, yaw)
+    :param weights: the normalized weight of each pose
+    :return: the weighted mean pose [x, y, z, yaw], with the circular mean of the yaws
+    """
+    x, y, z = np.dot(weights, poses[:, :3])
+    return [x, y, z, circular_mean(poses[:, 3], weights)]
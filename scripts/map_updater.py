@@ -0,0 +1,126 @@
+"""
+map_updater.py
+
+Runs the FastSLAM map update for a keyframe on a pool of worker processes, so the update uses every core of
+the pi instead of one python thread. The particles are split into one shard per worker, and the keyframe's
+measurements and descriptors are handed to the workers in shared memory, only the per-particle tasks are
+pickled.
+"""
+
+import multiprocessing
+import signal
+import numpy as np
+
+NUM_WORKERS = max(1, multiprocessing.cpu_count() - 1)
+MAX_FEATURES = 1000
+DES_SIZE = 32
+
+# state of a worker process, filled in by init_worker
+worker = {}
+
+
+def init_worker(shared_measurements, shared_descriptors, matcher_factory):
+    """
+    runs once in each worker process, wraps the shared memory in arrays and builds the worker's matcher
+    """
+    # let the parent process handle ctrl-c
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    worker['measurements'] = np.frombuffer(shared_measurements, dtype=np.float64).reshape(-1, 2)
+    worker['descriptors'] = np.frombuffer(shared_descriptors, dtype=np.uint8).reshape(-1, DES_SIZE)
+    worker['matcher'] = matcher_factory()
+
+
+def run_shard(args):
+    """
+    applies the update function to every task of a shard
+
+    :param args: the update function, the number of features in the keyframe, the tasks and extra parameters
+    :return: the list of results, one per task
+    """
+    function, num_features, tasks, params = args
+    measurements = worker['measurements'][:num_features]
+    descriptors = worker['descriptors'][:num_features]
+
+    return [function(worker['matcher'], task, measurements, descriptors, params) for task in tasks]
+
+
+class MapUpdater(object):
+    """
+    a pool of worker processes which runs one map update at a time
+
+    the update function is called in the workers as function(matcher, task, measurements, descriptors, params)
+    and must be a module level function so it can be sent to them
+    """
+
+    def __init__(self, matcher_factory, num_workers=NUM_WORKERS, max_features=MAX_FEATURES):
+        self.num_workers = num_workers
+        self.max_features = max_features
+
+        shared_measurements = multiprocessing.RawArray('d', max_features * 2)
+        shared_descriptors = multiprocessing.RawArray('B', max_features * DES_SIZE)
+        self.measurements = np.frombuffer(shared_measurements, dtype=np.float64).reshape(-1, 2)
+        self.descriptors = np.frombuffer(shared_descriptors, dtype=np.uint8).reshape(-1, DES_SIZE)
+
+        self.pool = multiprocessing.Pool(num_workers, init_worker,
+                                         (shared_measurements, shared_descriptors, matcher_factory))
+        self.in_flight = None
+
+    def busy(self):
+        """
+        :return: True if an update was started and its results have not been collected yet
+        """
+        return self.in_flight is not None
+
+    def ready(self):
+        """
+        :return: True if an update has finished and its results can be collected
+        """
+        return self.in_flight is not None and self.in_flight.ready()
+
+    def start(self, function, tasks, measurements, descriptors, params):
+        """
+        copies the keyframe into shared memory and starts the update on the workers, without waiting for it
+
+        :param function: the update function to run on each task
+        :param tasks: the list of per-particle tasks
+        :param measurements, descriptors: the arrays of the keyframe's measurements and descriptors
+        :param params: extra parameters passed to every call of function
+        """
+        if self.busy():
+            raise RuntimeError("a map update is already running")
+
+        num_features = len(measurements)
+        if num_features > self.max_features:
+            raise ValueError("keyframe has %d features, the map updater holds at most %d"
+                             % (num_features, self.max_features))
+
+        self.measurements[:num_features] = measurements
+        self.descriptors[:num_features] = descriptors
+
+        shards = np.array_split(np.arange(len(tasks)), self.num_workers)
+        args = [(function, num_features, [tasks[i] for i in shard], params) for shard in shards if len(shard) != 0]
+        self.in_flight = self.pool.map_async(run_shard, args)
+
+    def results(self):
+        """
+        waits for the running update to finish
+
+        :return: the results of the update, in the order of its tasks
+        """
+        shards = self.in_flight.get()
+        self.in_flight = None
+
+        return [result for shard in shards for result in shard]
+
+    def cancel(self):
+        """
+        waits for the running update, if any, and throws its results away
+        """
+        if self.in_flight is not None:
+            self.in_flight.wait()
+            self.in_flight = None
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
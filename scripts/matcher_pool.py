@@ -0,0 +1,63 @@
+"""
+matcher_pool.py
+
+Keeps a matcher trained on the descriptors of each map cell, so the index of a cell is built once instead of
+on every knnMatch against it. The pool holds at most a fixed number of matchers and drops the least
+recently used one when it is full. A map small enough for the pool is trained when it is loaded, see fill.
+"""
+
+from collections import OrderedDict
+from matchers import create_matcher
+
+POOL_SIZE = 128
+
+
+class MatcherPool(object):
+    """
+    a least recently used cache of trained matchers, keyed by map cell
+    """
+
+    def __init__(self, matcher_factory=create_matcher, size=POOL_SIZE):
+        self.matcher_factory = matcher_factory
+        self.size = size
+        self.matchers = OrderedDict()
+
+    def get(self, key, descriptors):
+        """
+        :param key: the map cell, which must always be passed with the same descriptors
+        :param descriptors: the descriptors of the cell, used to train its matcher the first time the cell is used
+        :return: a matcher trained on the cell's descriptors, query it with knnMatch(query_descriptors, k)
+        """
+        matcher = self.matchers.pop(key, None)
+        if matcher is None:
+            matcher = self.matcher_factory()
+            matcher.add([descriptors])
+            matcher.train()
+
+            if len(self.matchers) >= self.size:
+                self.matchers.popitem(last=False)
+
+        # the most recently used matcher goes last
+        self.matchers[key] = matcher
+        return matcher
+
+    def fill(self, cells):
+        """
+        trains the matchers of the map's cells up front, so the first frames over a cell do not wait for its
+        matcher to be trained, once the pool is full the other cells are still trained when they are first used
+
+        :param cells: iterable of (key, descriptors) of each cell, the first ones are kept if there are more than
+                      the pool holds
+        """
+        for key, descriptors in cells:
+            if len(self.matchers) >= self.size:
+                break
+            # a cell needs two features for the ratio test, so it is never matched otherwise
+            if len(descriptors) > 1:
+                self.get(key, descriptors)
+
+    def clear(self):
+        """
+        drops every matcher, must be called when the map changes
+        """
+        self.matchers.clear()
@@ -0,0 +1,191 @@
+"""
+matchers.py
+
+Matchers for ORB descriptors with a choice of backend
+
+FLANN: OpenCV's approximate matcher with an LSH index, fast on large train sets once the index is built, but
+       on small train sets the hash buckets are nearly empty and it often finds no second neighbor
+BF:    OpenCV's exact brute force matcher with the Hamming norm, cheapest for small train sets
+NUMPY: an exact brute force matcher on the popcount table of hamming.py, which needs no OpenCV matcher
+
+A Matcher picks its backend from the size of the problem unless one is given, and has the knnMatch interface
+of OpenCV's matchers, so it can be used anywhere one of them is. tests/matcher_benchmark.py times the backends
+on a range of sizes, the thresholds below come from it.
+"""
+
+import cv2
+import numpy as np
+import hamming
+
+FLANN = 'flann'
+BF = 'bf'
+NUMPY = 'numpy'
+BACKENDS = (FLANN, BF, NUMPY)
+
+# brute force is exact, and faster than LSH until the train set has this many descriptors
+BF_MAX_TRAIN = 300
+# without a prebuilt index, brute force is also faster than building an LSH index when there are this few
+# query descriptors
+BF_MAX_QUERY = 50
+
+
+def create_matcher(backend=None):
+    """
+    :param backend: one of BACKENDS, or None to choose by problem size
+    :return: an untrained Matcher for ORB descriptors
+    """
+    return Matcher(backend)
+
+
+def choose_backend(num_train, num_query=None):
+    """
+    :param num_train: the number of train descriptors
+    :param num_query: the number of query descriptors, None if the matcher is trained once and queried many
+                      times, so the cost of building an index does not count
+    :return: the fastest backend for the problem which does not lose matches
+    """
+    if num_train <= BF_MAX_TRAIN or (num_query is not None and num_query <= BF_MAX_QUERY):
+        return BF
+
+    return FLANN
+
+
+def create_backend(backend):
+    """
+    :param backend: one of BACKENDS
+    :return: an untrained matcher of that backend
+    """
+    if backend == FLANN:
+        index_params = dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1)
+        search_params = dict(checks=50)
+        return cv2.FlannBasedMatcher(index_params, search_params)
+    elif backend == BF:
+        return cv2.BFMatcher(cv2.NORM_HAMMING)
+    elif backend == NUMPY:
+        return NumpyMatcher()
+
+    raise ValueError('unknown matcher backend: %s' % backend)
+
+
+class Matcher(object):
+    """
+    a descriptor matcher with the knnMatch interface of OpenCV's matchers
+
+    use it either as knnMatch(query, train, k), or add([train]), train() and then knnMatch(query, k)
+
+    knnMatch(query, train, k) keeps the backend it builds for train, so matching more queries against the same
+    train array reuses it, the array must not be changed in place while it is matched against
+    """
+
+    def __init__(self, backend=None):
+        """
+        :param backend: one of BACKENDS, or None to choose by problem size
+        """
+        if backend is not None and backend not in BACKENDS:
+            raise ValueError('unknown matcher backend: %s' % backend)
+
+        self.backend = backend
+        self.descriptors = []
+        self.trained = None
+        # the last train array passed to knnMatch and the backend trained on it
+        self.train_array = None
+        self.train_backend = None
+
+    def add(self, descriptors):
+        """
+        :param descriptors: a list of arrays of train descriptors
+        """
+        self.descriptors.extend(descriptors)
+        self.trained = None
+
+    def train(self):
+        """
+        builds the backend matcher for the train descriptors
+        """
+        num_train = sum(len(d) for d in self.descriptors)
+        self.trained = create_backend(self.backend or choose_backend(num_train))
+        self.trained.add(self.descriptors)
+        self.trained.train()
+
+    def clear(self):
+        self.descriptors = []
+        self.trained = None
+        self.train_array = None
+        self.train_backend = None
+
+    def knnMatch(self, query, train=None, k=2):
+        """
+        :param query: the query descriptors
+        :param train: the train descriptors, if None the query is matched against the descriptors added before
+        :param k: the number of neighbors to find for each query descriptor
+        :return: for each query descriptor the list of its up to k closest DMatch
+        """
+        if train is not None:
+            if train is not self.train_array:
+                # training the backend costs what matching against an untrained one does, and is only paid once
+                # for each train array
+                self.train_backend = create_backend(self.backend or choose_backend(len(train), len(query)))
+                self.train_backend.add([train])
+                self.train_backend.train()
+                self.train_array = train
+
+            return self.train_backend.knnMatch(query, k=k)
+
+        if self.trained is None:
+            self.train()
+
+        return self.trained.knnMatch(query, k=k)
+
+
+class NumpyMatcher(object):
+    """
+    exact brute force matching on the popcount table
+    """
+
+    def __init__(self):
+        self.descriptors = []
+        self.train_descriptors = None
+
+    def add(self, descriptors):
+        self.descriptors.extend(descriptors)
+
+    def train(self):
+        self.train_descriptors = np.concatenate(self.descriptors) if len(self.descriptors) != 0 else None
+
+    def knnMatch(self, query, train=None, k=2):
+        if train is None:
+            train = self.train_descriptors
+
+        return to_dmatches(*knn_match(query, train, k))
+
+
+def knn_match(query, train, k):
+    """
+    :param query: N x D array of uint8 descriptors
+    :param train: M x D array of uint8 descriptors
+    :param k: the number of neighbors
+    :return: N x min(k, M) arrays of the train indices and distances of each query's neighbors, closest first
+    """
+    num_query = 0 if query is None else len(query)
+    if num_query == 0 or train is None or len(train) == 0:
+        return np.empty((num_query, 0), dtype=np.int64), np.empty((num_query, 0), dtype=np.int32)
+
+    distances = hamming.distances(query, train)
+    k = min(k, len(train))
+    rows = np.arange(num_query)[:, np.newaxis]
+
+    # the k closest in any order, then sorted
+    neighbors = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    order = np.argsort(distances[rows, neighbors], axis=1, kind='mergesort')
+    neighbors = neighbors[rows, order]
+
+    return neighbors, distances[rows, neighbors]
+
+
+def to_dmatches(neighbors, distances):
+    """
+    :param neighbors, distances: the arrays returned by knn_match
+    :return: the lists of DMatch knnMatch returns
+    """
+    return [[cv2.DMatch(q, int(t), float(d)) for t, d in zip(neighbors[q], distances[q])]
+            for q in range(len(neighbors))]
@@ -5,6 +5,9 @@ from sensor_msgs.msg import Image
 from std_msgs.msg import Empty
 from geometry_msgs.msg import Pose
 from analyze_flow import AnalyzeFlow
+from frame_pipeline import FramePipeline
+from frame_ingest import CapturedFrame
+import frame_ingest
 from cv_bridge import CvBridge
 import rospy
 import picamera
@@ -14,6 +17,7 @@ import numpy as np
 CAMERA_WIDTH = 320
 CAMERA_HEIGHT = 240
 CAMERA_CENTER = np.float32([(CAMERA_WIDTH - 1) / 2., (CAMERA_HEIGHT - 1) / 2.])
+NUM_FEATURES = 150
 
 
 class ObjectTracker(picamera.array.PiMotionAnalysis):
@@ -22,7 +26,7 @@ class ObjectTracker(picamera.array.PiMotionAnalysis):
 
         self.obj_pose_pub = rospy.Publisher('/pidrone/desired/pose', Pose, queue_size=1)
 
-        self.detector = cv2.ORB(nfeatures=150, scoreType=cv2.ORB_FAST_SCORE)
+        self.detector = cv2.ORB(nfeatures=NUM_FEATURES, scoreType=cv2.ORB_FAST_SCORE)
 
         self.curr_obj_coordinates = None
         self.error = None
@@ -34,11 +38,17 @@ class ObjectTracker(picamera.array.PiMotionAnalysis):
         self.z = 0.16
 
     def write(self, data):
-        curr_img = np.reshape(np.fromstring(data, dtype=np.uint8), (CAMERA_HEIGHT, CAMERA_WIDTH, 3))
+        self.process(CapturedFrame(data, CAMERA_WIDTH, CAMERA_HEIGHT, self.detector))
+
+    def process(self, captured):
+        """
+        :param captured: the CapturedFrame of the camera image
+        """
+        curr_img = captured.image
 
         # start object tracking
         if self.track_object:
-            curr_kp, curr_des = self.detector.detectAndCompute(curr_img, None)
+            curr_kp, curr_des = captured.features(NUM_FEATURES)
 
             if curr_kp is not None and len(curr_kp) > 0:
                 kp_x = []
@@ -130,19 +140,23 @@ def main():
                     # run the setup functions for each of the image callback classes
                     flow_analyzer.setup(camera.resolution)
 
+                    # the tracker works on the newest frame on its own thread, so it never holds up the camera
+                    tracker_pipeline = FramePipeline(tracker, 'object_tracking')
+
                     # start the recordings for the image and the motion vectors
                     camera.start_recording("/dev/null", format='h264', splitter_port=1, motion_output=flow_analyzer)
-                    camera.start_recording(tracker, format='bgr', splitter_port=2)
+                    camera.start_recording(tracker_pipeline, format=frame_ingest.FORMAT, splitter_port=2)
 
                     while not rospy.is_shutdown():
                         camera.wait_recording(1 / 100.0)
 
                         if tracker.prev_img is not None:
-                            image_message = bridge.cv2_to_imgmsg(tracker.prev_img, encoding="bgr8")
+                            image_message = bridge.cv2_to_imgmsg(tracker.prev_img, encoding="mono8")
                             image_pub.publish(image_message)
 
                 camera.stop_recording(splitter_port=1)
             camera.stop_recording(splitter_port=2)
+            tracker_pipeline.close()
         print "Shutdown Received"
     except Exception:
         print "Camera Error!!"
@@ -8,14 +8,17 @@ import numpy as np
 import cv2
 from pidrone_pkg.msg import axes_err, Mode, ERR
 from sensor_msgs.msg import Image, Range, CameraInfo
-from std_msgs.msg import Empty
+from std_msgs.msg import Empty, Int32
 import rospy
 import tf
-from cv_bridge import CvBridge, CvBridgeError
 from geometry_msgs.msg import PoseStamped
 from pidrone_pkg.msg import State
 from localization_helper import LocalizationParticleFilter, create_map, PROB_THRESHOLD
+from frame import Frame
+from frame_transport import FrameSubscriber
+from feature_transport import FeatureSubscriber
 import os
+import argparse
 
 # ---------- map parameters ----------- #
 MAP_PIXEL_WIDTH = 3227  # in pixel
@@ -34,6 +37,7 @@ CAMERA_CENTER = np.float32([(CAMERA_WIDTH - 1) / 2., (CAMERA_HEIGHT - 1) / 2.]).
 # ---------- localization parameters ----------- #
 MAX_BAD_COUNT = -10
 NUM_PARTICLE = 30
+MIN_PARTICLE = 10
 NUM_FEATURES = 200
 # ---------------------------------------------- #
 
@@ -41,15 +45,16 @@ NUM_FEATURES = 200
 class AnalyzePhase:
 
     def __init__(self):
-        self.bridge = CvBridge()
         self.br = tf.TransformBroadcaster()
 
         self.posepub = rospy.Publisher('/pidrone/picamera/pose', PoseStamped, queue_size=1)
         self.first_image_pub = rospy.Publisher("/pidrone/picamera/first_image", Image, queue_size=1, latch=True)
+        self.num_particles_pub = rospy.Publisher('/pidrone/picamera/num_particles', Int32, queue_size=1)
 
         self.detector = cv2.ORB(nfeatures=NUM_FEATURES, scoreType=cv2.ORB_FAST_SCORE)
         map_grid_kp, map_grid_des = create_map('map.jpg')
         self.estimator = LocalizationParticleFilter(map_grid_kp, map_grid_des)
+        rospy.on_shutdown(self.estimator.close)
 
         # [x, y, z, yaw]
         self.pos = [0, 0, 0, 0]
@@ -64,8 +69,7 @@ class AnalyzePhase:
         self.locate_position = False
 
         self.prev_img = None
-        self.prev_kp = None
-        self.prev_des = None
+        self.prev_frame = None
         self.prev_time = None
         self.prev_rostime = None
 
@@ -76,20 +80,37 @@ class AnalyzePhase:
         self.alpha_yaw = 0.1  # perceived yaw smoothing alpha
         self.hybrid_alpha = 0.3  # blend position with first frame and int
 
-    def image_callback(self, data):
-        curr_img = self.bridge.imgmsg_to_cv2(data, desired_encoding="passthrough")
+    def image_callback(self, curr_img):
+        """ process a camera frame, read from shared memory when the camera runs on this host, see frame_transport """
+        # the frame may be a view of a shared memory slot, which is reused once the callback returns
+        self.prev_img = curr_img.copy()
+        if self.locate_position:
+            curr_kp, curr_des = self.detector.detectAndCompute(curr_img, None)
+            self.process(Frame(curr_kp, curr_des))
+        else:
+            self.process(None)
+
+    def features_callback(self, curr_frame, z, angle_x, angle_y):
+        """ process the features of a camera frame detected on the drone, see feature_transport """
+        self.z = z
+        self.angle_x = angle_x
+        self.angle_y = angle_y
+        self.process(curr_frame if self.locate_position else None)
+
+    def process(self, curr_frame):
+        """
+        :param curr_frame: the Frame of the camera frame, None while not locating
+        """
         curr_rostime = rospy.Time.now()
         self.posemsg.header.stamp = curr_rostime
         curr_time = curr_rostime.to_sec()
 
         # start MCL localization
-        if self.locate_position:
-            curr_kp, curr_des = self.detector.detectAndCompute(curr_img, None)
-
-            if curr_kp is not None and curr_kp is not None:
+        if curr_frame is not None:
+            if len(curr_frame) != 0:
                 # generate particles for the first time
                 if self.first_locate:
-                    particle = self.estimator.initialize_particles(NUM_PARTICLE, curr_kp, curr_des)
+                    particle = self.estimator.initialize_particles(NUM_PARTICLE, curr_frame, MIN_PARTICLE)
                     self.first_locate = False
                     self.pos = [particle.x(), particle.y(), particle.z(), particle.yaw()]
 
@@ -105,8 +126,7 @@ class AnalyzePhase:
 
                     print 'first', particle
                 else:
-                    particle = self.estimator.update(self.z, self.angle_x, self.angle_y, self.prev_kp, self.prev_des,
-                                                     curr_kp, curr_des)
+                    particle = self.estimator.update(self.z, self.angle_x, self.angle_y, self.prev_frame, curr_frame)
 
                     # update position
                     self.pos = [self.hybrid_alpha * particle.x() + (1.0 - self.hybrid_alpha) * self.pos[0],
@@ -124,6 +144,7 @@ class AnalyzePhase:
                     self.posemsg.pose.orientation.z = z
                     self.posemsg.pose.orientation.w = w
                     self.posepub.publish(self.posemsg)
+                    self.num_particles_pub.publish(self.estimator.particles.num_particles)
 
                     print '--pose', self.pos[0], self.pos[1], self.pos[3]
 
@@ -145,10 +166,8 @@ class AnalyzePhase:
             else:
                 print "CANNOT FIND ANY FEATURES !!!!!"
 
-            self.prev_kp = curr_kp
-            self.prev_des = curr_des
+            self.prev_frame = curr_frame
 
-        self.prev_img = curr_img
         self.prev_time = curr_time
         self.prev_rostime = curr_rostime
         self.br.sendTransform((self.pos[0], self.pos[1], self.z),
@@ -178,14 +197,20 @@ def is_almost_equal(x, y):
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Run localization off board')
+    parser.add_argument('--images', action='store_true',
+                        help='run ORB on the camera frames instead of using the features the drone publishes')
+    args = parser.parse_args(rospy.myargv()[1:])
+
     node_name = os.path.splitext(os.path.basename(__file__))[0]
     rospy.init_node(node_name)
     
-    phase_analyzer = AnalyzePhase()
-
     phase_analyzer = AnalyzePhase()
     rospy.Subscriber("/pidrone/reset_transform", Empty, phase_analyzer.reset_callback)
-    rospy.Subscriber('/pidrone/picamera/image_raw', Image, phase_analyzer.image_callback)
+    if args.images:
+        frame_subscriber = FrameSubscriber(phase_analyzer.image_callback)
+    else:
+        feature_subscriber = FeatureSubscriber(phase_analyzer.features_callback, NUM_FEATURES)
     rospy.Subscriber('/pidrone/state', State, phase_analyzer.state_callback)
 
     print "Start"
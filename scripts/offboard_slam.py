@@ -7,14 +7,17 @@ Runs fastSLAM for the pidrone off board, on the pi run 'vision_offboard.py'
 import numpy as np
 import cv2
 from sensor_msgs.msg import Image, Range
-from std_msgs.msg import Empty
+from std_msgs.msg import Empty, Int32
 from pidrone_pkg.msg import State
 import rospy
 import tf
-from cv_bridge import CvBridge
 from geometry_msgs.msg import PoseStamped
 from slam_helper import FastSLAM
+from frame import Frame
+from frame_transport import FrameSubscriber
+from feature_transport import FeatureSubscriber
 import os
+import argparse
 
 
 CAMERA_WIDTH = 320
@@ -22,20 +25,22 @@ CAMERA_HEIGHT = 240
 # assume a pixel in x and y has the same length
 CAMERA_CENTER = np.float32([(CAMERA_WIDTH - 1) / 2., (CAMERA_HEIGHT - 1) / 2.]).reshape(-1, 1, 2)
 NUM_PARTICLE = 20
+MIN_PARTICLE = 8
 NUM_FEATURES = 50
 
 
 class AnalyzePhase:
 
     def __init__(self):
-        self.bridge = CvBridge()
         self.br = tf.TransformBroadcaster()
 
         self.posepub = rospy.Publisher('/pidrone/picamera/pose', PoseStamped, queue_size=1)
         self.first_image_pub = rospy.Publisher("/pidrone/picamera/first_image", Image, queue_size=1, latch=True)
+        self.num_particles_pub = rospy.Publisher('/pidrone/picamera/num_particles', Int32, queue_size=1)
 
         self.detector = cv2.ORB(nfeatures=NUM_FEATURES, scoreType=cv2.ORB_FAST_SCORE)
         self.estimator = FastSLAM()
+        rospy.on_shutdown(self.estimator.close)
 
         self.angle_x = 0.0
         self.angle_y = 0.0
@@ -44,8 +49,7 @@ class AnalyzePhase:
         self.locate_position = False
 
         self.prev_img = None
-        self.prev_kp = None
-        self.prev_des = None
+        self.prev_frame = None
         self.prev_time = None
 
         self.prev_rostime = None
@@ -57,20 +61,37 @@ class AnalyzePhase:
         self.alpha_yaw = 0.1  # perceived yaw smoothing alpha
         self.hybrid_alpha = 0.3  # blend position with first frame and int
 
-    def image_callback(self, data):
-        curr_img = self.bridge.imgmsg_to_cv2(data, desired_encoding="passthrough")
+    def image_callback(self, curr_img):
+        """ process a camera frame, read from shared memory when the camera runs on this host, see frame_transport """
+        # the frame may be a view of a shared memory slot, which is reused once the callback returns
+        self.prev_img = curr_img.copy()
+        if self.locate_position:
+            curr_kp, curr_des = self.detector.detectAndCompute(curr_img, None)
+            self.process(Frame(curr_kp, curr_des))
+        else:
+            self.process(None)
+
+    def features_callback(self, curr_frame, z, angle_x, angle_y):
+        """ process the features of a camera frame detected on the drone, see feature_transport """
+        self.z = z
+        self.angle_x = angle_x
+        self.angle_y = angle_y
+        self.process(curr_frame if self.locate_position else None)
+
+    def process(self, curr_frame):
+        """
+        :param curr_frame: the Frame of the camera frame, None while not locating
+        """
         curr_rostime = rospy.Time.now()
         self.posemsg.header.stamp = curr_rostime
         curr_time = curr_rostime.to_sec()
 
         # start SLAM
-        if self.locate_position:
-            curr_kp, curr_des = self.detector.detectAndCompute(curr_img, None)
-
-            if curr_kp is not None and len(curr_kp) != 0:
+        if curr_frame is not None:
+            if len(curr_frame) != 0:
                 # generate particles for the first time
                 if self.first_locate:
-                    pose = self.estimator.generate_particles(NUM_PARTICLE)
+                    pose = self.estimator.generate_particles(NUM_PARTICLE, MIN_PARTICLE)
                     self.first_locate = False
                     self.pos = pose
 
@@ -84,11 +105,11 @@ class AnalyzePhase:
                     self.posemsg.pose.orientation.z = z
                     self.posemsg.pose.orientation.w = w
                     self.posepub.publish(self.posemsg)
+                    self.num_particles_pub.publish(self.estimator.particles.num_particles)
 
                     print 'first', pose
                 else:
-                    pose, weight = self.estimator.run(self.z, self.prev_kp, self.prev_des,
-                                                      curr_kp, curr_des)
+                    pose, weight = self.estimator.run(self.z, self.prev_frame, curr_frame)
 
                     # update position
                     self.pos = [self.hybrid_alpha * pose[0] + (1.0 - self.hybrid_alpha) * self.pos[0],
@@ -106,16 +127,15 @@ class AnalyzePhase:
                     self.posemsg.pose.orientation.z = z
                     self.posemsg.pose.orientation.w = w
                     self.posepub.publish(self.posemsg)
+                    self.num_particles_pub.publish(self.estimator.particles.num_particles)
 
                     print '--pose', self.pos[0], self.pos[1], self.pos[3]
                     print '--weight', weight
             else:
                 print "CANNOT FIND ANY FEATURES !!!!!"
 
-            self.prev_kp = curr_kp
-            self.prev_des = curr_des
+            self.prev_frame = curr_frame
 
-        self.prev_img = curr_img
         self.prev_time = curr_time
         self.prev_rostime = curr_rostime
         self.br.sendTransform((self.pos[0], self.pos[1], self.z),
@@ -138,12 +158,20 @@ class AnalyzePhase:
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Run SLAM off board')
+    parser.add_argument('--images', action='store_true',
+                        help='run ORB on the camera frames instead of using the features the drone publishes')
+    args = parser.parse_args(rospy.myargv()[1:])
+
     node_name = os.path.splitext(os.path.basename(__file__))[0]
     rospy.init_node(node_name)
 
     phase_analyzer = AnalyzePhase()
     rospy.Subscriber('/pidrone/reset_transform', Empty, phase_analyzer.reset_callback)
-    rospy.Subscriber('/pidrone/picamera/image_raw', Image, phase_analyzer.image_callback)
+    if args.images:
+        frame_subscriber = FrameSubscriber(phase_analyzer.image_callback)
+    else:
+        feature_subscriber = FeatureSubscriber(phase_analyzer.features_callback, NUM_FEATURES)
     rospy.Subscriber('/pidrone/state', State, phase_analyzer.state_callback)
 
     print "Start"
@@ -11,9 +11,12 @@ import picamera.array
 import cv2
 from geometry_msgs.msg import PoseStamped
 from sensor_msgs.msg import Image, Range, CameraInfo
+from std_msgs.msg import Int32
 import rospy
 import tf
 from localization_helper import LocalizationParticleFilter, create_map, PROB_THRESHOLD
+from frame import Frame
+from frame_ingest import CapturedFrame
 
 # ---------- map parameters ----------- #
 MAP_PIXEL_WIDTH = 3227  # in pixel
@@ -32,6 +35,7 @@ CAMERA_CENTER = np.float32([(CAMERA_WIDTH - 1) / 2., (CAMERA_HEIGHT - 1) / 2.]).
 # ---------- localization parameters ----------- #
 MAX_BAD_COUNT = -10
 NUM_PARTICLE = 30
+MIN_PARTICLE = 10
 NUM_FEATURES = 200
 
 
@@ -44,11 +48,13 @@ class Localizer(picamera.array.PiMotionAnalysis):
 
         self.posepub = rospy.Publisher('/pidrone/picamera/pose', PoseStamped, queue_size=1)
         self.first_image_pub = rospy.Publisher("/pidrone/picamera/first_image", Image, queue_size=1, latch=True)
+        self.num_particles_pub = rospy.Publisher('/pidrone/picamera/num_particles', Int32, queue_size=1)
 
         self.detector = cv2.ORB(nfeatures=NUM_FEATURES, scoreType=cv2.ORB_FAST_SCORE)
 
         map_grid_kp, map_grid_des = create_map('map.jpg')
         self.estimator = LocalizationParticleFilter(map_grid_kp, map_grid_des)
+        rospy.on_shutdown(self.estimator.close)
 
         # [x, y, z, yaw]
         self.pos = [0, 0, 0, 0]
@@ -63,8 +69,7 @@ class Localizer(picamera.array.PiMotionAnalysis):
         self.locate_position = False
 
         self.prev_img = None
-        self.prev_kp = None
-        self.prev_des = None
+        self.prev_frame = None
         self.prev_time = None
         self.prev_rostime = None
 
@@ -76,19 +81,26 @@ class Localizer(picamera.array.PiMotionAnalysis):
         self.hybrid_alpha = 0.3  # blend position with first frame and int
 
     def write(self, data):
-        curr_img = np.reshape(np.fromstring(data, dtype=np.uint8), (CAMERA_HEIGHT, CAMERA_WIDTH, 3))
+        self.process(CapturedFrame(data, CAMERA_WIDTH, CAMERA_HEIGHT, self.detector))
+
+    def process(self, captured):
+        """
+        :param captured: the CapturedFrame of the camera image
+        """
+        curr_img = captured.image
         curr_rostime = rospy.Time.now()
         self.posemsg.header.stamp = curr_rostime
         curr_time = curr_rostime.to_sec()
 
         # start MCL localization
         if self.locate_position:
-            curr_kp, curr_des = self.detector.detectAndCompute(curr_img, None)
+            curr_kp, curr_des = captured.features(NUM_FEATURES)
+            curr_frame = Frame(curr_kp, curr_des)
 
             if curr_kp is not None and curr_kp is not None:
                 # generate particles for the first time
                 if self.first_locate:
-                    particle = self.estimator.initialize_particles(NUM_PARTICLE, curr_kp, curr_des)
+                    particle = self.estimator.initialize_particles(NUM_PARTICLE, curr_frame, MIN_PARTICLE)
                     self.first_locate = False
                     self.pos = [particle.x(), particle.y(), particle.z(), particle.yaw()]
 
@@ -103,10 +115,10 @@ class Localizer(picamera.array.PiMotionAnalysis):
                     self.posemsg.pose.orientation.w = w
 
                     self.posepub.publish(self.posemsg)
+                    self.num_particles_pub.publish(self.estimator.particles.num_particles)
                     print 'first', particle
                 else:
-                    particle = self.estimator.update(self.z, self.angle_x, self.angle_y, self.prev_kp, self.prev_des,
-                                                     curr_kp, curr_des)
+                    particle = self.estimator.update(self.z, self.angle_x, self.angle_y, self.prev_frame, curr_frame)
 
                     # update position
                     self.pos = [self.hybrid_alpha * particle.x() + (1.0 - self.hybrid_alpha) * self.pos[0],
@@ -125,6 +137,7 @@ class Localizer(picamera.array.PiMotionAnalysis):
                     self.posemsg.pose.orientation.w = w
 
                     self.posepub.publish(self.posemsg)
+                    self.num_particles_pub.publish(self.estimator.particles.num_particles)
                     print '--pose', self.pos[0], self.pos[1], self.pos[3]
 
                     # if all particles are not good estimations
@@ -145,8 +158,7 @@ class Localizer(picamera.array.PiMotionAnalysis):
             else:
                 print "CANNOT FIND ANY FEATURES !!!!!"
 
-            self.prev_kp = curr_kp
-            self.prev_des = curr_des
+            self.prev_frame = curr_frame
 
         self.prev_img = curr_img
         self.prev_time = curr_time
@@ -10,9 +10,12 @@ import picamera.array
 import cv2
 from geometry_msgs.msg import PoseStamped
 from sensor_msgs.msg import Image, Range, CameraInfo
+from std_msgs.msg import Int32
 import rospy
 import tf
 from slam_helper import FastSLAM
+from frame import Frame
+from frame_ingest import CapturedFrame
 
 # ---------- camera parameters DO NOT EDIT ----------- #
 CAMERA_WIDTH = 320
@@ -21,6 +24,7 @@ CAMERA_CENTER = np.float32([(CAMERA_WIDTH - 1) / 2., (CAMERA_HEIGHT - 1) / 2.]).
 
 # ---------- SLAM parameters ----------- #
 NUM_PARTICLE = 7
+MIN_PARTICLE = 4
 NUM_FEATURES = 30
 
 
@@ -34,9 +38,11 @@ class SLAM(picamera.array.PiMotionAnalysis):
         # setup publishers
         self.posepub = rospy.Publisher('/pidrone/picamera/pose', PoseStamped, queue_size=1)
         self.first_image_pub = rospy.Publisher("/pidrone/picamera/first_image", Image, queue_size=1, latch=True)
+        self.num_particles_pub = rospy.Publisher('/pidrone/picamera/num_particles', Int32, queue_size=1)
 
         self.detector = cv2.ORB(nfeatures=NUM_FEATURES, scoreType=cv2.ORB_FAST_SCORE)
         self.estimator = FastSLAM()
+        rospy.on_shutdown(self.estimator.close)
 
         self.angle_x = 0.0
         self.angle_y = 0.0
@@ -45,8 +51,7 @@ class SLAM(picamera.array.PiMotionAnalysis):
         self.locate_position = False
 
         self.prev_img = None
-        self.prev_kp = None
-        self.prev_des = None
+        self.prev_frame = None
         self.prev_time = None
 
         self.prev_rostime = None
@@ -59,19 +64,26 @@ class SLAM(picamera.array.PiMotionAnalysis):
         self.hybrid_alpha = 0.3  # blend position with first frame and int
 
     def write(self, data):
-        curr_img = np.reshape(np.fromstring(data, dtype=np.uint8), (CAMERA_HEIGHT, CAMERA_WIDTH, 3))
+        self.process(CapturedFrame(data, CAMERA_WIDTH, CAMERA_HEIGHT, self.detector))
+
+    def process(self, captured):
+        """
+        :param captured: the CapturedFrame of the camera image
+        """
+        curr_img = captured.image
         curr_rostime = rospy.Time.now()
         self.posemsg.header.stamp = curr_rostime
         curr_time = curr_rostime.to_sec()
 
         # start SLAM
         if self.locate_position:
-            curr_kp, curr_des = self.detector.detectAndCompute(curr_img, None)
+            curr_kp, curr_des = captured.features(NUM_FEATURES)
+            curr_frame = Frame(curr_kp, curr_des)
 
             if curr_kp is not None and len(curr_kp) != 0:
                 # generate particles for the first time
                 if self.first_locate:
-                    pose = self.estimator.generate_particles(NUM_PARTICLE)
+                    pose = self.estimator.generate_particles(NUM_PARTICLE, MIN_PARTICLE)
                     self.first_locate = False
                     self.pos = pose
 
@@ -86,10 +98,10 @@ class SLAM(picamera.array.PiMotionAnalysis):
                     self.posemsg.pose.orientation.w = w
 
                     self.posepub.publish(self.posemsg)
+                    self.num_particles_pub.publish(self.estimator.particles.num_particles)
                     print 'first', pose
                 else:
-                    pose, weight = self.estimator.run(self.z, self.prev_kp, self.prev_des,
-                                                      curr_kp, curr_des)
+                    pose, weight = self.estimator.run(self.z, self.prev_frame, curr_frame)
 
                     # update position
                     self.pos = [self.hybrid_alpha * pose[0] + (1.0 - self.hybrid_alpha) * self.pos[0],
@@ -108,14 +120,14 @@ class SLAM(picamera.array.PiMotionAnalysis):
                     self.posemsg.pose.orientation.w = w
 
                     self.posepub.publish(self.posemsg)
+                    self.num_particles_pub.publish(self.estimator.particles.num_particles)
                     print '--pose', self.pos[0], self.pos[1], self.pos[3]
                     print '--weight', weight
 
             else:
                 print "CANNOT FIND ANY FEATURES !!!!!"
 
-            self.prev_kp = curr_kp
-            self.prev_des = curr_des
+            self.prev_frame = curr_frame
 
         self.prev_img = curr_img
         self.prev_time = curr_time
@@ -0,0 +1,133 @@
+"""
+relocalization.py
+
+Verifies relocalization candidates on a pool of worker processes
+
+Matching an image against a map cell and estimating the transform to it does not depend on the other cells,
+so the candidate cells are verified in parallel. The map's keypoints and descriptors are copied into shared
+memory once, when the pool starts, so a task only carries the cell's key and the image's features.
+
+Every verify hands out its tasks under a new generation number. Once it has its result it moves the shared
+generation on, so the workers skip the tasks it still had queued instead of verifying stale candidates ahead
+of the next verify's tasks.
+"""
+
+import multiprocessing
+import signal
+import numpy as np
+from matcher_pool import MatcherPool
+
+NUM_WORKERS = max(1, multiprocessing.cpu_count() - 1)
+DES_SIZE = 32
+# stop waiting for the remaining candidates once this many cells matched with at least STRONG_MATCH_COUNT
+ENOUGH_HYPOTHESES = 2
+STRONG_MATCH_COUNT = 40
+
+# state of a worker process, filled in by init_worker
+worker = {}
+
+
+def init_worker(shared_points, shared_descriptors, offsets, locate, generation):
+    """
+    runs once in each worker process, wraps the shared memory in arrays
+    """
+    # let the parent process handle ctrl-c
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    worker['points'] = np.frombuffer(shared_points, dtype=np.float32).reshape(-1, 2)
+    worker['descriptors'] = np.frombuffer(shared_descriptors, dtype=np.uint8).reshape(-1, DES_SIZE)
+    worker['offsets'] = offsets
+    worker['locate'] = locate
+    worker['generation'] = generation
+    worker['matchers'] = MatcherPool()
+
+
+def verify_cell(args):
+    """
+    matches an image against a map cell and computes the pose it gives
+
+    :param args: the generation of the task, the key of the cell, the image's keypoint coordinates and
+                 descriptors and the drone's attitude
+    :return: the key of the cell, the pose or None and the number of good matches
+    """
+    generation, cell, points, descriptors, attitude = args
+    start, end = worker['offsets'][cell]
+
+    # the ratio test needs at least two map features, and the verify the task belongs to may have returned
+    if end - start < 2 or generation != worker['generation'].value:
+        return cell, None, 0
+
+    matches = worker['matchers'].get(cell, worker['descriptors'][start:end]).knnMatch(descriptors, k=2)
+    pose, num = worker['locate'](matches, points, worker['points'][start:end], attitude)
+    return cell, pose, num
+
+
+class Relocalizer(object):
+    """
+    a pool of worker processes holding a map in shared memory
+
+    locate is called in the workers as locate(matches, image_points, cell_points, attitude) and must be a
+    module level function so it can be sent to them
+    """
+
+    def __init__(self, cells, grid_points, grid_descriptors, locate, num_workers=NUM_WORKERS):
+        """
+        :param cells: the keys of the map cells
+        :param grid_points: the N x 2 keypoint coordinates of each cell
+        :param grid_descriptors: the N x DES_SIZE descriptors of each cell
+        :param locate: the function computing a pose from the matches against a cell
+        :param num_workers: the number of worker processes
+        """
+        counts = [len(points) for points in grid_points]
+        bounds = np.concatenate(([0], np.cumsum(counts)))
+        offsets = dict((cell, (bounds[c], bounds[c + 1])) for c, cell in enumerate(cells))
+
+        shared_points = multiprocessing.RawArray('f', max(int(bounds[-1]), 1) * 2)
+        shared_descriptors = multiprocessing.RawArray('B', max(int(bounds[-1]), 1) * DES_SIZE)
+        points = np.frombuffer(shared_points, dtype=np.float32).reshape(-1, 2)
+        descriptors = np.frombuffer(shared_descriptors, dtype=np.uint8).reshape(-1, DES_SIZE)
+        for c in range(len(cells)):
+            if counts[c] != 0:
+                points[bounds[c]:bounds[c + 1]] = grid_points[c]
+                descriptors[bounds[c]:bounds[c + 1]] = grid_descriptors[c]
+
+        # the generation of the tasks of the current verify, tasks of an older one are skipped
+        self.generation = multiprocessing.RawValue('i', 0)
+        self.pool = multiprocessing.Pool(num_workers, init_worker,
+                                         (shared_points, shared_descriptors, offsets, locate, self.generation))
+
+    def verify(self, candidates, points, descriptors, attitude,
+               enough=ENOUGH_HYPOTHESES, strong_match_count=STRONG_MATCH_COUNT):
+        """
+        verifies candidate cells in parallel, returning as soon as enough cells gave a pose with many matches
+
+        :param candidates: the keys of the cells to verify
+        :param points: N x 2 keypoint coordinates of the image
+        :param descriptors: the descriptors of the image
+        :param attitude: the drone's attitude, passed on to locate
+        :param enough: the number of strong hypotheses after which the remaining candidates are not waited for
+        :param strong_match_count: the number of good matches which makes a hypothesis strong
+        :return: a list of (cell, pose, number of good matches) of every cell which gave a pose
+        """
+        points = np.float32(points).reshape(-1, 2)
+        generation = self.generation.value
+        tasks = [(generation, cell, points, descriptors, attitude) for cell in candidates]
+
+        hypotheses = []
+        strong = 0
+        for cell, pose, num in self.pool.imap_unordered(verify_cell, tasks):
+            if pose is not None:
+                hypotheses.append((cell, pose, num))
+                if num >= strong_match_count:
+                    strong += 1
+                    if strong >= enough:
+                        break
+
+        # the tasks still queued are skipped
+        self.generation.value = generation + 1
+
+        return hypotheses
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
@@ -0,0 +1,124 @@
+"""
+resampling.py
+
+Resampling schemes shared by the particle filters
+
+Each scheme takes normalized weights and returns the indices of the particles to keep, sorted, so a filter
+gathers its new particle set with a single fancy index instead of copying particles one at a time.
+Systematic and stratified resampling draw one sample per stratum of the weights' cumulative sum, and
+residual resampling keeps floor(N * w) copies of each particle deterministically, which all give a lower
+variance than multinomial resampling for the same number of particles.
+"""
+
+import numpy as np
+
+# resample when the effective sample size drops below this fraction of the number of particles
+ESS_THRESHOLD = 0.5
+
+
+def systematic(weights, num_samples=None):
+    """
+    low variance resampling, draws num_samples evenly spaced samples from the cumulative weights with a
+    single random offset
+
+    :param weights: the normalized weights of the particles
+    :param num_samples: the number of particles to draw, defaults to the number of weights
+    :return: the sorted array of the indices of the drawn particles
+    """
+    num_samples = len(weights) if num_samples is None else num_samples
+    positions = (np.random.random_sample() + np.arange(num_samples)) / num_samples
+    return search(weights, positions)
+
+
+def stratified(weights, num_samples=None):
+    """
+    draws one sample with its own random offset from each of num_samples equal strata of the cumulative weights
+
+    :param weights: the normalized weights of the particles
+    :param num_samples: the number of particles to draw, defaults to the number of weights
+    :return: the sorted array of the indices of the drawn particles
+    """
+    num_samples = len(weights) if num_samples is None else num_samples
+    positions = (np.random.random_sample(num_samples) + np.arange(num_samples)) / num_samples
+    return search(weights, positions)
+
+
+def residual(weights, num_samples=None):
+    """
+    keeps floor(num_samples * w) copies of each particle, and draws the remaining particles from the leftover
+    weights with systematic resampling
+
+    :param weights: the normalized weights of the particles
+    :param num_samples: the number of particles to draw, defaults to the number of weights
+    :return: the sorted array of the indices of the drawn particles
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    num_samples = len(weights) if num_samples is None else num_samples
+
+    copies = np.floor(num_samples * weights).astype(np.int64)
+    kept = np.repeat(np.arange(len(weights)), copies)
+
+    num_residual = num_samples - len(kept)
+    if num_residual == 0:
+        return kept
+
+    residuals = num_samples * weights - copies
+    drawn = systematic(residuals / np.sum(residuals), num_residual)
+    return np.sort(np.concatenate((kept, drawn)))
+
+
+def multinomial(weights, num_samples=None):
+    """
+    draws num_samples independent samples from the weights
+
+    :param weights: the normalized weights of the particles
+    :param num_samples: the number of particles to draw, defaults to the number of weights
+    :return: the sorted array of the indices of the drawn particles
+    """
+    num_samples = len(weights) if num_samples is None else num_samples
+    return np.repeat(np.arange(len(weights)), np.random.multinomial(num_samples, weights))
+
+
+def search(weights, positions):
+    """
+    :param weights: the normalized weights of the particles
+    :param positions: sorted positions in [0, 1)
+    :return: the index of the particle whose interval of the cumulative weights holds each position
+    """
+    cumulative = np.cumsum(weights)
+    # guard against the sum of the weights rounding to slightly less than 1
+    cumulative[-1] = 1.0
+    return np.searchsorted(cumulative, positions, side='right')
+
+
+def effective_sample_size(weights):
+    """
+    :param weights: the normalized weights of the particles
+    :return: 1 / sum(w^2), the number of equally weighted particles the weights are worth
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    return 1.0 / np.sum(weights ** 2)
+
+
+def needs_resampling(weights, threshold=ESS_THRESHOLD):
+    """
+    :param weights: the normalized weights of the particles
+    :param threshold: the fraction of the number of particles below which the effective sample size is too low
+    :return: True if the weights have degenerated enough that the particles should be resampled
+    """
+    return effective_sample_size(weights) < threshold * len(weights)
+
+
+def resample(weights, scheme=systematic, threshold=ESS_THRESHOLD):
+    """
+    resamples the particles if their effective sample size is too low
+
+    :param weights: the normalized weights of the particles
+    :param scheme: the resampling function to use
+    :param threshold: see needs_resampling, a threshold above 1 always resamples
+    :return: the indices of the new particles, or None if resampling was skipped
+    """
+    if not needs_resampling(weights, threshold):
+        return None
+
+    return scheme(weights)
@@ -7,10 +7,15 @@ Implements fastSLAM for the pidrone
 import numpy as np
 import math
 import utils
-import copy
-import cv2
-import threading
-from thread_queue import ThreadQueue
+import guided_matching
+import resampling
+import kld_sampling
+import landmark_budget
+import log_weights
+from collections import namedtuple
+from landmark_map import LandmarkMap
+from map_updater import MapUpdater
+from matchers import create_matcher
 
 # set one these to true to save the poses or weights from the flight
 POSE  = False
@@ -26,54 +31,203 @@ MATCH_RATIO = 0.7
 PROB_THRESHOLD = 0.005
 KEYFRAME_DIST_THRESHOLD = CAMERA_HEIGHT
 KEYFRAME_YAW_THRESHOLD = 0.175
+# the filter is lost when even its best particle matched less than this share of the observed features
+LOST_MATCH_RATIO = 0.1
 
 # ----- edit to where you want the pose data written --------- #
 pose_path = '/home/luke/ws/src/pidrone_pkg/scripts/pose_data.txt'
 
 
-class Particle:
+class ParticleSet(object):
     """
+    holds every particle of the filter in arrays indexed by particle, so that the motion update,
+    pose estimate and resampling run as array operations rather than per-particle python code
+
+    the landmarks live in a copy-on-write LandmarkMap, so particles produced by resampling share the
+    landmarks of their parent until they change them. landmarks are addressed by ids into the shared
+    lm_pos, lm_cov, lm_des and lm_counter arrays
+
     attributes:
-    robot_position: a list of the robot's position (x, y, z, yaw)
-    landmarks:      a list of landmark objects
-    descriptors:    a list of feature descriptors for each landmark
-    weight:         the current weight for the particle
+    poses:   num_particles x 4 array of the robots' positions (x, y, z, yaw)
+    weights: the log weight of each particle
+    maps:    the LandmarkMap holding each particle's landmarks
     """
 
-    def __init__(self, x, y, z, yaw):
-        self.pose = [x, y, z, yaw]
-        self.landmarks = []
-        self.weight = PROB_THRESHOLD
+    def __init__(self, poses, maps=None):
+        self.num_particles = len(poses)
+        self.poses = np.array(poses, dtype=np.float64).reshape(self.num_particles, 4)
+        self.weights = np.zeros(self.num_particles)
+        self.maps = maps if maps is not None else LandmarkMap(self.num_particles)
 
     def __str__(self):
-        return "Pose: " + str(self.pose) + " Weight: " + str(self.weight)
+        return "Poses: " + str(self.poses) + " Weights: " + str(self.weights)
+
+    @property
+    def lm_pos(self):
+        return self.maps.pool.pos
+
+    @property
+    def lm_cov(self):
+        return self.maps.pool.cov
+
+    @property
+    def lm_des(self):
+        return self.maps.pool.des
+
+    @property
+    def lm_counter(self):
+        return self.maps.pool.counter
+
+    def landmarks(self, i):
+        """
+        :param i: the index of the particle
+        :return: the ids of particle i's landmarks
+        """
+        return self.maps.landmarks(i)
+
+    def has_landmarks(self, i):
+        """
+        :param i: the index of the particle
+        :return: True if particle i holds any landmark
+        """
+        return len(self.maps.blocks(i)) != 0
+
+    def landmarks_near(self, i, radius):
+        """
+        uses the spatial index of particle i's map to find the landmarks within radius of the particle
+
+        :param i: the index of the particle
+        :param radius: the range to search in
+        :return: the ids of the landmarks in range
+        """
+        x, y = self.poses[i, 0], self.poses[i, 1]
+        candidates = self.maps.near(i, x, y, radius)
+
+        lm_pos = self.lm_pos[candidates]
+        return candidates[np.hypot(lm_pos[:, 0] - x, lm_pos[:, 1] - y) <= radius]
+
+    def num_landmarks(self):
+        """
+        :return: the number of landmarks held by each particle
+        """
+        return self.maps.num_landmarks()
+
+    def writable_landmarks(self, i, ids):
+        """
+        must be called before changing landmarks, copies the landmarks which particle i shares with others
+
+        :param i: the index of the particle
+        :param ids: the ids of the landmarks which are about to change
+        :return: the ids to write the changed landmarks to
+        """
+        return self.maps.writable(i, ids)
+
+    def add_landmarks(self, i, pos, cov, des):
+        """
+        stores new landmarks in particle i's map
+
+        :param i: the index of the particle
+        :param pos, cov, des: the positions, covariances and descriptors of the new landmarks
+        :return: the ids of the new landmarks
+        """
+        return self.maps.add(i, pos, cov, des)
+
+    def remove_landmarks(self, i, ids):
+        """
+        removes landmarks from particle i's map
+
+        :param i: the index of the particle
+        :param ids: the ids of the landmarks to remove
+        """
+        self.maps.remove(i, ids)
+
+    def select(self, indices):
+        """
+        gathers a new particle set from the particles at indices, particles may be repeated
+        the new set shares the landmarks of this set until either of them changes a landmark
+
+        :param indices: an array of particle indices
+        :return: a new ParticleSet
+        """
+        new = ParticleSet(self.poses[indices], self.maps.select(indices))
+        new.weights = self.weights[indices]
+
+        return new
+
+    def copy(self):
+        return self.select(np.arange(self.num_particles))
+
+    def take_maps(self, other):
+        """
+        replaces the landmarks of this set with those of other and adds other's weights to this set's, keeping
+        the current poses
+
+        :param other: a ParticleSet with the same number of particles, which must not be used afterwards
+        """
+        self.maps.release()
+        self.maps = other.maps
+        self.weights = self.weights + other.weights
+
+    def release(self):
+        """
+        gives up this set's landmarks, the set must not be used afterwards
+        """
+        self.maps.release()
+
+    def get_landmarks(self, i):
+        """
+        :param i: the index of the particle
+        :return: the landmarks of particle i as a list of landmark objects
+        """
+        return [utils.Landmark(self.lm_pos[l, 0], self.lm_pos[l, 1], self.lm_cov[l].copy(),
+                               self.lm_des[l].copy(), self.lm_counter[l]) for l in self.landmarks(i)]
 
 
 class FastSLAM:
+    # print the average number of landmarks per particle on every run, for debugging
+    verbose = False
+
     def __init__(self):
         self.particles = None
-        self.num_particles = None
-        self.weight = PROB_THRESHOLD
+        # the bounds of the number of particles, which follows the uncertainty of the belief
+        self.min_particles = None
+        self.max_particles = None
+        self.weight = 0.0
+        # the number of features observed in the keyframes whose evidence is in the weights, and the most of them
+        # any one particle matched to its landmarks
+        self.observed_features = 0
+        self.matched_features = 0
 
         self.z = 0
         self.perceptual_range = 0.0
+        # the most landmarks each particle keeps
+        self.max_landmarks = landmark_budget.MAX_LANDMARKS
 
-        # key points and descriptors from the most recent keyframe
-        self.key_kp = None
-        self.key_des = None
+        # the Frame of the most recent keyframe
+        self.key_frame = None
+
+        # the transforms from the previous frame and from the keyframe to the most recent frame, used to
+        # predict where the keypoints of the next frame are
+        self.frame_transform = None
+        self.key_transform = None
 
         if POSE or WEIGHT:
             self.file = open(pose_path, 'w')
 
-        # we will queue threads here, and they will store their results in most_recent_map and set new_result to True
-        self.thread_queue = ThreadQueue()
-        self.most_recent_map = None
-        self.new_result = False
+        # map updates run on a pool of worker processes, created on the first keyframe
+        # update_context holds the snapshot being updated, and pending_keyframe the poses, measurements and
+        # descriptors of the newest keyframe which arrived while the workers were busy, its snapshot is only
+        # taken once the running update has been merged, so it holds that update's landmarks
+        # the lineages hold the index of the snapshot particle each current particle descends from, as the
+        # particles may be resampled while an update runs
+        self.map_updater = None
+        self.update_context = None
+        self.pending_keyframe = None
+        self.update_lineage = None
+        self.pending_lineage = None
 
         # --------------- openCV parameters --------------------- #
-        index_params = dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1)
-        search_params = dict(checks=50)
-        self.matcher = cv2.FlannBasedMatcher(index_params, search_params)
+        self.matcher = create_matcher()
 
         # ------- parameters for noise on observations ----------- #
         self.sigma_d = 3
@@ -90,52 +244,65 @@ class FastSLAM:
                                            [0, 0, sigma_vz ** 2, 0],
                                            [0, 0, 0, sigma_yaw ** 2]])
 
-    def generate_particles(self, num_particles):
+    def generate_particles(self, num_particles, min_particles=None):
         """
         Creates the initial set of particles for SLAM
         Each particle starts at (0,0) since we build the map relative to the drone's
         initial position, but with some noise
 
-        :param num_particles: the number of particles to generate
+        :param num_particles: the number of particles to generate, and the most the filter will use
+        :param min_particles: the fewest particles the filter will use, by default the number stays fixed
         """
-        self.particles = [Particle(abs(utils.normal(0, 0.1)),
-                                   abs(utils.normal(0, 0.1)),
-                                   self.z,
-                                   abs(utils.normal(math.pi, 0.01))) for _ in range(num_particles)]
+        poses = np.empty((num_particles, 4))
+        poses[:, 0] = np.abs(np.random.normal(0, 0.1, num_particles))
+        poses[:, 1] = np.abs(np.random.normal(0, 0.1, num_particles))
+        poses[:, 2] = self.z
+        poses[:, 3] = np.abs(np.random.normal(math.pi, 0.01, num_particles))
+        self.particles = ParticleSet(poses)
 
         # Reset SLAM variables in case of restart
-        self.num_particles = num_particles
-        self.key_kp, self.key_des, self.most_recent_map = None, None, None
-        self.new_result = False
-        self.weight = PROB_THRESHOLD
+        self.max_particles = num_particles
+        self.min_particles = min_particles if min_particles is not None else num_particles
+        self.key_frame = None
+        self.frame_transform, self.key_transform = None, None
+        # the workers are kept for the new particles, only the running update is thrown away
+        if self.map_updater is not None:
+            self.map_updater.cancel()
+        self.update_context, self.pending_keyframe = None, None
+        self.update_lineage, self.pending_lineage = None, None
+        self.weight = 0.0
+        self.observed_features = 0
+        self.matched_features = 0
 
         return estimate_pose(self.particles)
 
-    def run(self, z, prev_kp, prev_des, kp, des):
+    def run(self, z, prev_frame, frame):
         """
         applies an iteration of the FastSLAM algorithm
 
         :param z: the new infrared height estimate for the drone
-        :param prev_kp, prev_des: are the keypoints and descriptors from the previous frame
-        :param kp, des: the current keypoints and descriptors
+        :param prev_frame: the Frame of the previous camera image
+        :param frame: the Frame of the current camera image
         """
 
         # print the average number of landmarks per particles
-        print "LM: ", np.sum([len(p.landmarks) for p in self.particles]) / float(self.num_particles)
+        if self.verbose:
+            print "LM: ", np.mean(self.particles.num_landmarks())
 
         # write poses to a text file to be animated
         if POSE:
-            for p in self.particles:
-                self.file.write(str(p.pose[0]) + '\n')
-                self.file.write(str(p.pose[1]) + '\n')
+            for pose in self.particles.poses:
+                self.file.write(str(pose[0]) + '\n')
+                self.file.write(str(pose[1]) + '\n')
 
         self.z = z
 
         # reflect that the drone can see more or less if its height changes
         self.update_perceptual_range()
 
-        # compute transformation from previous frame
-        transform = utils.compute_transform(self.matcher, prev_kp, prev_des, kp, des)
+        # compute transformation from previous frame, assuming the drone keeps moving as it did
+        transform = utils.compute_transform(prev_frame, frame, self.frame_transform)
+        self.frame_transform = transform
 
         if transform is not None:
             x = -transform[0, 2]
@@ -143,62 +310,65 @@ class FastSLAM:
             yaw = -np.arctan2(transform[1, 0], transform[0, 0])
 
             # update poses with motion prediction
-            for p in self.particles:
-                self.predict_particle(p, x, y, yaw)
+            self.predict_particles(x, y, yaw)
 
             # (potentially) do a map update
-            self.detect_keyframe(kp, des)
-
-            # replace particles with updated ones if a thread has completed
-            if self.new_result:
-                self.new_result = False
+            self.detect_keyframe(frame)
 
-                most_recent_particles = self.most_recent_map
-                for old, new in zip(self.particles, most_recent_particles):
-                    old.landmarks = new.landmarks
-                    old.weight = new.weight
+            # replace particles with updated ones if a map update has completed
+            updated = self.collect_map_update()
+            if updated is not None:
+                self.particles.take_maps(updated)
 
                 # write the weights to a text file to be animated
                 if WEIGHT:
-                    self.file.write(str([p.weight for p in self.particles]) + '\n')
+                    self.file.write(str(self.particles.weights.tolist()) + '\n')
 
                 # update the weight and resample
                 self.weight = self.get_average_weight()
                 self.resample_particles()
 
+                # the keyframe which waited for this update is updated on the merged maps
+                self.begin_pending_update()
+
         return estimate_pose(self.particles), self.weight
 
-    def predict_particle(self, particle, x, y, yaw):
+    def predict_particles(self, x, y, yaw):
         """
-        updates this particle's position according to the transformation from prev frame to this one
+        updates every particle's position according to the transformation from prev frame to this one
 
-        the robot's new position is determined based on the control, with
-        added noise to account for control error
+        the robots' new positions are determined based on the control, with
+        added noise drawn separately for each particle to account for control error
 
-        :param particle:  the particle containing the robot's position information
         :param x, y, yaw: the "controls" computed by transforming the previous camera frame to this one
         """
 
-        noisy_x_y_z_yaw = np.random.multivariate_normal([x, y, self.z, yaw], self.covariance_motion)
+        noisy_x_y_z_yaw = np.random.multivariate_normal([x, y, self.z, yaw], self.covariance_motion,
+                                                        self.particles.num_particles)
 
-        particle.pose[0] += self.pixel_to_meter(noisy_x_y_z_yaw[0])
-        particle.pose[1] += self.pixel_to_meter(noisy_x_y_z_yaw[1])
-        particle.pose[2] = self.z
-        particle.pose[3] += noisy_x_y_z_yaw[3]
-        particle.pose[3] = utils.adjust_angle(particle.pose[3])
+        poses = self.particles.poses
+        poses[:, 0] += self.pixel_to_meter(noisy_x_y_z_yaw[:, 0])
+        poses[:, 1] += self.pixel_to_meter(noisy_x_y_z_yaw[:, 1])
+        poses[:, 2] = self.z
+        poses[:, 3] = utils.adjust_angle(poses[:, 3] + noisy_x_y_z_yaw[:, 3])
 
-    def detect_keyframe(self, kp, des):
+    def detect_keyframe(self, frame):
         """
         Checks if there is a previous keyframe, and if not, starts  a new one. If the distance between the
-        previous keyframe and the current frame is above a threshold, starts a map update thread. Or, if
-        we cannot transform between the previous keyframe and this frame, also starts a map update thread.
+        previous keyframe and the current frame is above a threshold, starts a map update. Or, if
+        we cannot transform between the previous keyframe and this frame, also starts a map update.
 
-        :param kp, des: the lists of keypoints and descriptors
+        :param frame: the Frame of the current camera image
         """
         # there is some previous keyframe
-        if self.key_kp is not None and self.key_des is not None:
+        if self.key_frame is not None:
 
-            transform = utils.compute_transform(self.matcher, self.key_kp, self.key_des, kp, des)
+            predicted = None
+            if self.key_transform is not None:
+                predicted = guided_matching.compose(self.frame_transform, self.key_transform)
+
+            transform = utils.compute_transform(self.key_frame, frame, predicted)
+            self.key_transform = transform
 
             if transform is not None:
                 # distance since previous keyframe
@@ -208,124 +378,241 @@ class FastSLAM:
 
                 if utils.distance(x, y, 0, 0) > self.pixel_to_meter(KEYFRAME_DIST_THRESHOLD) \
                         or yaw > KEYFRAME_YAW_THRESHOLD:
-                    self.start_update_thread(kp, des)
+                    self.start_map_update(frame)
             else:
                 # moved too far to transform from last keyframe, so set a new one
-                self.start_update_thread(kp, des)
+                self.start_map_update(frame)
         # there is no previous keyframe
         else:
-            self.start_update_thread(kp, des)
+            self.start_map_update(frame)
 
-    def start_update_thread(self, kp, des):
+    def start_map_update(self, frame):
         """
-        starts a thread to update the map
+        starts a map update on the worker processes, without waiting for it to finish
+        if an update is already running, the keyframe waits until it has finished, replacing any older
+        keyframe which was waiting
 
-        :param kp, des: the lists of keypoints and descriptors
+        :param frame: the Frame of the keyframe
         """
-        t = threading.Thread(target=self.update_map, args=(kp, des,))
-        self.thread_queue.add_thread(t)
+        if self.map_updater is None:
+            self.map_updater = MapUpdater(create_matcher)
+
+        measurements = self.kp_to_measurement(np.float64(frame.points))
+
+        if self.map_updater.busy():
+            # the keyframe was observed from the current poses, the maps are taken once the running update
+            # has been merged into them
+            self.pending_keyframe = (self.particles.poses.copy(), measurements, frame.des)
+            self.pending_lineage = np.arange(self.particles.num_particles)
+        else:
+            # the update owns the snapshot until its result is merged
+            self.begin_map_update(self.snapshot(), measurements, frame.des)
+            self.update_lineage = np.arange(self.particles.num_particles)
 
-        # set the new keyframe kp and des to the current ones
-        self.key_kp, self.key_des = kp, des
+        # the current frame is the new keyframe
+        self.key_frame = frame
+        self.key_transform = guided_matching.IDENTITY
 
-    def update_map(self, kp, des):
+    def snapshot(self):
         """
-        updates the map and gets the average weight of the particles, then stores those results
+        :return: a copy of the particles for a map update, with zero weights so the copy only collects the
+                 evidence of the update, which is added to the particles when the update is merged
+        """
+        particles = self.particles.copy()
+        particles.weights[:] = 0.0
+        return particles
 
-        :param kp, des: the lists of keypoints and descriptors
+    def begin_map_update(self, particles, measurements, des):
         """
-        # save a copy of the particles at this time to avoid conflicts
-        curr_particles = copy.deepcopy(self.particles)
+        hands the landmarks around each particle to the workers
 
-        for p in curr_particles:
-            self.update_particle(p, kp, des)
+        :param particles: the snapshot of the particles to update
+        :param measurements: the (range, bearing) of each keypoint of the keyframe
+        :param des: the array of descriptors of the keyframe
+        """
+        tasks, close_ids = self.gather_tasks(particles)
+        self.map_updater.start(associate_landmarks, tasks, measurements, des, (self.sigma_observation,))
+        self.update_context = (particles, close_ids, des)
 
-        self.most_recent_map = curr_particles
-        self.new_result = True
+    def collect_map_update(self):
+        """
+        applies the result of a finished map update to its snapshot, once it is merged into the particles
+        begin_pending_update starts the update of the keyframe which was waiting for it
 
-    def update_particle(self, particle, keypoints, descriptors):
+        :return: the updated snapshot lined up with the current particles, or None if no update has finished
         """
-        Associate observed keypoints with an old particle's landmark set and update the EKF
-        Increment the landmark's counter if it finds a match, otherwise add a new landmark
-        Decrement the counter of a landmark which is close to this particle's pose and not observed
+        if self.map_updater is None or not self.map_updater.ready():
+            return None
 
-        :param particle: the old particle to perform the data association on
-        :param keypoints, descriptors: the lists of currently observed keypoints and descriptors
+        particles, close_ids, des = self.update_context
+        lineage = self.update_lineage
+        self.update_context, self.update_lineage = None, None
+        self.apply_updates(particles, close_ids, self.map_updater.results(), des)
+
+        # the particles were resampled while the update ran
+        if len(lineage) != particles.num_particles or np.any(lineage != np.arange(len(lineage))):
+            resampled = particles.select(lineage)
+            particles.release()
+            return resampled
+
+        return particles
+
+    def begin_pending_update(self):
+        """
+        starts the update of the keyframe which waited for the last update, on the current maps and the poses
+        the keyframe was observed from
         """
+        if self.pending_keyframe is None:
+            return
 
-        particle.weight = PROB_THRESHOLD
+        poses, measurements, des = self.pending_keyframe
+        particles = self.snapshot()
+        particles.poses[:] = poses[self.pending_lineage]
+        self.begin_map_update(particles, measurements, des)
 
-        # if this particle has no landmarks, make all measurements into landmarks
-        if len(particle.landmarks) == 0:
-            for kp, des in zip(keypoints, descriptors):
-                utils.add_landmark(particle, kp, des, self.sigma_observation, self.kp_to_measurement)
-                particle.weight += math.log(PROB_THRESHOLD)
-        else:
-            # find particle's landmarks in a close range, close_landmarks holds tuples of the landmark and its index
-            close_landmarks = []
-            for i, lm in enumerate(particle.landmarks):
-                if utils.distance(lm.x, lm.y, particle.pose[0], particle.pose[1]) <= self.perceptual_range * 1.2:
-                    close_landmarks.append((lm, i))
-
-            part_descriptors, matched_landmarks = None, None
-            if len(close_landmarks) != 0:
-                # get the descriptors of relevant landmarks
-                part_descriptors = [lm[0].des for lm in close_landmarks]
-
-                # we will set to true indices where a landmark is matched
-                matched_landmarks = [False] * len(close_landmarks)
-
-            for kp, des in zip(keypoints, descriptors):
-                # length 1 list of the most likely match between this descriptor and all the particle's descriptors
-                match = None
-                if part_descriptors is not None:
-                    match = self.matcher.knnMatch(np.array([des]), np.array(part_descriptors), k=2)
-
-                # there was no match (short circuiting!)
-                if match is None or len(match) < 2 or match[0].distance > MATCH_RATIO * match[1].distance:
-                    utils.add_landmark(particle, kp, des, self.sigma_observation, self.kp_to_measurement)
-
-                    # 'punish' this particle since new landmarks decrease certainty
-                    particle.weight += math.log(PROB_THRESHOLD)
-                else:
-                    # get the index of the matched landmark in close_landmarks
-                    close_index = match[0].trainIdx
-                    matched_landmarks[close_index] = True
-                    dated_landmark = close_landmarks[close_index]
-
-                    # update the original landmark in this particle
-                    updated_landmark = utils.update_landmark(particle, dated_landmark[0], kp, des,
-                                                             self.sigma_observation, self.kp_to_measurement)
-                    particle.landmarks[dated_landmark[1]] = updated_landmark
-
-                    # 'reward' this particles since revisiting landmarks increases certainty
-                    particle.weight += math.log(scale_weight(match[0].distance, match[1].distance))
-
-            if matched_landmarks is not None:
-                # increment counter for revisited particles, and decrement counter for non-revisited particles
-                removed = []
-                for i, match in enumerate(matched_landmarks):
-                    tup = close_landmarks[i]
-                    lm = particle.landmarks[tup[1]]
-                    if match:
-                        lm.counter += 1
-                    else:
-                        lm.counter -= 1
-                        # 'punish' this particle for having a dubious landmark
-                        particle.weight += math.log(0.1*PROB_THRESHOLD)
-                        if lm.counter < 0:
-                            removed.append(lm)
-
-                for rm in removed:
-                    particle.landmarks.remove(rm)
+        self.update_lineage = np.arange(particles.num_particles)
+        self.pending_keyframe, self.pending_lineage = None, None
+
+    def update_map(self, particles, frame):
+        """
+        updates the map of every particle for a keyframe in this process
+
+        :param particles: the particles to update
+        :param frame: the Frame of the keyframe
+        """
+        # the measurements only depend on the height, so they are shared by every particle
+        measurements = self.kp_to_measurement(np.float64(frame.points))
+
+        tasks, close_ids = self.gather_tasks(particles)
+        updates = [associate_landmarks(self.matcher, task, measurements, frame.des, (self.sigma_observation,))
+                   for task in tasks]
+        self.apply_updates(particles, close_ids, updates, frame.des)
+
+    def gather_tasks(self, particles):
+        """
+        collects the landmarks in range of each particle, which is all a worker needs to update the particle
+
+        :param particles: the particles to update
+        :return: the list of tasks for associate_landmarks and the list of ids of each particle's close landmarks
+        """
+        tasks = []
+        close_ids = []
+        for i in range(particles.num_particles):
+            close_landmarks = particles.landmarks_near(i, self.perceptual_range * 1.2)
+
+            tasks.append((particles.poses[i, :2].copy(), particles.lm_pos[close_landmarks],
+                          particles.lm_cov[close_landmarks], particles.lm_des[close_landmarks]))
+            close_ids.append(close_landmarks)
+
+        return tasks, close_ids
+
+    def apply_updates(self, particles, close_ids, updates, descriptors):
+        """
+        writes the result of associate_landmarks into each particle's map
+
+        :param particles: the particles which were updated
+        :param close_ids: the ids of each particle's close landmarks, from gather_tasks
+        :param updates: the ParticleUpdate of each particle
+        :param descriptors: the array of currently observed descriptors
+        """
+        # when no particle has landmarks nearby, as on the first keyframe, every particle gets the same penalty
+        # for all features being new, which tells the particles apart no more than it tells whether they are lost
+        evidence = any(len(close_landmarks) != 0 for close_landmarks in close_ids)
+
+        for i, (close_landmarks, update) in enumerate(zip(close_ids, updates)):
+            # every close landmark's counter changes, so take a private copy of the ones shared with others
+            close_landmarks = particles.writable_landmarks(i, close_landmarks)
+
+            # update the original landmarks in this particle
+            updated_ids = close_landmarks[update.updated]
+            particles.lm_pos[updated_ids] = update.pos
+            particles.lm_cov[updated_ids] = update.cov
+            particles.lm_des[updated_ids] = descriptors[update.features]
+
+            # increment counter for revisited particles, and decrement counter for non-revisited particles
+            particles.lm_counter[close_landmarks[update.matched]] += 1
+            missed = close_landmarks[~update.matched]
+            particles.lm_counter[missed] -= 1
+            particles.remove_landmarks(i, missed[particles.lm_counter[missed] < 0])
+
+            # a new landmark which duplicates a close landmark is one more observation of it, not a new landmark
+            new_features, new_pos, new_cov = update.new_features, update.new_pos, update.new_cov
+            if len(new_features) != 0:
+                close_landmarks = close_landmarks[particles.maps.pool.used[close_landmarks]]
+                duplicates, originals = landmark_budget.find_duplicates(new_pos, descriptors[new_features],
+                                                                        particles.lm_pos[close_landmarks],
+                                                                        particles.lm_des[close_landmarks])
+                if len(duplicates) != 0:
+                    merged = close_landmarks[originals]
+                    particles.lm_pos[merged], particles.lm_cov[merged] = landmark_budget.fuse(
+                        particles.lm_pos[merged], particles.lm_cov[merged], new_pos[duplicates], new_cov[duplicates])
+                    particles.lm_counter[merged] += 1
+                    updated_ids = np.union1d(updated_ids, merged)
+
+                    unique = np.setdiff1d(np.arange(len(new_features)), duplicates)
+                    new_features, new_pos, new_cov = new_features[unique], new_pos[unique], new_cov[unique]
+
+            # keep the spatial index right for landmarks the update moved into another grid cell
+            particles.maps.relocate(i, updated_ids)
+
+            if len(new_features) != 0:
+                particles.add_landmarks(i, new_pos, new_cov, descriptors[new_features])
+
+            self.evict_landmarks(particles, i)
+
+            # weights are log likelihoods, so the evidence of each keyframe since the last resampling adds up
+            if evidence:
+                particles.weights[i] += update.weight
+
+        if evidence:
+            self.observed_features += len(descriptors)
+            self.matched_features += max(len(update.features) for update in updates)
+
+    def evict_landmarks(self, particles, i):
+        """
+        once particle i holds more than max_landmarks, evicts the landmarks worth the least, the landmarks in
+        the particle's perceptual range are kept since they were just observed
+
+        :param particles: the particles
+        :param i: the index of the particle
+        """
+        landmarks = particles.landmarks(i)
+        if len(landmarks) <= self.max_landmarks:
+            return
+
+        close_landmarks = particles.landmarks_near(i, self.perceptual_range * 1.2)
+        candidates = np.setdiff1d(landmarks, close_landmarks)
+        evicted = landmark_budget.evictions(particles.lm_counter[candidates], particles.lm_cov[candidates],
+                                            max(self.max_landmarks - len(close_landmarks), 0))
+        particles.remove_landmarks(i, candidates[evicted])
+
+    def close(self):
+        """
+        stops the map update workers, a running update is thrown away
+        """
+        if self.map_updater is not None:
+            self.map_updater.close()
+            self.map_updater = None
+        self.update_context, self.pending_keyframe = None, None
 
     def get_average_weight(self):
         """
-        the average weight of all the particles
+        the average log weight of all the particles
+        """
+        return np.mean(self.particles.weights)
+
+    def is_lost(self):
+        """
+        :return: True if even the best particle matched few of the features observed since the last resampling
+                 to its landmarks, so the maps no longer explain what the camera sees
+        """
+        return self.observed_features != 0 and self.matched_features < LOST_MATCH_RATIO * self.observed_features
 
-        :param particles: the set of particles whose weight will be averaged
+    def get_effective_sample_size(self):
         """
-        return np.sum([p.weight for p in self.particles]) / float(self.num_particles)
+        the number of equally weighted particles the current weights are worth
+        """
+        return log_weights.effective_sample_size(self.particles.weights)
 
     def pixel_to_meter(self, px):
         """
@@ -335,24 +622,19 @@ class FastSLAM:
         """
         return px * self.z / CAMERA_SCALE
 
-    def kp_to_measurement(self, kp):
+    def kp_to_measurement(self, points):
         """
-        Computes the range and bearing from the center of the camera frame to (kp.x, kp.y)
-        bearing is in (-pi/2, pi/2) measured in the standard math way
+        Computes the range and bearing from the center of the camera frame to each keypoint (x, y)
+        bearing is measured in the standard math way
 
-        :param kp: they keypoint to measure from
+        :param points: N x 2 array of the keypoints' pixel coordinates
+        :return: N x 2 array of (range, bearing)
         """
-        kp_x, kp_y = kp.pt[0], kp.pt[1]
         # key point y is measured from the top left
-        kp_y = CAMERA_HEIGHT - kp_y
-
-        dx = kp_x - CAMERA_WIDTH / 2
-        dy = kp_y - CAMERA_HEIGHT / 2
-        dist = math.sqrt(math.pow(dx, 2) + math.pow(dy, 2))
-        dist = self.pixel_to_meter(dist)
-        bearing = math.atan2(dy, dx)
+        dx = points[:, 0] - CAMERA_WIDTH / 2
+        dy = (CAMERA_HEIGHT - points[:, 1]) - CAMERA_HEIGHT / 2
 
-        return dist, bearing
+        return np.column_stack((self.pixel_to_meter(np.hypot(dx, dy)), np.arctan2(dy, dx)))
 
     def update_perceptual_range(self):
         """
@@ -363,87 +645,122 @@ class FastSLAM:
 
     def resample_particles(self):
         """
-        resample particles according to their weight
+        resample particles according to their weight with low variance resampling, gathering the new set with
+        a single index array, the particles are kept as they are while their weights have not degenerated
 
-        :param particles: the set of particles to resample
-        :return: a new set of particles, resampled with replacement according to their weight
+        the number of particles is chosen with KLD-sampling, growing to the maximum when the filter is lost
         """
+        weights = log_weights.normalize(self.particles.weights)
+        if not self.is_lost():
+            indices = kld_sampling.resample(weights, self.particles.poses, self.min_particles, self.max_particles)
+        elif self.particles.num_particles != self.max_particles:
+            indices = resampling.systematic(weights, self.max_particles)
+        else:
+            indices = resampling.resample(weights)
 
-        weight_sum = 0.0
-        new_particles = []
-        normal_weights = np.array([])
+        if indices is None:
+            return
 
-        weights = [p.weight for p in self.particles]
-        lowest_weight = min(weights)
+        old_particles = self.particles
+        self.particles = old_particles.select(indices)
+        old_particles.release()
 
-        for w in weights:
-            x = 1 - (w / lowest_weight)
-            if x == 0:
-                x = PROB_THRESHOLD
-            normal_weights = np.append(normal_weights, x)
-            weight_sum += x
+        # the resampled particles are equally likely
+        self.particles.weights[:] = 0.0
+        self.observed_features = 0
+        self.matched_features = 0
 
-        normal_weights /= weight_sum
-        samples = np.random.multinomial(self.num_particles, normal_weights)
-        for i, count in enumerate(samples):
-            for _ in range(count):
-                new_particles.append(copy.deepcopy(self.particles[i]))
+        # map updates which are still running were started from particles before this resampling
+        if self.update_lineage is not None:
+            self.update_lineage = self.update_lineage[indices]
+        if self.pending_lineage is not None:
+            self.pending_lineage = self.pending_lineage[indices]
 
-        self.particles = new_particles
 
+# the changes associate_landmarks computes for one particle, indices refer to the particle's close landmarks
+# and to the observed features
+ParticleUpdate = namedtuple('ParticleUpdate', ['weight', 'matched', 'updated', 'features', 'pos', 'cov',
+                                               'new_features', 'new_pos', 'new_cov'])
 
-def scale_weight(match0, match1):
-    """
-    uses the distances of the two best matches to provide a weight scaled between 0 and 1
 
-    :param match0: the hamming distance of the first best match
-    :param match1: the hamming distance of the second best match
+def associate_landmarks(matcher, task, measurements, descriptors, params):
     """
-    scaled = (match1 - match0) / float(match1)
-    if scaled == 0:
-        scaled = PROB_THRESHOLD
-    return scaled
+    Associate observed keypoints with the landmarks close to a particle and compute the EKF updates
+    A landmark is matched if a keypoint passes the ratio test against it, otherwise the keypoint becomes a new
+    landmark. Close landmarks which are not matched are missed, and their counters are decremented
+
+    This runs in the map update workers, so it only reads its inputs and returns the changes to the map
+
+    :param matcher: the matcher for the descriptors
+    :param task: the particle's (x, y) and the positions, covariances and descriptors of its close landmarks
+    :param measurements: the (range, bearing) of each currently observed keypoint
+    :param descriptors: the array of currently observed descriptors
+    :param params: a tuple holding the covariance of the observation measurement
+    :return: a ParticleUpdate
+    """
+    robot_position, close_pos, close_cov, close_des = task
+    sigma_observation, = params
 
+    weight = 0.0
+    new_features = np.arange(len(descriptors))
+    matched = np.zeros(len(close_pos), dtype=bool)
+    updated = features = np.empty(0, dtype=np.int64)
 
-def estimate_pose(particles):
-    """
-    retrieves the drone's estimated position by summing each particle's pose estimate multiplied
-    by its weight
+    # match every observed descriptor against the descriptors of the close landmarks at once,
+    # the ratio test needs at least two landmarks
+    if len(close_pos) > 1:
+        query, train, distance0, distance1 = utils.match_arrays(matcher.knnMatch(descriptors, close_des, k=2))
 
-    some mathematical motivation Expectation[X] = sum over all x in X of p(x) * x
+        # ratio test, keypoints which fail it (or have less than two neighbors) become new landmarks
+        good = distance0 <= MATCH_RATIO * distance1
+        query, train, distance0, distance1 = query[good], train[good], distance0[good], distance1[good]
+        new_features = np.setdiff1d(new_features, query)
 
-    :param particles: the set of particles to estimate a position for
-    :return: the estimated pose [x,y,z,yaw]
-    """
-    weight_sum = 0.0
-    normal_weights = np.array([])
+        # 'reward' this particle since revisiting landmarks increases certainty
+        weight += np.sum(np.log(scale_weight(distance0, distance1)))
 
-    weights = [p.weight for p in particles]
-    lowest_weight = min(weights)
+        # several keypoints may match one landmark, update it with the closest match only
+        order = np.lexsort((distance0, train))
+        first = order[np.r_[True, train[order][1:] != train[order][:-1]]] if len(order) != 0 else order
+        updated, features = train[first], query[first]
+        matched[train] = True
 
-    for w in weights:
-        x = 1 - (w / lowest_weight)
-        if x == 0:
-            x = PROB_THRESHOLD
-        normal_weights = np.append(normal_weights, x)
-        weight_sum += x
+    pos, cov = utils.update_landmarks(robot_position, close_pos[updated], close_cov[updated],
+                                      measurements[features], sigma_observation)
 
-    normal_weights /= weight_sum
+    # 'punish' this particle for having dubious landmarks
+    weight += (len(matched) - matched.sum()) * math.log(0.1*PROB_THRESHOLD)
 
-    x = 0.0
-    y = 0
-    z = 0
-    yaw = 0
+    # 'punish' this particle since new landmarks decrease certainty
+    weight += len(new_features) * math.log(PROB_THRESHOLD)
 
-    for i, prob in enumerate(normal_weights):
-        x += prob * particles[i].pose[0]
-        y += prob * particles[i].pose[1]
-        z += prob * particles[i].pose[2]
-        yaw += prob * particles[i].pose[3]
+    new_pos, new_cov = utils.initialize_landmarks(robot_position, measurements[new_features], sigma_observation)
 
-    yaw = utils.adjust_angle(yaw)
+    return ParticleUpdate(weight, matched, updated, features, pos, cov, new_features, new_pos, new_cov)
 
-    return [x, y, z, yaw]
+
+def scale_weight(match0, match1):
+    """
+    uses the distances of the two best matches to provide a weight scaled between 0 and 1
+
+    :param match0: the hamming distances of the first best matches
+    :param match1: the hamming distances of the second best matches
+    """
+    match0 = np.asarray(match0, dtype=np.float64)
+    match1 = np.asarray(match1, dtype=np.float64)
+
+    scaled = (match1 - match0) / np.maximum(match1, 1)
+    return np.where(scaled == 0, PROB_THRESHOLD, scaled)
 
 
+def estimate_pose(particles):
+    """
+    retrieves the drone's estimated position by summing each particle's pose estimate multiplied
+    by its weight, the yaw is averaged on the circle
 
+    some mathematical motivation Expectation[X] = sum over all x in X of p(x) * x
+
+    :param particles: the ParticleSet to estimate a position for
+    :return: the estimated pose [x,y,z,yaw]
+    """
+    return log_weights.mean_pose(particles.poses, log_weights.normalize(particles.weights))
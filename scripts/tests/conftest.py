@@ -0,0 +1,15 @@
+# the scripts are Python 2, like the ROS install on the drone, run the tests with
+#   python2 -m pytest scripts/tests
+import os
+import sys
+
+# the modules under test live in scripts/, next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# manual scripts for the flight controller and the camera, not tests
+collect_ignore = ['checkbat.py', 'fc_test.py', 'feature_test.py', 'h2rMultiWii_test.py', 'matcher_benchmark.py',
+                  'test.py']
+
+# python 3 cannot import the scripts at all, so there is nothing to collect instead of a syntax error per module
+if sys.version_info[0] >= 3:
+    collect_ignore_glob = ['test_*.py']
@@ -0,0 +1,97 @@
+"""
+matcher_benchmark.py
+
+Times the matcher backends of matchers.py on ORB descriptors from the map image, for a range of query and
+train set sizes, to find where each backend is the fastest. For every size it prints the time of a single
+knnMatch without an index (build + query), the time of a query against a trained index, and the share of the
+exact ratio test matches which FLANN also finds. Half of the query descriptors are noisy copies of train
+descriptors, so there are true matches to find.
+
+usage: python matcher_benchmark.py [image]
+"""
+
+import os
+import sys
+import time
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import matchers
+
+QUERY_SIZES = [30, 50, 150, 300]
+TRAIN_SIZES = [10, 30, 100, 300, 1000, 3000]
+REPEATS = 20
+MATCH_RATIO = 0.7
+# the share of bits flipped in a query which is a copy of a train descriptor
+NOISE = 0.05
+
+
+def time_call(function, repeats=REPEATS):
+    """
+    :return: the average time of a call in milliseconds
+    """
+    function()
+    start = time.time()
+    for _ in range(repeats):
+        function()
+    return (time.time() - start) / repeats * 1000
+
+
+def good_matches(matches):
+    """
+    :return: the set of (query, train) pairs which pass the ratio test
+    """
+    return set((m[0].queryIdx, m[0].trainIdx) for m in matches
+               if len(m) > 1 and m[0].distance < MATCH_RATIO * m[1].distance)
+
+
+def main():
+    image_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                     '..', 'map.jpg')
+    image = cv2.imread(image_path, 0)
+    if image is None:
+        print 'cannot read', image_path
+        return
+
+    detector = cv2.ORB(nfeatures=max(TRAIN_SIZES) + max(QUERY_SIZES))
+    _, descriptors = detector.detectAndCompute(image, None)
+    random = np.random.RandomState(0)
+
+    print '%6s %6s | %-27s | %-27s | %7s | %s' % ('query', 'train', 'single knnMatch (ms)', 'trained index (ms)',
+                                                 'recall', 'auto')
+    print '%6s %6s | %8s %8s %9s | %8s %8s %9s | %7s | %s' % ('', '', matchers.FLANN, matchers.BF, matchers.NUMPY,
+                                                           matchers.FLANN, matchers.BF, matchers.NUMPY,
+                                                           matchers.FLANN, 'single / trained')
+    for num_query in QUERY_SIZES:
+        for num_train in TRAIN_SIZES:
+            chosen = random.choice(len(descriptors), num_query + num_train, replace=False)
+            query, train = descriptors[chosen[:num_query]], descriptors[chosen[num_query:]]
+
+            # half of the queries are noisy copies of train descriptors, like a landmark seen again
+            num_seen = min(num_query // 2, num_train)
+            noise = np.packbits(random.rand(num_seen, train.shape[1] * 8) < NOISE, axis=1)
+            query[:num_seen] = train[:num_seen] ^ noise
+
+            single, trained, results = [], [], {}
+            for backend in matchers.BACKENDS:
+                matcher = matchers.create_backend(backend)
+                repeats = REPEATS if backend != matchers.NUMPY else max(1, REPEATS // 4)
+                single.append(time_call(lambda: matcher.knnMatch(query, train, k=2), repeats))
+
+                matcher = matchers.create_backend(backend)
+                matcher.add([train])
+                matcher.train()
+                trained.append(time_call(lambda: matcher.knnMatch(query, k=2), repeats))
+                results[backend] = good_matches(matcher.knnMatch(query, k=2))
+
+            exact = results[matchers.BF]
+            recall = len(results[matchers.FLANN] & exact) / float(max(len(exact), 1))
+
+            print '%6d %6d | %8.3f %8.3f %9.3f | %8.3f %8.3f %9.3f | %6.0f%% | %s / %s' % (
+                num_query, num_train, single[0], single[1], single[2], trained[0], trained[1], trained[2],
+                100 * recall, matchers.choose_backend(num_train, num_query), matchers.choose_backend(num_train))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import numpy as np
+import bow_index
+
+
+def random_descriptors(num, seed):
+    return np.random.RandomState(seed).randint(0, 256, (num, 32)).astype(np.uint8)
+
+
+def noisy_copy(des, num_bits, seed):
+    rng = np.random.RandomState(seed)
+    bits = np.unpackbits(des, axis=1)
+    for row in bits:
+        row[rng.choice(bits.shape[1], num_bits, replace=False)] ^= 1
+    return np.packbits(bits, axis=1)
+
+
+def make_cells(num_cells=12, per_cell=60):
+    keys = [(x, y) for x in range(num_cells // 3) for y in range(3)]
+    documents = [random_descriptors(per_cell, seed) for seed in range(len(keys))]
+    return keys, documents
+
+
+def test_vocabulary_words_are_leaves():
+    vocabulary = bow_index.Vocabulary(random_descriptors(600, 0), branching=4, depth=2)
+    words = vocabulary.transform(random_descriptors(100, 1))
+
+    assert vocabulary.num_words <= 16
+    assert np.all((words >= 0) & (words < vocabulary.num_words))
+
+
+def test_vocabulary_is_deterministic():
+    descriptors = random_descriptors(600, 0)
+    first = bow_index.Vocabulary(descriptors)
+    second = bow_index.Vocabulary(descriptors)
+
+    assert np.array_equal(first.centers, second.centers)
+    assert np.array_equal(first.transform(descriptors), second.transform(descriptors))
+
+
+def test_query_ranks_the_cell_the_frame_was_taken_in_first():
+    keys, documents = make_cells()
+    index = bow_index.build_index(keys, documents)
+
+    for c in (0, 5, 11):
+        frame = noisy_copy(documents[c][:40], 4, c)
+        assert index.query(frame, 3)[0] == keys[c]
+
+
+def test_scores_are_similarities():
+    keys, documents = make_cells()
+    index = bow_index.build_index(keys, documents)
+
+    scores = index.scores(documents[2])
+
+    assert np.all((scores >= 0) & (scores <= 1 + 1e-9))
+    assert np.argmax(scores) == 2
+
+
+def test_empty_cells_and_frames():
+    keys, documents = make_cells()
+    documents[1] = np.empty((0, 32), dtype=np.uint8)
+    index = bow_index.build_index(keys, documents)
+
+    assert keys[1] not in index.query(documents[0], len(keys))
+    assert index.query(None, 3) == []
+    assert index.query(np.empty((0, 32), dtype=np.uint8), 3) == []
+    assert bow_index.build_index(keys, [np.empty((0, 32), dtype=np.uint8)] * len(keys)) is None
@@ -0,0 +1,84 @@
+import os
+import numpy as np
+import feature_map
+
+
+def make_grid(seed=0, grid_size_x=3, grid_size_y=2):
+    rng = np.random.RandomState(seed)
+    counts = rng.randint(0, 5, (grid_size_x, grid_size_y))
+    counts[0, 0] = 0
+    points = [[rng.uniform(0, 100, (counts[x, y], 2)).astype(np.float32) for y in range(grid_size_y)]
+              for x in range(grid_size_x)]
+    descriptors = [[rng.randint(0, 256, (counts[x, y], 32)).astype(np.uint8) for y in range(grid_size_y)]
+                   for x in range(grid_size_x)]
+    return points, descriptors
+
+
+def write_source(tmpdir, content='image'):
+    source = tmpdir.join('map.jpg')
+    source.write(content)
+    return str(source)
+
+
+def test_round_trip(tmpdir):
+    source = write_source(tmpdir)
+    file_name = str(tmpdir.join('map.fmap'))
+    points, descriptors = make_grid()
+
+    feature_map.write_map(file_name, points, descriptors, 200, source)
+    loaded = feature_map.load_map(file_name, source, 200)
+
+    assert (loaded.grid_size_x, loaded.grid_size_y) == (3, 2)
+    loaded_points, loaded_descriptors = loaded.grid()
+    for x in range(3):
+        for y in range(2):
+            assert np.array_equal(loaded_points[x][y], points[x][y])
+            assert np.array_equal(loaded_descriptors[x][y], descriptors[x][y])
+    assert not os.path.exists(file_name + '.tmp')
+
+
+def test_missing_or_foreign_file(tmpdir):
+    source = write_source(tmpdir)
+    file_name = str(tmpdir.join('map.fmap'))
+
+    assert feature_map.load_map(file_name, source, 200) is None
+
+    tmpdir.join('map.fmap').write('not a map')
+    assert feature_map.load_map(file_name, source, 200) is None
+
+    tmpdir.join('map.fmap').write('X' * feature_map.HEADER_SIZE)
+    assert feature_map.load_map(file_name, source, 200) is None
+
+
+def test_other_version_is_rejected(tmpdir):
+    source = write_source(tmpdir)
+    file_name = str(tmpdir.join('map.fmap'))
+    feature_map.write_map(file_name, *make_grid(), num_features=200, source_file=source)
+
+    with open(file_name, 'r+b') as f:
+        fields = list(feature_map.HEADER.unpack(f.read(feature_map.HEADER.size)))
+        fields[1] = feature_map.VERSION + 1
+        f.seek(0)
+        f.write(feature_map.HEADER.pack(*fields))
+
+    assert feature_map.load_map(file_name, source, 200) is None
+
+
+def test_stale_source_is_rebuilt(tmpdir):
+    source = write_source(tmpdir)
+    file_name = str(tmpdir.join('map.fmap'))
+    feature_map.write_map(file_name, *make_grid(0), num_features=200, source_file=source)
+
+    # a map built with other parameters, or from an older version of the image, is out of date
+    assert feature_map.load_map(file_name, source, 100) is None
+    write_source(tmpdir, 'a new image')
+    stat = os.stat(source)
+    os.utime(source, (stat.st_atime, stat.st_mtime + 10))
+    assert feature_map.load_map(file_name, source, 200) is None
+
+    # compiling the map again makes it current
+    points, descriptors = make_grid(1)
+    feature_map.write_map(file_name, points, descriptors, 200, source)
+    loaded = feature_map.load_map(file_name, source, 200)
+    assert loaded is not None
+    assert np.array_equal(loaded.cell(2, 1)[1], descriptors[2][1])
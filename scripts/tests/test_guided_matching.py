@@ -0,0 +1,48 @@
+import numpy as np
+import guided_matching
+from frame import Frame
+
+
+def random_features(num, seed=0):
+    rng = np.random.RandomState(seed)
+    points = rng.uniform(0, 320, (num, 2)).astype(np.float32)
+    des = rng.randint(0, 256, (num, 32)).astype(np.uint8)
+    return points, des
+
+
+def test_match_finds_moved_keypoints():
+    points, des = random_features(50)
+    shift = np.float64([[1, 0, 3], [0, 1, -2]])
+
+    query, train = guided_matching.match(points, des, points + (3, -2), des, shift)
+
+    assert len(query) == 50
+    assert np.array_equal(query, train)
+
+
+def test_match_without_candidates_inside_the_windows():
+    points, des = random_features(50)
+
+    query, train = guided_matching.match(points, des, points + 500, des, guided_matching.IDENTITY)
+
+    assert len(query) == 0 and len(train) == 0
+
+
+def test_match_without_candidates_in_the_cells():
+    points, des = random_features(50)
+
+    query, train = guided_matching.match(points, des, points + 5000, des, guided_matching.IDENTITY)
+
+    assert len(query) == 0 and len(train) == 0
+
+
+def test_frame_match_falls_back_to_full_match():
+    points, des = random_features(50)
+    frame1 = Frame(None, des, points)
+    frame2 = Frame(None, des, points + 500)
+
+    query, train = frame2.match(frame1, guided_matching.IDENTITY)
+
+    assert len(query) == 50
+    assert np.array_equal(np.sort(query), np.arange(50))
+    assert np.array_equal(query, train)
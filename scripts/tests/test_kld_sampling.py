@@ -0,0 +1,66 @@
+import numpy as np
+import kld_sampling
+
+
+def test_kld_bound_grows_with_the_occupied_bins():
+    bounds = kld_sampling.kld_bound(np.arange(1, 50))
+
+    assert bounds[0] == 0
+    assert np.all(np.diff(bounds) > 0)
+    # the chi-square 0.99 quantile with 9 degrees of freedom is 21.67, the bound is it over 2 epsilon
+    assert abs(kld_sampling.kld_bound(10, epsilon=0.25) - 21.67 / 0.5) < 0.5
+
+
+def test_bin_keys_group_poses_by_bin():
+    poses = np.float64([[0.0, 0.0, 1, 0.0],
+                        [0.01, 0.01, 2, 0.01],
+                        [0.06, 0.0, 1, 0.0],
+                        [0.0, 0.06, 1, 0.0],
+                        [0.0, 0.0, 1, 0.11]])
+
+    keys = kld_sampling.bin_keys(poses)
+
+    assert keys[0] == keys[1]
+    assert len(np.unique(keys)) == 4
+
+
+def test_concentrated_belief_needs_few_particles():
+    np.random.seed(0)
+    poses = np.zeros((100, 4)) + np.random.uniform(0, 0.01, (100, 4))
+    weights = np.full(100, 0.01)
+
+    indices = kld_sampling.sample(weights, poses, 10, 100)
+
+    assert len(indices) == 10
+    assert np.all(np.diff(indices) >= 0)
+
+
+def test_spread_belief_needs_many_particles():
+    np.random.seed(1)
+    poses = np.random.uniform(-2, 2, (100, 4))
+    weights = np.full(100, 0.01)
+
+    assert len(kld_sampling.sample(weights, poses, 10, 100)) == 100
+
+
+def test_resample_keeps_size_within_tolerance_until_degenerate():
+    np.random.seed(2)
+    poses = np.random.uniform(-2, 2, (50, 4))
+    uniform = np.full(50, 0.02)
+
+    assert kld_sampling.resample(uniform, poses, 10, 50) is None
+
+    degenerate = np.full(50, 0.001)
+    degenerate[0] = 1 - 49 * 0.001
+    indices = kld_sampling.resample(degenerate, poses, 10, 50)
+    assert indices is not None
+    assert 10 <= len(indices) <= 50
+
+
+def test_resample_shrinks_a_concentrated_belief():
+    np.random.seed(3)
+    poses = np.random.uniform(0, 0.01, (50, 4))
+
+    indices = kld_sampling.resample(np.full(50, 0.02), poses, 10, 50)
+
+    assert indices is not None and len(indices) == 10
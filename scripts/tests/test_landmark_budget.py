@@ -0,0 +1,75 @@
+import numpy as np
+import landmark_budget
+
+
+def descriptors(bits):
+    """
+    :param bits: the number of leading bits set in each descriptor
+    """
+    des = np.zeros((len(bits), 32), dtype=np.uint8)
+    for row, n in zip(des, bits):
+        row[:n // 8] = 0xff
+        if n % 8:
+            row[n // 8] = (0xff << (8 - n % 8)) & 0xff
+    return des
+
+
+def test_duplicates_need_both_position_and_descriptor():
+    pos = np.float64([[0.0, 0.0], [1.0, 0.0]])
+    des = descriptors([0, 0])
+
+    new_pos = np.float64([[0.005, 0.0], [0.05, 0.0], [1.0, 0.005]])
+    # the first is close in both, the second is too far, the third has a too different descriptor
+    new_des = descriptors([10, 0, landmark_budget.MERGE_DISTANCE + 1])
+
+    duplicates, originals = landmark_budget.find_duplicates(new_pos, new_des, pos, des)
+
+    assert duplicates.tolist() == [0]
+    assert originals.tolist() == [0]
+
+
+def test_each_landmark_takes_the_closest_duplicate_only():
+    pos = np.float64([[0.0, 0.0]])
+    des = descriptors([0])
+    new_pos = np.float64([[0.001, 0.0], [0.002, 0.0]])
+    new_des = descriptors([20, 4])
+
+    duplicates, originals = landmark_budget.find_duplicates(new_pos, new_des, pos, des)
+
+    assert duplicates.tolist() == [1]
+    assert originals.tolist() == [0]
+
+
+def test_no_duplicates_in_an_empty_map():
+    duplicates, originals = landmark_budget.find_duplicates(np.zeros((3, 2)), descriptors([0, 0, 0]),
+                                                            np.empty((0, 2)), np.empty((0, 32), dtype=np.uint8))
+    assert len(duplicates) == 0 and len(originals) == 0
+
+
+def test_fuse_weights_by_information():
+    pos1, cov1 = np.float64([[0.0, 0.0]]), np.float64([[[1.0, 0.0], [0.0, 1.0]]])
+    pos2, cov2 = np.float64([[3.0, 3.0]]), np.float64([[[2.0, 0.0], [0.0, 2.0]]])
+
+    pos, cov = landmark_budget.fuse(pos1, cov1, pos2, cov2)
+
+    # the more certain estimate counts twice as much, and the fused estimate is more certain than either
+    assert np.allclose(pos, [[1.0, 1.0]])
+    assert np.allclose(cov, [np.eye(2) * 2.0 / 3.0])
+
+
+def test_evictions_keep_the_budget_until_it_is_exceeded():
+    counter = np.zeros(10, dtype=np.int32)
+    cov = np.tile(np.eye(2), (10, 1, 1))
+
+    assert len(landmark_budget.evictions(counter, cov, 10)) == 0
+    # one over the budget evicts down to evict_to of it
+    assert len(landmark_budget.evictions(counter, cov, 9, evict_to=0.5)) == 10 - 4
+
+
+def test_evictions_take_the_least_observed_and_most_uncertain_first():
+    counter = np.int32([5, 1, 1, 0, 3])
+    cov = np.float64([1.0, 1.0, 4.0, 1.0, 1.0])[:, np.newaxis, np.newaxis] * np.eye(2)
+
+    evicted = landmark_budget.evictions(counter, cov, 4, evict_to=0.75)
+
+    assert evicted.tolist() == [3, 2]
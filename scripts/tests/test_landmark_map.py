@@ -0,0 +1,168 @@
+import numpy as np
+from landmark_map import LandmarkMap, LandmarkPool, BLOCK_SIZE, DES_SIZE
+
+
+def add_landmarks(maps, i, pos, counter=1):
+    pos = np.float64(pos).reshape(-1, 2)
+    cov = np.tile(np.eye(2), (len(pos), 1, 1))
+    des = np.zeros((len(pos), DES_SIZE), dtype=np.uint8)
+    return maps.add(i, pos, cov, des, counter)
+
+
+def check_refcounts(pool, *maps):
+    """
+    asserts that every block is referenced as often as the maps' tables hold it, and that exactly the blocks
+    without references are free
+    """
+    expected = np.zeros(pool.num_blocks(), dtype=np.int32)
+    for landmark_map in maps:
+        np.add.at(expected, landmark_map.table[landmark_map.table >= 0], 1)
+
+    assert np.array_equal(pool.refcount, expected)
+    assert sorted(pool.free_blocks) == np.flatnonzero(expected == 0).tolist()
+
+
+def test_add_groups_landmarks_by_cell():
+    maps = LandmarkMap(1)
+    ids = add_landmarks(maps, 0, [[0.05, 0.05], [0.1, 0.1], [1.05, 1.05]])
+
+    assert sorted(maps.landmarks(0)) == sorted(ids)
+    assert len(maps.blocks(0)) == 2
+    assert sorted(maps.near(0, 0.0, 0.0, 0.1)) == sorted(ids[:2])
+    check_refcounts(maps.pool, maps)
+
+
+def test_select_writable_release_balance_refcounts():
+    parent = LandmarkMap(2)
+    add_landmarks(parent, 0, np.random.RandomState(0).uniform(0, 1, (40, 2)))
+    add_landmarks(parent, 1, np.random.RandomState(1).uniform(0, 1, (40, 2)))
+    pool = parent.pool
+
+    children = parent.select(np.array([0, 0, 1, 0]))
+    check_refcounts(pool, parent, children)
+
+    # writing to a shared landmark copies its block and leaves the other maps untouched
+    ids = children.landmarks(0)[:3]
+    before = pool.pos[ids].copy()
+    written = children.writable(0, ids)
+    pool.pos[written] += 1.0
+
+    assert not np.array_equal(written // BLOCK_SIZE, ids // BLOCK_SIZE)
+    assert np.array_equal(pool.pos[ids], before)
+    assert np.array_equal(pool.pos[children.landmarks(1)], pool.pos[parent.landmarks(0)])
+    check_refcounts(pool, parent, children)
+
+    # a block the map owns alone is written in place
+    assert np.array_equal(children.writable(0, written), written)
+
+    parent.release()
+    check_refcounts(pool, children)
+    children.release()
+    check_refcounts(pool)
+    assert len(pool.free_blocks) == pool.num_blocks()
+
+
+def test_remove_frees_empty_blocks():
+    maps = LandmarkMap(1)
+    ids = add_landmarks(maps, 0, [[0.05, 0.05], [0.1, 0.1], [1.05, 1.05]])
+    block = ids[2] // BLOCK_SIZE
+
+    maps.remove(0, ids[2:])
+
+    assert block in maps.pool.free_blocks
+    assert sorted(maps.landmarks(0)) == sorted(ids[:2])
+    check_refcounts(maps.pool, maps)
+
+
+def test_remove_shared_landmark_keeps_other_map():
+    parent = LandmarkMap(1)
+    ids = add_landmarks(parent, 0, [[0.05, 0.05], [0.1, 0.1]])
+    children = parent.select(np.array([0, 0]))
+
+    children.remove(0, ids[:1])
+
+    assert len(children.landmarks(0)) == 1
+    assert sorted(children.landmarks(1)) == sorted(ids)
+    assert sorted(parent.landmarks(0)) == sorted(ids)
+    check_refcounts(parent.pool, parent, children)
+
+
+def test_relocate_moves_landmarks_to_their_new_cell():
+    maps = LandmarkMap(1)
+    ids = add_landmarks(maps, 0, [[0.05, 0.05], [0.1, 0.1]])
+    maps.pool.pos[ids] = [[1.05, 1.05], [1.1, 1.1]]
+    maps.relocate(0, ids)
+
+    landmarks = maps.landmarks(0)
+    assert len(landmarks) == 2
+    assert np.array_equal(maps.pool.cells(maps.pool.pos[landmarks]), maps.pool.block_cell[landmarks // BLOCK_SIZE])
+    # the emptied block was freed, and is reused for the new cell
+    assert len(maps.blocks(0)) == 1
+    check_refcounts(maps.pool, maps)
+
+
+def test_pool_and_table_grow():
+    maps = LandmarkMap(1, LandmarkPool(num_blocks=2))
+    cells = np.arange(40) * 0.2 + 0.1
+    add_landmarks(maps, 0, np.column_stack((cells, cells)))
+
+    assert len(maps.landmarks(0)) == 40
+    assert maps.pool.num_blocks() >= 40
+    assert maps.num_landmarks()[0] == 40
+    check_refcounts(maps.pool, maps)
+
+
+def test_near_holds_every_landmark_in_range():
+    rng = np.random.RandomState(2)
+    maps = LandmarkMap(1, LandmarkPool(cell_size=0.2))
+    pos = rng.uniform(-1, 1, (500, 2))
+    ids = add_landmarks(maps, 0, pos)
+
+    for x, y, radius in rng.uniform(-1, 1, (20, 3)) * (1, 1, 0.5) + (0, 0, 0.5):
+        candidates = maps.near(0, x, y, radius)
+        in_range = ids[np.hypot(pos[:, 0] - x, pos[:, 1] - y) <= radius]
+
+        assert set(in_range) <= set(candidates)
+        # the candidates come from the cells within reach of the query only
+        reach = np.ceil(radius / 0.2) + 1
+        assert np.all(np.abs(maps.pool.pos[candidates] - (x, y)).max(axis=1) <= reach * 0.2)
+
+
+def test_clone_copies_the_block_and_moves_one_reference():
+    parent = LandmarkMap(1)
+    ids = add_landmarks(parent, 0, [[0.05, 0.05], [0.1, 0.1]], counter=3)
+    block = ids[0] // BLOCK_SIZE
+    children = parent.select(np.array([0, 0]))
+    pool = parent.pool
+    assert pool.refcount[block] == 3
+
+    new_block = pool.clone(block)
+    src = slice(block * BLOCK_SIZE, (block + 1) * BLOCK_SIZE)
+    dst = slice(new_block * BLOCK_SIZE, (new_block + 1) * BLOCK_SIZE)
+
+    assert new_block != block
+    assert pool.refcount[block] == 2 and pool.refcount[new_block] == 1
+    assert pool.block_cell[new_block].tolist() == pool.block_cell[block].tolist()
+    for array in (pool.pos, pool.cov, pool.des, pool.counter, pool.used):
+        assert np.array_equal(array[dst], array[src])
+
+    # the copy is independent of the block it came from
+    pool.pos[dst] += 1.0
+    assert np.array_equal(pool.pos[ids], [[0.05, 0.05], [0.1, 0.1]])
+    children.table[0][children.table[0] == block] = new_block
+    check_refcounts(pool, parent, children)
+
+
+def test_last_map_sharing_a_block_writes_in_place():
+    parent = LandmarkMap(1)
+    ids = add_landmarks(parent, 0, [[0.05, 0.05]])
+    children = parent.select(np.array([0, 0]))
+    parent.release()
+
+    # the first child copies the block, which leaves the second child its only owner
+    first = children.writable(0, ids)
+    second = children.writable(1, ids)
+
+    assert not np.array_equal(first, ids)
+    assert np.array_equal(second, ids)
+    check_refcounts(children.pool, children)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+import log_weights
+
+
+def test_log_sum_exp_of_extreme_log_weights():
+    assert log_weights.log_sum_exp([-1e4, -1e4]) == pytest.approx(-1e4 + np.log(2))
+    assert log_weights.log_sum_exp([1e4, 0.0]) == pytest.approx(1e4)
+    assert log_weights.log_sum_exp([-np.inf, -5.0]) == pytest.approx(-5.0)
+    assert log_weights.log_sum_exp([-np.inf, -np.inf]) == -np.inf
+
+
+def test_normalize_extreme_log_weights():
+    weights = log_weights.normalize([-20000.0, -20001.0, -np.inf, -30000.0])
+
+    assert np.all(np.isfinite(weights))
+    assert weights.sum() == pytest.approx(1.0)
+    assert weights[0] / weights[1] == pytest.approx(np.e)
+    assert weights[2] == 0.0
+
+
+def test_normalize_matches_direct_normalization():
+    log = np.log(np.float64([1, 2, 3, 4]))
+
+    assert np.allclose(log_weights.normalize(log), np.float64([1, 2, 3, 4]) / 10)
+    assert np.allclose(log_weights.normalize(log - 5000), np.float64([1, 2, 3, 4]) / 10)
+
+
+def test_effective_sample_size_bounds():
+    assert log_weights.effective_sample_size(np.full(10, -800.0)) == pytest.approx(10)
+    assert log_weights.effective_sample_size([0.0, -1e4, -1e4]) == pytest.approx(1)
+
+
+def test_circular_mean_across_pi():
+    weights = np.float64([0.5, 0.5])
+
+    assert abs(log_weights.circular_mean(np.float64([np.pi - 0.1, -np.pi + 0.1]), weights)) == pytest.approx(np.pi)
+
+    poses = np.float64([[0, 0, 1, np.pi - 0.1], [2, 4, 1, -np.pi + 0.1]])
+    x, y, z, yaw = log_weights.mean_pose(poses, weights)
+    assert (x, y, z) == pytest.approx((1, 2, 1))
+    assert abs(yaw) == pytest.approx(np.pi)
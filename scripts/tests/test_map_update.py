@@ -0,0 +1,114 @@
+import numpy as np
+from matchers import create_matcher
+from frame import Frame
+from slam_helper import FastSLAM
+
+
+class InlineUpdater(object):
+    """
+    runs a map update in this process when it is started, and holds it as running until finish is called
+    """
+
+    def __init__(self):
+        self.matcher = create_matcher()
+        self.in_flight = None
+        self.finished = False
+
+    def busy(self):
+        return self.in_flight is not None
+
+    def ready(self):
+        return self.busy() and self.finished
+
+    def start(self, function, tasks, measurements, descriptors, params):
+        assert not self.busy()
+        self.in_flight = [function(self.matcher, task, measurements, descriptors, params) for task in tasks]
+        self.finished = False
+
+    def finish(self):
+        self.finished = True
+
+    def results(self):
+        results, self.in_flight = self.in_flight, None
+        return results
+
+    def cancel(self):
+        self.in_flight = None
+
+    def close(self):
+        self.in_flight = None
+
+
+def keyframe(rng, num_features=100):
+    points = rng.uniform(0, 240, (num_features, 2)).astype(np.float32)
+    des = rng.randint(0, 256, (num_features, 32)).astype(np.uint8)
+    return Frame(None, des, points)
+
+
+def make_slam(num_particles):
+    slam = FastSLAM()
+    slam.verbose = False
+    slam.z = 0.3
+    slam.update_perceptual_range()
+    slam.generate_particles(num_particles)
+    slam.map_updater = InlineUpdater()
+    return slam
+
+
+def merge(slam):
+    # what run does once collect_map_update returns the updated particles
+    updated = slam.collect_map_update()
+    slam.particles.take_maps(updated)
+    slam.resample_particles()
+    slam.begin_pending_update()
+
+
+def test_keyframe_queued_while_update_runs_keeps_its_landmarks():
+    rng = np.random.RandomState(0)
+    slam = make_slam(5)
+
+    slam.start_map_update(keyframe(rng))
+    # fly out of range of the first keyframe's landmarks, so the second keyframe adds to them
+    slam.particles.poses[:, 0] += 100.0
+    slam.start_map_update(keyframe(rng))
+    assert slam.pending_keyframe is not None
+
+    slam.map_updater.finish()
+    merge(slam)
+
+    # the queued keyframe is updated on maps which already hold the first keyframe's landmarks
+    snapshot = slam.update_context[0]
+    assert np.all(snapshot.num_landmarks() == 100)
+    assert np.allclose(snapshot.poses[:, 0], slam.particles.poses[:, 0])
+
+    slam.map_updater.finish()
+    merge(slam)
+
+    assert np.all(slam.particles.num_landmarks() == 200)
+    assert slam.update_context is None and slam.pending_keyframe is None
+
+
+def test_queued_keyframe_follows_the_resampled_particles():
+    rng = np.random.RandomState(1)
+    slam = make_slam(4)
+    slam.particles.poses[:, 0] = np.arange(4)
+
+    slam.start_map_update(keyframe(rng))
+    queued_poses = slam.particles.poses.copy()
+    slam.start_map_update(keyframe(rng))
+
+    # resampling while both keyframes wait, the queued keyframe is observed from the ancestors' poses
+    slam.particles.weights[:] = [-500.0, 0.0, -500.0, -500.0]
+    slam.particles.poses[:, 1] += 5.0
+    slam.resample_particles()
+    ancestors = slam.pending_lineage.copy()
+    assert np.all(ancestors == 1)
+
+    slam.map_updater.finish()
+    updated = slam.collect_map_update()
+    slam.particles.take_maps(updated)
+    slam.begin_pending_update()
+
+    snapshot = slam.update_context[0]
+    assert np.array_equal(snapshot.poses, queued_poses[ancestors])
+    assert np.all(snapshot.num_landmarks() == 100)
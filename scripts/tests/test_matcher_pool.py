@@ -0,0 +1,31 @@
+import numpy as np
+from matcher_pool import MatcherPool
+
+
+class CountingMatcher(object):
+    trained = 0
+
+    def add(self, descriptors):
+        pass
+
+    def train(self):
+        CountingMatcher.trained += 1
+
+
+def test_fill_trains_the_cells_the_pool_holds():
+    CountingMatcher.trained = 0
+    pool = MatcherPool(CountingMatcher, size=3)
+    des = np.zeros((5, 32), dtype=np.uint8)
+    cells = [((0, 0), des), ((0, 1), des[:1]), ((1, 0), des), ((1, 1), des), ((2, 0), des)]
+
+    pool.fill(cells)
+
+    # the cell with one feature is skipped, and the cells past the size of the pool are left for later
+    assert list(pool.matchers) == [(0, 0), (1, 0), (1, 1)]
+    assert CountingMatcher.trained == 3
+
+    pool.get((1, 0), des)
+    assert CountingMatcher.trained == 3
+    pool.get((2, 0), des)
+    assert CountingMatcher.trained == 4
+    assert list(pool.matchers) == [(1, 1), (1, 0), (2, 0)]
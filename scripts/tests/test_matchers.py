@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+import matchers
+
+RATIO = 0.7
+
+
+def random_descriptors(num, seed):
+    return np.random.RandomState(seed).randint(0, 256, (num, 32)).astype(np.uint8)
+
+
+def noisy_copy(des, num_bits, seed):
+    """
+    :return: des with num_bits random bits of each descriptor flipped
+    """
+    rng = np.random.RandomState(seed)
+    bits = np.unpackbits(des, axis=1)
+    for row in bits:
+        flip = rng.choice(bits.shape[1], num_bits, replace=False)
+        row[flip] ^= 1
+    return np.packbits(bits, axis=1)
+
+
+def ratio_test(knn_matches):
+    return sorted((m[0].queryIdx, m[0].trainIdx) for m in knn_matches
+                  if len(m) > 1 and m[0].distance < RATIO * m[1].distance)
+
+
+def neighbor_distances(knn_matches):
+    return [[m.distance for m in ms] for ms in knn_matches]
+
+
+@pytest.mark.parametrize('num_query, num_train', [(1, 2), (20, 50), (200, 500)])
+def test_numpy_matches_brute_force(num_query, num_train):
+    train = random_descriptors(num_train, 1)
+    query = noisy_copy(train[:num_query], 20, 2)
+
+    expected = matchers.create_matcher(matchers.BF).knnMatch(query, train, k=2)
+    result = matchers.create_matcher(matchers.NUMPY).knnMatch(query, train, k=2)
+
+    assert neighbor_distances(result) == neighbor_distances(expected)
+    assert ratio_test(result) == ratio_test(expected)
+    assert len(ratio_test(result)) == num_query
+
+
+def test_numpy_matches_brute_force_when_trained():
+    train = random_descriptors(300, 3)
+    query = np.concatenate((noisy_copy(train[:100], 30, 4), random_descriptors(50, 5)))
+
+    results = []
+    for backend in (matchers.BF, matchers.NUMPY):
+        matcher = matchers.create_matcher(backend)
+        matcher.add([train[:150], train[150:]])
+        matcher.train()
+        results.append(matcher.knnMatch(query, k=2))
+
+    assert neighbor_distances(results[1]) == neighbor_distances(results[0])
+    assert ratio_test(results[1]) == ratio_test(results[0])
+
+
+def test_numpy_empty_input():
+    des = random_descriptors(10, 6)
+    matcher = matchers.create_matcher(matchers.NUMPY)
+
+    assert matcher.knnMatch(des[:0], des, k=2) == []
+    assert matcher.knnMatch(des, des[:0], k=2) == [[]] * len(des)
+
+    matcher.add([des[:0]])
+    matcher.train()
+    assert matcher.knnMatch(des, k=2) == [[]] * len(des)
+
+
+def test_numpy_single_train_descriptor():
+    des = random_descriptors(5, 7)
+
+    result = matchers.create_matcher(matchers.NUMPY).knnMatch(des, des[:1], k=2)
+
+    assert [len(m) for m in result] == [1] * len(des)
+    assert ratio_test(result) == []
+
+
+def test_choose_backend_thresholds():
+    assert matchers.choose_backend(matchers.BF_MAX_TRAIN) == matchers.BF
+    assert matchers.choose_backend(matchers.BF_MAX_TRAIN + 1) == matchers.FLANN
+    assert matchers.choose_backend(matchers.BF_MAX_TRAIN + 1, matchers.BF_MAX_QUERY) == matchers.BF
+    assert matchers.choose_backend(matchers.BF_MAX_TRAIN + 1, matchers.BF_MAX_QUERY + 1) == matchers.FLANN
+
+
+def test_train_array_backend_is_reused_until_the_array_changes():
+    train = random_descriptors(400, 6)
+    query = noisy_copy(train[:50], 20, 7)
+    matcher = matchers.create_matcher(matchers.BF)
+
+    first = matcher.knnMatch(query, train, k=2)
+    backend = matcher.train_backend
+    assert ratio_test(matcher.knnMatch(query[:10], train, k=2)) == ratio_test(first)[:10]
+    assert matcher.train_backend is backend
+
+    other = train[::-1].copy()
+    result = matcher.knnMatch(query, other, k=2)
+    assert matcher.train_backend is not backend
+    assert ratio_test(result) == sorted((q, len(train) - 1 - t) for q, t in ratio_test(first))
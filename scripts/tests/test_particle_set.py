@@ -0,0 +1,55 @@
+import numpy as np
+from slam_helper import ParticleSet
+
+
+def make_particles(num):
+    rng = np.random.RandomState(0)
+    particles = ParticleSet(rng.uniform(0, 1, (num, 4)))
+    particles.weights = rng.normal(size=num)
+    for i in range(num):
+        pos = rng.uniform(0, 1, (5, 2))
+        particles.add_landmarks(i, pos, np.tile(np.eye(2), (5, 1, 1)), np.zeros((5, 32), dtype=np.uint8))
+    return particles
+
+
+def test_select_gathers_poses_weights_and_maps():
+    particles = make_particles(4)
+    indices = np.array([3, 3, 0, 1])
+
+    new = particles.select(indices)
+
+    assert np.array_equal(new.poses, particles.poses[indices])
+    assert np.array_equal(new.weights, particles.weights[indices])
+    for j, i in enumerate(indices):
+        assert np.array_equal(np.sort(new.lm_pos[new.landmarks(j)], axis=0),
+                              np.sort(particles.lm_pos[particles.landmarks(i)], axis=0))
+
+    # the poses are copies, the landmarks are shared until written
+    new.poses[0] += 1.0
+    assert not np.array_equal(new.poses[0], particles.poses[3])
+    assert new.maps.pool is particles.maps.pool
+
+
+def test_landmarks_near():
+    particles = ParticleSet(np.zeros((1, 4)))
+    pos = np.float64([[0.05, 0.0], [0.3, 0.0], [2.0, 2.0]])
+    ids = particles.add_landmarks(0, pos, np.tile(np.eye(2), (3, 1, 1)), np.zeros((3, 32), dtype=np.uint8))
+
+    assert sorted(particles.landmarks_near(0, 0.1)) == [ids[0]]
+    assert sorted(particles.landmarks_near(0, 0.5)) == sorted(ids[:2])
+
+
+def test_take_maps_and_release_free_every_block():
+    particles = make_particles(3)
+    pool = particles.maps.pool
+    snapshot = particles.copy()
+    snapshot.weights[:] = 1.0
+    expected = particles.weights + 1.0
+
+    particles.take_maps(snapshot)
+    assert np.allclose(particles.weights, expected)
+    assert np.all(pool.refcount[particles.maps.table[particles.maps.table >= 0]] == 1)
+
+    particles.release()
+    assert np.all(pool.refcount == 0)
+    assert sorted(pool.free_blocks) == list(range(pool.num_blocks()))
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import resampling
+
+SCHEMES = [resampling.systematic, resampling.stratified, resampling.residual, resampling.multinomial]
+
+
+@pytest.mark.parametrize('scheme', SCHEMES)
+def test_indices_are_sorted_and_in_range(scheme):
+    np.random.seed(0)
+    weights = np.random.dirichlet(np.ones(20))
+
+    for num_samples in (1, 20, 57):
+        indices = scheme(weights, num_samples)
+        assert len(indices) == num_samples
+        assert np.all(np.diff(indices) >= 0)
+        assert indices.min() >= 0 and indices.max() < len(weights)
+
+
+@pytest.mark.parametrize('scheme', SCHEMES)
+def test_counts_follow_the_weights(scheme):
+    np.random.seed(1)
+    weights = np.float64([0.5, 0.25, 0.125, 0.125, 0.0])
+
+    counts = np.zeros(len(weights))
+    for _ in range(200):
+        counts += np.bincount(scheme(weights, 40), minlength=len(weights))
+
+    assert np.allclose(counts / counts.sum(), weights, atol=0.02)
+    assert counts[-1] == 0
+
+
+# systematic and residual resampling keep floor(N * w) or ceil(N * w) copies of each particle, stratified
+# resampling may be one further off
+@pytest.mark.parametrize('scheme, slack', [(resampling.systematic, 0), (resampling.residual, 0),
+                                           (resampling.stratified, 1)])
+def test_low_variance_schemes_keep_their_expected_copies(scheme, slack):
+    np.random.seed(2)
+    weights = np.random.dirichlet(np.ones(10))
+
+    for _ in range(50):
+        counts = np.bincount(scheme(weights), minlength=len(weights))
+        assert np.all(counts >= np.floor(len(weights) * weights) - slack)
+        assert np.all(counts <= np.ceil(len(weights) * weights) + slack)
+
+
+def test_weights_summing_below_one():
+    weights = np.full(10, 0.1 - 1e-12)
+
+    assert np.array_equal(resampling.systematic(weights), np.arange(10))
+
+
+def test_resample_only_when_degenerate():
+    assert resampling.effective_sample_size(np.full(8, 0.125)) == pytest.approx(8)
+    assert resampling.resample(np.full(8, 0.125)) is None
+
+    weights = np.float64([0.93] + [0.01] * 7)
+    assert resampling.needs_resampling(weights)
+    assert len(resampling.resample(weights)) == 8
+
+
+def test_resampling_threshold_boundary():
+    # half the particles hold all the weight, the effective sample size is exactly half of them
+    weights = np.float64([0.5, 0.5, 0.0, 0.0])
+    assert resampling.effective_sample_size(weights) == pytest.approx(2)
+    assert resampling.resample(weights) is None
+
+    skewed = np.float64([0.51, 0.49, 0.0, 0.0])
+    assert np.array_equal(resampling.resample(skewed), [0, 0, 1, 1])
+
+    # a threshold above 1 resamples even equal weights, and 0 never resamples
+    assert np.array_equal(resampling.resample(np.full(4, 0.25), threshold=1.01), np.arange(4))
+    assert resampling.resample(np.float64([1.0, 0.0, 0.0, 0.0]), threshold=0.0) is None
@@ -11,7 +11,7 @@ import math
 import sys
 
 max_float = sys.float_info.max
-MATCH_RATIO = 0.7
+MIN_SQUARED_DISTANCE = 1e-12
 
 debug = False
 
@@ -179,97 +179,145 @@ def compute_new_covariance(kalmanGain, jacobian, oldCovariance):
     return newCovariance
 
 
-def add_landmark(particle, kp, des, sigma_observation, kp_to_measurement):
+def calculate_jacobians(robot_position, landmark_pos):
+    """ Batched calculate_jacobian for N landmarks observed from the same robot position
+
+    args:
+        robot_position: the (x, y) coordinates of the robot's position
+        landmark_pos: N x 2 array of landmark positions
+
+    returns:
+        N x 2 x 2 array holding the Jacobian of each observation
     """
-    adds a newly observed landmark to particle
+    dx = landmark_pos[:, 0] - robot_position[0]
+    dy = landmark_pos[:, 1] - robot_position[1]
+    # a landmark directly below the robot has no defined bearing
+    q = np.maximum(dx ** 2 + dy ** 2, MIN_SQUARED_DISTANCE)
+    sqrt_q = np.sqrt(q)
+
+    jacobians = np.empty((len(q), 2, 2))
+    jacobians[:, 0, 0] = dx / sqrt_q
+    jacobians[:, 0, 1] = dy / sqrt_q
+    jacobians[:, 1, 0] = -dy / q
+    jacobians[:, 1, 1] = dx / q
+    return jacobians
+
+
+def compute_measurement_covariances(jacobians, oldCovariances, sigmaObservation):
+    """ Batched compute_measurement_covariance, Q = H S H^T + sigmaObservation for each landmark """
+    return np.einsum('nij,njk,nlk->nil', jacobians, oldCovariances, jacobians) + sigmaObservation
+
+
+def compute_initial_covariances(jacobians, sigmaObservation):
+    """ Batched compute_initial_covariance, S = H^-1 sigmaObservation H^-T for each landmark """
+    jacobianInverses = np.linalg.inv(jacobians)
+    return np.einsum('nij,jk,nlk->nil', jacobianInverses, sigmaObservation, jacobianInverses)
+
+
+def compute_kalman_gains(jacobians, oldCovariances, measurementCovariances):
+    """ Batched compute_kalman_gain, K = S H^T Q^-1 for each landmark """
+    return np.einsum('nij,nkj,nkl->nil', oldCovariances, jacobians, np.linalg.inv(measurementCovariances))
+
 
-    :param particle: the particle to add the new landmark to
-    :param kp, des: the keypoint and descriptor of the new landmark to add
+def compute_new_covariances(kalmanGains, jacobians, oldCovariances):
+    """ Batched compute_new_covariance, (I - K H) S for each landmark """
+    return oldCovariances - np.einsum('nij,njk,nkl->nil', kalmanGains, jacobians, oldCovariances)
+
+
+def initialize_landmarks(robot_position, measurements, sigma_observation):
+    """
+    computes the position and covariance of newly observed landmarks
+
+    :param robot_position: the (x, y) coordinates of the robot's position
+    :param measurements: N x 2 array of the (range, bearing) from the center of the camera frame to each keypoint
     :param sigma_observation: the covariance of the observation measurement
-    :param kp_to_measurement: a function which computes a range/bearing measurement from the center of the
-                              camera frame to kp
+    :return: N x 2 array of the new landmarks' positions and N x 2 x 2 array of their covariances
     """
 
-    robot_x, robot_y = particle.pose[0], particle.pose[1]
+    dist, bearing = measurements[:, 0], measurements[:, 1]
 
-    # get the dist and bearing from the keypoint to the center of the camera frame
-    dist, bearing = kp_to_measurement(kp)
+    land_pos = np.column_stack((robot_position[0] + dist * np.cos(bearing),
+                                robot_position[1] + dist * np.sin(bearing)))
 
-    land_x = robot_x + (dist * np.cos(bearing))
-    land_y = robot_y + (dist * np.sin(bearing))
+    if len(land_pos) == 0:
+        return land_pos.reshape(0, 2), np.empty((0, 2, 2))
 
     # compute Jacobian of the robot's position and covariance of the measurement
-    H = calculate_jacobian((robot_x, robot_y), (land_x, land_y))
-    covariance = compute_initial_covariance(H, sigma_observation)
+    H = calculate_jacobians(robot_position, land_pos)
+    covariances = compute_initial_covariances(H, sigma_observation)
 
-    # add the new landmark to this particle's list of landmarks
-    particle.landmarks.append(Landmark(land_x, land_y, covariance, des, 1))
+    return land_pos, covariances
 
 
-def update_landmark(particle, landmark, kp, des, sigma_observation, kp_to_measurement):
+def update_landmarks(robot_position, old_pos, old_cov, measurements, sigma_observation):
     """
-    update the mean and covariance of a landmark
+    update the means and covariances of landmarks
 
-    uses the Extended Kalman Filter (EKF) to update the existing landmark's mean (x, y) and
-    covariance according to the new measurement
+    uses the Extended Kalman Filter (EKF) to update each existing landmark's mean (x, y) and
+    covariance according to its new measurement
 
-    :param particle: the particle to update
-    :param landmark: the landmark to update
-    :param kp, des: the keypoint and descriptor of the new landmark
+    :param robot_position: the (x, y) coordinates of the robot's position
+    :param old_pos: N x 2 array of the landmarks' positions at the previous time step
+    :param old_cov: N x 2 x 2 array of the landmarks' covariances at the previous time step
+    :param measurements: N x 2 array of the (range, bearing) from the center of the camera frame to each keypoint
     :param sigma_observation: the covariance of the observation measurement
-    :param kp_to_measurement: a function which computes a range/bearing measurement from the center of the
-                              camera frame to kp
+    :return: the updated positions and covariances of the landmarks
     """
 
-    robot_x, robot_y = particle.pose[0], particle.pose[1]
-
-    # get the dist and bearing from the center of the camera frame to this keypoint
-    dist, bearing = kp_to_measurement(kp)
-
-    predicted_dist = distance(landmark.x, landmark.y, robot_x, robot_y)
-    predicted_bearing = (math.atan2((landmark.y - robot_y), (landmark.x - robot_x)))
+    if len(old_pos) == 0:
+        return np.empty((0, 2)), np.empty((0, 2, 2))
 
-    # the covariance matrix of a landmark at the previous time step
-    S = landmark.covariance
-    # compute the Jacobian of the robot's position
-    H = calculate_jacobian((robot_x, robot_y), (landmark.x, landmark.y))
-    # compute the measurement covariance matrix
-    Q = compute_measurement_covariance(H, S, sigma_observation)
-    # compute the Kalman gain
-    K = compute_kalman_gain(H, S, Q)
+    # the dist and bearing we expect to measure from the landmarks' current estimates
+    dx = old_pos[:, 0] - robot_position[0]
+    dy = old_pos[:, 1] - robot_position[1]
+    predicted = np.column_stack((np.hypot(dx, dy), np.arctan2(dy, dx)))
 
-    # calculate the new landmark's position estimate using the Kalman gain
-    old_landmark = np.array(landmark.x, landmark.y)
-    new_landmark = compute_new_landmark((dist, bearing), (predicted_dist, predicted_bearing), K, old_landmark)
+    # compute the Jacobians of the robot's position
+    H = calculate_jacobians(robot_position, old_pos)
+    # compute the measurement covariance matrices
+    Q = compute_measurement_covariances(H, old_cov, sigma_observation)
+    # compute the Kalman gains
+    K = compute_kalman_gains(H, old_cov, Q)
 
-    # compute the updated covariance of the landmark
-    new_covariance = compute_new_covariance(K, H, S)
+    # calculate the new landmark position estimates from the innovation and the Kalman gains
+    innovation = measurements - predicted
+    innovation[:, 1] = adjust_angle(innovation[:, 1])
 
-    return Landmark(new_landmark[0], new_landmark[1], new_covariance, des, landmark.counter)
+    return old_pos + np.einsum('nij,nj->ni', K, innovation), compute_new_covariances(K, H, old_cov)
 
 
-def compute_transform(matcher, kp1, des1, kp2, des2):
+def match_arrays(matches):
     """
-    computes the transformation between two sets of keypoints and descriptors
+    converts the result of a knnMatch with k=2 into arrays, queries with less than two neighbors are dropped
+
+    :param matches: the list of lists of DMatch returned by knnMatch
+    :return: arrays of the query indices, train indices, best distances and second best distances
     """
-    transform = None
+    pairs = [match for match in matches if len(match) > 1]
+
+    query = np.array([m[0].queryIdx for m in pairs], dtype=np.int64)
+    train = np.array([m[0].trainIdx for m in pairs], dtype=np.int64)
+    distance0 = np.array([m[0].distance for m in pairs], dtype=np.float64)
+    distance1 = np.array([m[1].distance for m in pairs], dtype=np.float64)
+
+    return query, train, distance0, distance1
 
-    if des1 is not None and des2 is not None:
-        matches = matcher.knnMatch(des1, des2, k=2)
 
-        good = []
-        for match in matches:
-            if len(match) > 1 and match[0].distance < MATCH_RATIO * match[1].distance:
-                good.append(match[0])
+def compute_transform(frame1, frame2, predicted=None):
+    """
+    computes the transformation between the keypoints of two frames
 
-        src_pts = np.float32([kp1[m.queryIdx].pt for m in good]).reshape(-1, 1, 2)
-        dst_pts = np.float32([kp2[m.trainIdx].pt for m in good]).reshape(-1, 1, 2)
+    :param frame1, frame2: the Frames to transform from and to
+    :param predicted: a predicted 2 x 3 transform from frame 1 to frame 2, used to guide the matching
+    """
+    query, train = frame2.match(frame1, predicted)
 
-        # estimateRigidTransform needs at least three pairs
-        if src_pts is not None and dst_pts is not None and len(src_pts) > 3 and len(dst_pts) > 3:
-            transform = cv2.estimateRigidTransform(src_pts, dst_pts, False)
+    # estimateRigidTransform needs at least three pairs
+    if len(query) > 3:
+        return cv2.estimateRigidTransform(frame1.points[query].reshape(-1, 1, 2),
+                                          frame2.points[train].reshape(-1, 1, 2), False)
 
-    return transform
+    return None
 
 
 def distance(x1, y1, x2, y2):
@@ -288,14 +336,9 @@ def normal(mu, sigma):
 
 def adjust_angle(angle):
     """
-    keeps angle within -pi to pi
+    keeps angle within -pi to pi, works on scalars and on arrays of angles
     """
-    while angle > math.pi:
-        angle -= 2 * math.pi
-    while angle <= -math.pi:
-        angle += 2 * math.pi
-
-    return angle
+    return math.pi - np.mod(math.pi - angle, 2 * math.pi)
 
 
 
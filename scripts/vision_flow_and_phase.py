@@ -5,6 +5,8 @@ import picamera
 from sensor_msgs.msg import Image
 from analyze_flow import AnalyzeFlow
 from analyze_phase import AnalyzePhase
+from frame_pipeline import FramePipeline
+import frame_ingest
 from cv_bridge import CvBridge
 
 
@@ -32,20 +34,24 @@ def main():
                     flow_analyzer.setup(camera.resolution)
                     phase_analyzer.setup()
 
+                    # the phase analyzer works on the newest frame on its own thread, so it never holds up the camera
+                    phase_pipeline = FramePipeline(phase_analyzer, 'phase')
+
                     # start the recordings for the image and the motion vectors
                     camera.start_recording("/dev/null", format='h264', splitter_port=1, motion_output=flow_analyzer)
-                    camera.start_recording(phase_analyzer, format='bgr', splitter_port=2)
+                    camera.start_recording(phase_pipeline, format=frame_ingest.FORMAT, splitter_port=2)
                     # nonblocking wait
                     while not rospy.is_shutdown():
                         camera.wait_recording(1/100.0)
                         # publish the raw image
                         if phase_analyzer.previous_image is not None:
-                            image_message = bridge.cv2_to_imgmsg(phase_analyzer.previous_image, encoding="bgr8")
+                            image_message = bridge.cv2_to_imgmsg(phase_analyzer.previous_image, encoding="mono8")
                             image_pub.publish(image_message)
                 # safely shutdown the camera recording for flow_analyzer
                 camera.stop_recording(splitter_port=1)
             # safely shutdown the camera recording for phase_analyzer
             camera.stop_recording(splitter_port=2)
+            phase_pipeline.close()
 
         print "Shutdown Received"
         sys.exit()
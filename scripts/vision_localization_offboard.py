@@ -2,6 +2,10 @@
 offboard_vision
 
 Run this file for SLAM or localization offboard (run it on the pi)
+
+The ORB features of the frames are published for SLAM or localization running on another host, see
+feature_transport.py. The frames are written into shared memory for nodes running on the pi, and published as
+images for nodes on other hosts which use them, see frame_transport.py
 """
 
 
@@ -9,6 +13,9 @@ import numpy as np
 import picamera
 import picamera.array
 from analyze_flow import AnalyzeFlow
+from frame_transport import FrameWriter
+from feature_transport import FeaturePublisher
+from pidrone_pkg.msg import State
 from sensor_msgs.msg import Image, Range, CameraInfo
 import rospy
 from cv_bridge import CvBridge, CvBridgeError
@@ -49,6 +56,9 @@ def main():
 
     try:
         bridge = CvBridge()
+        frame_writer = FrameWriter(CAMERA_WIDTH, CAMERA_HEIGHT, 3)
+        feature_publisher = FeaturePublisher()
+        rospy.Subscriber('/pidrone/state', State, feature_publisher.state_callback)
 
         with picamera.PiCamera(framerate=90) as camera:
             camera.resolution = (CAMERA_WIDTH, CAMERA_HEIGHT)
@@ -64,15 +74,21 @@ def main():
                     camera.wait_recording(1 / 40.0)
 
                     if camera_transmitter.prev_img is not None and camera_transmitter.prev_time != last_time:
-                        image_message = bridge.cv2_to_imgmsg(camera_transmitter.prev_img, encoding="bgr8")
-                        image_message.header.stamp = camera_transmitter.prev_rostime
-                        # print "stamp", image_message.header.stamp
                         last_time = camera_transmitter.prev_rostime
-                        image_pub.publish(image_message)
+                        frame_writer.write(camera_transmitter.prev_img, last_time)
+                        feature_publisher.publish(camera_transmitter.prev_img, last_time)
+
+                        # only convert the frame to an image for nodes which read the topic, the nodes on the pi
+                        # read it from shared memory
+                        if image_pub.get_num_connections() > 0:
+                            image_message = bridge.cv2_to_imgmsg(camera_transmitter.prev_img, encoding="bgr8")
+                            image_message.header.stamp = last_time
+                            image_pub.publish(image_message)
                         camera_info_pub.publish(cim.getCameraInfo())
 
                 camera.stop_recording(splitter_port=1)
                 camera.stop_recording(splitter_port=2)
+        frame_writer.close()
         print "Shutdown Received"
     except Exception:
         print "Camera Error!!"
@@ -16,6 +16,8 @@ import camera_info_manager
 import rospy
 from sensor_msgs.msg import Image, Range, CameraInfo
 from analyze_flow import AnalyzeFlow
+from frame_pipeline import FramePipeline
+import frame_ingest
 from std_msgs.msg import Empty
 from pidrone_pkg.msg import State
 import argparse
@@ -62,15 +64,18 @@ def main():
                 rospy.Subscriber('/pidrone/reset_transform', Empty, phase_analyzer.reset_callback)
                 rospy.Subscriber('/pidrone/state', State, phase_analyzer.state_callback)
 
+                # the estimator works on the newest frame on its own thread, so it never holds up the camera
+                phase_pipeline = FramePipeline(phase_analyzer, 'slam' if args.SLAM else 'localization')
+
                 camera.start_recording("/dev/null", format='h264', splitter_port=1, motion_output=flow_analyzer)
                 print "Starting Flow"
-                camera.start_recording(phase_analyzer, format='bgr', splitter_port=2)
+                camera.start_recording(phase_pipeline, format=frame_ingest.FORMAT, splitter_port=2)
                 last_time = None
                 while not rospy.is_shutdown():
                     camera.wait_recording(1 / 100.0)
 
                     if phase_analyzer.prev_img is not None and phase_analyzer.prev_time != last_time:
-                        image_message = bridge.cv2_to_imgmsg(phase_analyzer.prev_img, encoding="bgr8")
+                        image_message = bridge.cv2_to_imgmsg(phase_analyzer.prev_img, encoding="mono8")
                         image_message.header.stamp = phase_analyzer.prev_rostime
                         last_time = phase_analyzer.prev_rostime
                         image_pub.publish(image_message)
@@ -78,6 +83,7 @@ def main():
 
                 camera.stop_recording(splitter_port=1)
                 camera.stop_recording(splitter_port=2)
+                phase_pipeline.close()
         print "Shutdown Received"
     except Exception:
         print "Camera Error!!"